@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+"""Offline benchmarks of discovery, template loading and provisioning.
+
+A fleet of 10, 100 and 1000 profiles is simulated with the moto mocks the
+tests use. Every profile is a role assumed in its own moto account, so each
+profile gets its own stacks. Latency and throttling can be injected in
+front of moto to see how concurrency behaves against a slow, rate limited
+API. Results are printed and can be compared against a stored baseline.
+
+Usage:
+    python benchmarks/benchmark.py --sizes 10 100 --latency 0.05 \\
+        --compare benchmarks/baseline.json
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from unittest import mock
+
+import boto3
+from botocore.awsrequest import AWSResponse
+from botocore.handlers import BUILTIN_HANDLERS
+import moto
+from moto.core.botocore_stubber import MockRawResponse
+from moto.core.models import botocore_stubber
+from moto.iam.models import IAMBackend
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from lib.accounts import AwsAccounts  # noqa: E402
+from lib.clients import ClientPool  # noqa: E402
+from lib.metrics import metrics  # noqa: E402
+from lib.provisioners import AwsProvisioner  # noqa: E402
+from lib.stacks import Template  # noqa: E402
+
+logger = logging.getLogger('benchmark')
+
+DEFAULT_SIZES = (10, 100, 1000)
+
+PROFILE_PREFIX = 'bench-'
+
+REGION = 'us-east-1'
+
+TEMPLATE_PATH = os.path.join(REPO_DIR, 'tests', 'cfn_valid_template1.yaml')
+
+# Services that answer with throttling errors when throttling is injected
+THROTTLED_SERVICES = ('cloudformation', 'sts')
+
+THROTTLING_BODY = (
+    b'<ErrorResponse><Error><Type>Sender</Type><Code>Throttling</Code>'
+    b'<Message>Rate exceeded</Message></Error>'
+    b'<RequestId>benchmark</RequestId></ErrorResponse>'
+)
+
+# Relative increase in wall time tolerated before a case is a regression
+DEFAULT_TOLERANCE = 0.25
+
+
+##########################################################################
+# Args
+
+parser = argparse.ArgumentParser(
+    description="Benchmarks discovery, template loading and provisioning "
+                "against a simulated fleet of accounts."
+)
+parser.add_argument('--sizes',
+                    type=int,
+                    nargs='+',
+                    default=list(DEFAULT_SIZES),
+                    help="Number of profiles in each simulated fleet. "
+                         "Defaults to 10 100 1000"
+                    )
+parser.add_argument('--max-workers',
+                    type=int,
+                    default=20,
+                    help="max_workers used for discovery and provisioning. "
+                         "Defaults to 20"
+                    )
+parser.add_argument('--latency',
+                    type=float,
+                    default=0.05,
+                    help="Seconds added to every API call. Defaults to 0.05"
+                    )
+parser.add_argument('--throttle-rate',
+                    type=float,
+                    default=0.02,
+                    help="Fraction of CloudFormation and STS calls answered "
+                         "with a throttling error. Defaults to 0.02"
+                    )
+parser.add_argument('--rate-limits',
+                    type=json.loads,
+                    default={'cloudformation': 0, 'sts': 0},
+                    help="JSON object of the provisioner's rate limits. "
+                         "Client side limits are off by default so the "
+                         "simulated API is the bottleneck"
+                    )
+parser.add_argument('--template-loads',
+                    type=int,
+                    default=100,
+                    help="Times the S3 template is loaded. Defaults to 100"
+                    )
+parser.add_argument('--seed',
+                    type=int,
+                    default=0,
+                    help="Seed of the injected throttling. Defaults to 0"
+                    )
+parser.add_argument('--output',
+                    help="Path to write the results to as JSON"
+                    )
+parser.add_argument('--compare',
+                    help="Path to a baseline to compare the results with, "
+                         "exits with 1 if a case regressed"
+                    )
+parser.add_argument('--tolerance',
+                    type=float,
+                    default=DEFAULT_TOLERANCE,
+                    help="Relative increase in wall time and peak memory "
+                         "allowed when comparing. Defaults to 0.25"
+                    )
+
+
+##########################################################################
+# Simulated fleet
+
+class LatencyInjector:
+    """botocore before-send handler that slows down and throttles calls
+    before they reach moto.
+
+    botocore calls every before-send handler and uses the first response,
+    so the injector takes the place of moto's handler and passes the calls
+    that are not throttled on to it. moto is not thread safe, so they are
+    passed one at a time, after the latency has been added.
+
+    Args:
+        latency:        Seconds slept before every call.
+        throttle_rate:  Fraction of THROTTLED_SERVICES calls that get a
+                        throttling error instead of a response.
+        seed:           Seed of the random throttling.
+
+    """
+
+    def __init__(self, latency=0.0, throttle_rate=0.0, seed=0):
+        self._latency = latency
+        self._lock = threading.Lock()
+        self._moto_lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._throttle_rate = throttle_rate
+
+    def __call__(self, request, event_name, **kwargs):
+        if self._latency:
+            time.sleep(self._latency)
+        service = event_name.split('.')[1]
+        if service in THROTTLED_SERVICES and self._throttle_rate:
+            with self._lock:
+                throttled = self._random.random() < self._throttle_rate
+            if throttled:
+                return AWSResponse(request.url, 400, {},
+                                   MockRawResponse(THROTTLING_BODY))
+        with self._moto_lock:
+            return botocore_stubber(request=request, event_name=event_name,
+                                    **kwargs)
+
+
+@contextmanager
+def injected(args):
+    """Puts a LatencyInjector in front of moto for the sessions created
+    inside the with block."""
+    index = BUILTIN_HANDLERS.index(('before-send', botocore_stubber))
+    BUILTIN_HANDLERS[index] = ('before-send', LatencyInjector(
+        args.latency, args.throttle_rate, args.seed
+    ))
+    try:
+        yield
+    finally:
+        BUILTIN_HANDLERS[index] = ('before-send', botocore_stubber)
+
+
+def write_fleet(directory, size):
+    """Writes a credentials file with size profiles and points boto3 to it.
+
+    Each profile holds the credentials of a role assumed in its own moto
+    account, so moto keeps the stacks of the profiles apart.
+    """
+    sts = boto3.client('sts',
+                       region_name=REGION,
+                       aws_access_key_id='benchmark',
+                       aws_secret_access_key='benchmark')
+    sections = []
+    for number in range(size):
+        account_id = str(100000000000 + number)
+        credentials = sts.assume_role(
+            RoleArn="arn:aws:iam::{}:role/benchmark".format(account_id),
+            RoleSessionName='benchmark'
+        )['Credentials']
+        sections.append(
+            "[{}{:04d}]\n"
+            "aws_access_key_id = {}\n"
+            "aws_secret_access_key = {}\n"
+            "aws_session_token = {}\n".format(PROFILE_PREFIX, number,
+                                              credentials['AccessKeyId'],
+                                              credentials['SecretAccessKey'],
+                                              credentials['SessionToken'])
+        )
+    credentials_path = os.path.join(directory, 'credentials')
+    with open(credentials_path, 'w') as credentials_file:
+        credentials_file.write('\n'.join(sections))
+    config_path = os.path.join(directory, 'config')
+    with open(config_path, 'w') as config_file:
+        config_file.write("[default]\nregion = {}\n".format(REGION))
+    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = credentials_path
+    os.environ['AWS_CONFIG_FILE'] = config_path
+
+
+##########################################################################
+# Cases
+
+def measure(function):
+    """Runs function and returns its wall time and API calls."""
+    metrics.reset()
+    start = time.perf_counter()
+    function()
+    return {
+        'api_calls': sum(metrics.calls.values()),
+        'throttles': sum(metrics.throttles.values()),
+        'wall_seconds': round(time.perf_counter() - start, 3)
+    }
+
+
+def discovery_case(args, size):
+    with fleet(args, size):
+        return measure(
+            lambda: AwsAccounts(include=PROFILE_PREFIX,
+                                max_workers=args.max_workers,
+                                client_pool=ClientPool(
+                                    max_pool_connections=args.max_workers
+                                )).target_accounts
+        )
+
+
+def provision_case(args, size):
+    def provision():
+        summary = AwsProvisioner(
+            'file://' + TEMPLATE_PATH,
+            REGION,
+            'benchmark',
+            {},
+            include_profiles=PROFILE_PREFIX,
+            max_workers=args.max_workers,
+            rate_limits=args.rate_limits
+        ).provision_accounts(confirm=False)
+        if summary.failed:
+            raise RuntimeError("{} accounts failed to provision, first "
+                               "error: {}".format(len(summary.failed),
+                                                  summary.failed[0].error))
+
+    with fleet(args, size):
+        return measure(provision)
+
+
+def template_case(args, size):
+    """Loads an S3 template size times with a cache dir, the first load
+    downloads it and the rest revalidate the cache."""
+    with moto.mock_s3(), tempfile.TemporaryDirectory() as directory:
+        s3 = boto3.client('s3', region_name=REGION)
+        s3.create_bucket(Bucket='benchmark')
+        with open(TEMPLATE_PATH) as template_file:
+            s3.put_object(Bucket='benchmark', Key='template.yaml',
+                          Body=template_file.read())
+        with injected(args):
+            client_pool = ClientPool()
+            return measure(lambda: [
+                Template('s3://benchmark/template.yaml',
+                         cache_dir=directory,
+                         client_pool=client_pool)
+                for _ in range(size)
+            ])
+
+
+@contextmanager
+def fleet(args, size):
+    """Mocks AWS with a fleet of size profiles behind a LatencyInjector."""
+    # Every moto account copies the AWS managed policies into its IAM
+    # backend, which the benchmark does not need and would dominate its
+    # memory use
+    with mock.patch.object(IAMBackend, '_init_aws_policies', list), \
+            mock.patch.object(IAMBackend, '_init_managed_policies', dict), \
+            moto.mock_iam(), moto.mock_sts(), moto.mock_cloudformation(), \
+            tempfile.TemporaryDirectory() as directory:
+        write_fleet(directory, size)
+        with injected(args):
+            yield
+
+
+def run_case(case, args, size):
+    """Runs a case and adds the peak memory of the process to its result.
+
+    Each case is run in a process of its own, so the peak memory is its own
+    and the moto state of one case does not leak into the next.
+    """
+    result = case(args, size)
+    # ru_maxrss is in KiB on Linux
+    result['peak_rss_mb'] = round(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+    )
+    return result
+
+
+def run_cases(args):
+    """Returns a dict of case name to result."""
+    cases = [('template-s3', template_case, args.template_loads)]
+    for size in args.sizes:
+        cases.append(('discovery-{}'.format(size), discovery_case, size))
+        cases.append(('provision-{}'.format(size), provision_case, size))
+    results = {}
+    for name, case, size in cases:
+        with ProcessPoolExecutor(
+                max_workers=1,
+                mp_context=multiprocessing.get_context('fork')) as executor:
+            results[name] = executor.submit(run_case, case, args,
+                                            size).result()
+        logger.info("{}: {}".format(name, results[name]))
+    return results
+
+
+##########################################################################
+# Report
+
+def compare(results, settings, baseline, tolerance):
+    """Returns lines comparing results with a baseline and the names of the
+    cases that regressed."""
+    lines = []
+    regressions = []
+    if baseline.get('settings') != settings:
+        lines.append("Baseline was made with different settings: {}".format(
+            baseline.get('settings')
+        ))
+    for name, result in sorted(results.items()):
+        expected = baseline.get('results', {}).get(name)
+        if not expected:
+            lines.append("{:<16} no baseline".format(name))
+            continue
+        ratio = (result['wall_seconds'] / expected['wall_seconds']
+                 if expected['wall_seconds'] else 1.0)
+        rss_ratio = (result['peak_rss_mb'] / expected['peak_rss_mb']
+                     if expected.get('peak_rss_mb') else 1.0)
+        regressed = (ratio > 1 + tolerance
+                     or rss_ratio > 1 + tolerance
+                     or result['api_calls'] > expected['api_calls'])
+        if regressed:
+            regressions.append(name)
+        lines.append(
+            "{:<16} {:>9.3f}s vs {:>9.3f}s ({:>5.2f}x)  {:>7} vs {:>7} "
+            "calls  {:>7.1f} vs {:>7.1f} MB ({:>5.2f}x){}".format(
+                name, result['wall_seconds'], expected['wall_seconds'],
+                ratio, result['api_calls'], expected['api_calls'],
+                result['peak_rss_mb'], expected.get('peak_rss_mb', 0.0),
+                rss_ratio, '  REGRESSED' if regressed else '')
+        )
+    return lines, regressions
+
+
+def report(results):
+    lines = ["{:<16} {:>10} {:>9} {:>9} {:>13}".format(
+        'case', 'wall (s)', 'calls', 'throttles', 'peak RSS (MB)'
+    )]
+    for name, result in sorted(results.items()):
+        lines.append("{:<16} {:>10.3f} {:>9} {:>9} {:>13.1f}".format(
+            name, result['wall_seconds'], result['api_calls'],
+            result['throttles'], result['peak_rss_mb']
+        ))
+    return '\n'.join(lines)
+
+
+##########################################################################
+# Main
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    logger.setLevel(logging.INFO)
+    os.environ.setdefault('AWS_DEFAULT_REGION', REGION)
+
+    results = run_cases(args)
+    print(report(results))
+    settings = {'latency': args.latency,
+                'max_workers': args.max_workers,
+                'rate_limits': args.rate_limits,
+                'template_loads': args.template_loads,
+                'throttle_rate': args.throttle_rate}
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'settings': settings, 'results': results},
+                      output, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            lines, regressions = compare(results, settings,
+                                         json.load(baseline_file),
+                                         args.tolerance)
+        print('\n'.join(["\nCompared with {}".format(args.compare)] + lines))
+        if regressions:
+            sys.exit(1)
@@ -1,9 +1,14 @@
-import _io
-import configparser
+import asyncio
+import json
 import logging
+import os
 import re
+import threading
+import time
 
-import boto3
+from lib import aio
+from lib.clients import client_pool as default_client_pool
+from lib.progress import progress
 
 logger = logging.getLogger(__name__)
 
@@ -11,15 +16,43 @@ logger = logging.getLogger(__name__)
 class AwsAccount:
     """Contains metadata and connection info for each account
 
+    Only the account's identity is kept, the session is taken from the client
+    pool when first needed and can be dropped with release() once the
+    account has been worked on, so thousands of accounts do not keep
+    thousands of idle sessions and clients alive.
+
     Args:
-        profile_name: Name of the profile used to build the AwsAccount object.
+        profile_name:   Name of the profile used to build the AwsAccount
+                        object.
+        account_id:     Id of the account. Looked up with STS when not
+                        provided.
+        client_pool:    ClientPool the session and clients of the account
+                        are taken from.
+        credential_provider: botocore CredentialProvider used instead of the
+                        credentials of the profile, i.e. for an assumed
+                        role. profile_name is then only used as a label.
 
     """
 
-    def __init__(self, profile_name):
+    __slots__ = ('_client_pool', '_credential_provider', '_id',
+                 '_profile_name')
+
+    def __init__(self, profile_name, account_id=None, client_pool=None,
+                 credential_provider=None):
         self._profile_name = profile_name
-        self._session = boto3.session.Session(profile_name=profile_name)
-        self._id = self._session.client('sts').get_caller_identity()['Account']
+        self._client_pool = client_pool or default_client_pool
+        self._credential_provider = credential_provider
+        self._id = account_id
+        if not account_id:
+            self._id = self.client('sts').get_caller_identity()['Account']
+
+    def client(self, service_name, region_name=None):
+        """Returns a pooled client of the account."""
+        # Makes sure the pooled session is the account's own
+        self.session
+        return self._client_pool.client(service_name,
+                                        profile_name=self._profile_name,
+                                        region_name=region_name)
 
     @property
     def id(self):
@@ -29,9 +62,79 @@ class AwsAccount:
     def profile_name(self):
         return self._profile_name
 
+    def release(self):
+        """Drops the session and clients of the account from the pool, they
+        are created again if the account is used afterwards."""
+        self._client_pool.release(self._profile_name)
+
     @property
     def session(self):
-        return self._session
+        return self._client_pool.session(
+            self._profile_name,
+            account=lambda: self._id or self._profile_name,
+            credential_provider=self._credential_provider
+        )
+
+
+class IdentityCache:
+    """On-disk cache of profile name to account id.
+
+    Entries are keyed by a fingerprint of the profile's credentials and
+    config entries, so editing a profile invalidates its cached account id.
+
+    Args:
+        path:   Path to the JSON cache file.
+        ttl:    Number of seconds an entry is valid for. Defaults to a day.
+
+    """
+
+    def __init__(self, path, ttl=86400):
+        self._path = os.path.expanduser(path)
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = self.__load()
+
+    def get(self, profile_name, fingerprint):
+        """Returns the cached account id or None if missing or expired."""
+        with self._lock:
+            entry = self._entries.get(profile_name)
+        if (not entry
+                or entry['fingerprint'] != fingerprint
+                or time.time() - entry['timestamp'] >= self._ttl):
+            return None
+        return entry['account_id']
+
+    def save(self):
+        """Writes the cache to disk."""
+        directory = os.path.dirname(self._path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(self._path, os.getpid())
+        with self._lock:
+            with open(tmp_path, 'w') as cache_file:
+                json.dump(self._entries, cache_file, indent=2, sort_keys=True)
+        os.replace(tmp_path, self._path)
+
+    def set(self, profile_name, fingerprint, account_id):
+        with self._lock:
+            self._entries[profile_name] = {
+                'account_id': account_id,
+                'fingerprint': fingerprint,
+                'timestamp': time.time()
+            }
+
+    def __load(self):
+        if not os.path.exists(self._path):
+            return {}
+        try:
+            with open(self._path) as cache_file:
+                entries = json.load(cache_file)
+        except ValueError:
+            logger.warning(
+                "Ignoring unreadable identity cache {}".format(self._path)
+            )
+            return {}
+        return entries if type(entries) is dict else {}
 
 
 class AwsAccounts:
@@ -40,46 +143,154 @@ class AwsAccounts:
     credentials files defaults to ~/.aws/credentials or needs to be overrided
     via the AWS_SHARED_CREDENTIALS_FILE env var
 
+    The credentials and config files are parsed once, by the SharedConfig of
+    the client pool. accounts_async() yields the accounts as they are
+    resolved, so work on the first accounts can start while the others are
+    still being looked up.
+
     Args:
-        include:    A list or regex of profile names that should be
-                    provisioned.
-        exclude:    A list or regex of profiles names that should not be
-                    provisioned. Exclude is processed before includes.
+        include:        A list or regex of profile names that should be
+                        provisioned.
+        exclude:        A list or regex of profiles names that should not be
+                        provisioned. Exclude is processed before includes.
+        max_workers:    Number of profiles whose identity is looked up at
+                        the same time. Defaults to 1.
+        identity_cache: IdentityCache used to skip STS lookups for profiles
+                        that have already been resolved.
+        client_pool:    ClientPool shared by all accounts.
     """
 
-    def __init__(self, include=None, exclude=None):
-        self._include = include
-        self._exclude = exclude
+    def __init__(self, include=None, exclude=None, max_workers=1,
+                 identity_cache=None, client_pool=None):
+        self._include = self._criteria(include)
+        self._exclude = self._criteria(exclude)
+        self._max_workers = max_workers
+        self._identity_cache = identity_cache
+        self._client_pool = client_pool
+        self._target_accounts = None
+
+    async def accounts_async(self):
+        """Yields the AwsAccount objects to be provisioned as they are
+        resolved, which is not necessarily in target_accounts order.
+
+        Once all accounts have been yielded they are kept as
+        target_accounts, later calls yield those.
+        """
+        if self._target_accounts is not None:
+            for account in self._target_accounts:
+                yield account
+            return
+        resolved = []
+        async for index, account in self._discover_async():
+            resolved.append((index, account))
+            progress.emit('discovered', account_id=account.id,
+                          profile_name=account.profile_name)
+            yield account
+        self._target_accounts = [account for _, account in sorted(
+            resolved, key=lambda item: item[0]
+        )]
+
+    @property
+    def discovered(self):
+        """Returns True once all target accounts have been resolved."""
+        return self._target_accounts is not None
 
     @property
     def target_accounts(self):
-        """Returns a list of profile names to be provisioned."""
-        profiles = boto3.Session().available_profiles
-        target_accounts = []
-        for profile in profiles:
+        """Returns a list of AwsAccount objects to be provisioned.
+
+        The list is built on first access and reused afterwards.
+        """
+        if self._target_accounts is None:
+            aio.run(self.__drain(), max_threads=self._max_workers)
+        return self._target_accounts
+
+    async def __drain(self):
+        async for _ in self.accounts_async():
+            pass
+
+    async def _discover_async(self):
+        """Yields (index, AwsAccount) pairs of the accounts to be
+        provisioned as they are resolved, index is the position of the
+        account in discovery order."""
+        shared_config = (self._client_pool
+                         or default_client_pool).shared_config
+        target_profiles = []
+        for profile in await asyncio.to_thread(
+                lambda: shared_config.profiles):
             if self._exclude and self._match(profile, self._exclude):
                 logger.info("Excluding profile {}".format(profile))
                 continue
             elif self._include:
                 if self._match(profile, self._include):
                     logger.info("Including profile {}".format(profile))
-                    account = AwsAccount(profile)
-                    target_accounts.append(account)
+                    target_profiles.append(profile)
             else:
                 logger.info("Including profile {}".format(profile))
-                account = AwsAccount(profile)
-                target_accounts.append(account)
-        return target_accounts
+                target_profiles.append(profile)
+
+        async for (index, profile), account in aio.iter_blocking(
+                lambda item: self.__resolve(
+                    item[1], shared_config.fingerprint(item[1])),
+                enumerate(target_profiles),
+                self._max_workers):
+            if account:
+                yield index, account
+
+        if self._identity_cache:
+            self._identity_cache.save()
+
+    def __resolve(self, profile, fingerprint):
+        """Builds an AwsAccount, using the identity cache when possible.
+        Returns None if the account of the profile can not be looked up, so
+        one broken profile does not stop the accounts provisioned while
+        they are discovered."""
+        progress.emit('discovering', profile_name=profile)
+        account_id = None
+        if self._identity_cache:
+            account_id = self._identity_cache.get(profile, fingerprint)
+            if account_id:
+                logger.debug(
+                    "Using cached account id for profile {}".format(profile)
+                )
+        try:
+            account = AwsAccount(profile,
+                                 account_id=account_id,
+                                 client_pool=self._client_pool)
+        except Exception as e:
+            logger.error("Excluding profile {}, unable to look up its "
+                         "account: {}".format(profile, e))
+            (self._client_pool or default_client_pool).release(profile)
+            return None
+        if not account_id:
+            if self._identity_cache:
+                self._identity_cache.set(profile, fingerprint, account.id)
+            # The STS client is not needed again, the session is created
+            # again once the account is provisioned
+            account.release()
+        return account
+
+    @staticmethod
+    def _criteria(criteria):
+        """Returns a list criteria as a frozenset and a regex criteria as a
+        compiled pattern, so matching many items does not repeat the work."""
+        if not criteria:
+            return None
+        if type(criteria) in (list, set, frozenset):
+            return frozenset(criteria)
+        return re.compile(criteria)
 
     @staticmethod
     def _match(item, criteria):
         """Determines if an item matches a criteria.
 
-        Criteria is either a list or a regex. Returns True or False.
+        Criteria is either a list or a regex, as given or as returned by
+        _criteria. Returns True or False.
         """
-        if type(criteria) is list:
+        if type(criteria) in (list, set, frozenset):
             return item in criteria
+        elif isinstance(criteria, re.Pattern):
+            return criteria.match(item)
         else:
             # If not list, assume regex
             return re.match(criteria, item)
-
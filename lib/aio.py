@@ -0,0 +1,51 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+# Most threads making blocking AWS calls for a run. Waiting for stacks does
+# not hold a thread, so far more units than threads can be in flight.
+DEFAULT_MAX_THREADS = 32
+
+
+def run(coroutine, max_threads=None):
+    """Runs a coroutine on a new event loop and returns its result.
+
+    boto3 clients are blocking, so the coroutines of this package make their
+    calls with asyncio.to_thread. Those calls are made by a pool of at most
+    max_threads threads, which is shut down when the coroutine is done.
+
+    Args:
+        coroutine:      Coroutine to run.
+        max_threads:    Size of the thread pool. Defaults to
+                        DEFAULT_MAX_THREADS.
+
+    """
+    async def main():
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(
+            max_workers=max_threads or DEFAULT_MAX_THREADS,
+            thread_name_prefix='bct-aws'
+        ))
+        return await coroutine
+
+    return asyncio.run(main())
+
+
+async def iter_blocking(function, items, limit):
+    """Calls a blocking function with each item, at most limit at a time,
+    and yields (item, result) pairs as the calls finish.
+
+    Calls that have not finished are cancelled when the generator is closed
+    early.
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def call(item):
+        async with semaphore:
+            return item, await asyncio.to_thread(function, item)
+
+    tasks = [asyncio.ensure_future(call(item)) for item in items]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
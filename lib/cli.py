@@ -0,0 +1,560 @@
+"""Command line interface of the provisioner.
+
+Only the standard library is imported with this module. yaml is imported
+when a config file is read and boto3 once the config is valid and accounts
+are about to be provisioned, so --help and config errors return without
+paying for either.
+"""
+import argparse
+import json
+import logging
+from pathlib import Path
+import sys
+
+from lib.logs import ContextFilter
+from lib.manifests import Manifest
+from lib.metrics import metrics
+from lib.progress import progress
+
+logger = logging.getLogger(__name__)
+
+LOG_LEVELS = {
+    'debug':    logging.DEBUG,
+    'info':     logging.INFO,
+    'warn':     logging.WARN,
+    'error':    logging.ERROR
+}
+
+
+def build_parser():
+    """Returns the parser of the command line arguments."""
+    parser = argparse.ArgumentParser(
+        description="Provisions AWS accounts to be used with BCT and Related "
+                    "Tools. Use the AWS_SHARED_CREDENTIALS_FILE env var to "
+                    "change the desired AWS credentials file."
+    )
+
+    parser.add_argument('--config-file',
+                        dest='ConfigFile',
+                        default='config.yaml',
+                        help="Path to provisioner config file. "
+                             "Defaults to config.yaml"
+                        )
+    parser.add_argument('--template-url',
+                        dest='CfnTemplateUrl',
+                        help="s3 or file url to cloudformation template. "
+                             "Required unless the config file has a Stacks "
+                             "manifest."
+                        )
+    parser.add_argument('--region',
+                        dest='AwsRegion',
+                        help="aws region, or comma separated list of regions, "
+                             "used for cfn stack. Defaults to us-east-1"
+                        )
+    parser.add_argument('--stack-name',
+                        dest='CfnStackName',
+                        help="Name of cfn stack. "
+                             "Defaults to name of the template file "
+                             "(i.e. BctTools.yaml becomes BctTools) "
+                        )
+    parser.add_argument('--cfn-params',
+                        dest='CfnParams',
+                        help="JSON object of CFN Params."
+                        )
+    parser.add_argument('--include-profiles',
+                        dest='IncludeProfiles',
+                        help="comma separated list or regex of profiles that "
+                             "should be provisioned"
+                        )
+    parser.add_argument('--exclude-profiles',
+                        dest='ExcludeProfiles',
+                        help="comma separated list or regex of profiles that "
+                             "should not be provisioned."
+                        )
+    parser.add_argument('--org-management-profile',
+                        dest='OrgManagementProfile',
+                        help="Profile of the AWS Organizations management "
+                             "account. When set, the accounts of the "
+                             "organization are provisioned instead of the "
+                             "profiles in the credentials file, and "
+                             "--include-profiles and --exclude-profiles match "
+                             "account names or ids."
+                        )
+    parser.add_argument('--org-role-name',
+                        dest='OrgRoleName',
+                        help="Role assumed in each account of the "
+                             "organization. Defaults to "
+                             "OrganizationAccountAccessRole"
+                        )
+    parser.add_argument('--org-units',
+                        dest='OrgUnits',
+                        help="comma separated list of organizational unit "
+                             "ids, only accounts in these OUs or OUs nested "
+                             "in them are provisioned."
+                        )
+    parser.add_argument('--org-account-tags',
+                        dest='OrgAccountTags',
+                        help="JSON object of tags an account of the "
+                             "organization must have to be provisioned."
+                        )
+    parser.add_argument('--no-confirm',
+                        dest='NoConfirm',
+                        action='store_true',
+                        help="Does not confirm the profiles that will be "
+                             "confirmed prior to the provisioning them."
+                        )
+    parser.add_argument('--max-workers',
+                        dest='MaxWorkers',
+                        type=int,
+                        help="Number of accounts provisioned at the same "
+                             "time. Defaults to 1"
+                        )
+    parser.add_argument('--identity-cache-file',
+                        dest='IdentityCacheFile',
+                        help="Path to the cache of profile account ids. "
+                             "Defaults to "
+                             "~/.cache/bct-account-provisioner/identities.json"
+                        )
+    parser.add_argument('--identity-cache-ttl',
+                        dest='IdentityCacheTtl',
+                        type=int,
+                        help="Seconds a cached account id is valid for, 0 "
+                             "disables the cache. Defaults to 86400"
+                        )
+    parser.add_argument('--wait-timeout',
+                        dest='StackWaitTimeout',
+                        type=int,
+                        help="Seconds to wait for a stack create, update or "
+                             "delete to finish. Defaults to 1800"
+                        )
+    parser.add_argument('--template-cache-dir',
+                        dest='TemplateCacheDir',
+                        help="Directory used to cache templates read from s3. "
+                             "Defaults to ~/.cache/bct-account-provisioner/"
+                             "templates"
+                        )
+    parser.add_argument('--template-staging-url',
+                        dest='TemplateStagingUrl',
+                        help="s3://bucket/prefix templates over 51,200 bytes "
+                             "are uploaded to and read from by "
+                             "CloudFormation. Defaults to the bucket of a "
+                             "template read from s3."
+                        )
+    parser.add_argument('--validate-template',
+                        dest='ValidateTemplate',
+                        action='store_true',
+                        default=None,
+                        help="Validates each template with CloudFormation "
+                             "once before any account is provisioned."
+                        )
+    parser.add_argument('--no-template-check',
+                        dest='NoTemplateCheck',
+                        action='store_true',
+                        default=None,
+                        help="Does not check the structure of templates "
+                             "before provisioning, i.e. for templates with "
+                             "constructs the check does not know."
+                        )
+    parser.add_argument('--verify-deployed',
+                        dest='VerifyDeployed',
+                        action='store_true',
+                        default=None,
+                        help="Compares against the template deployed in each "
+                             "stack instead of the hexdigest recorded in the "
+                             "stack tags."
+                        )
+    parser.add_argument('--plan',
+                        dest='Plan',
+                        action='store_true',
+                        default=None,
+                        help="Creates change sets in each account without "
+                             "executing them and saves them to the plan file."
+                        )
+    parser.add_argument('--apply',
+                        dest='Apply',
+                        action='store_true',
+                        default=None,
+                        help="Executes the change sets saved in the plan file."
+                        )
+    parser.add_argument('--plan-file',
+                        dest='PlanFile',
+                        help="Path to the plan file used by --plan and "
+                             "--apply. Defaults to plan.json"
+                        )
+    parser.add_argument('--journal-file',
+                        dest='JournalFile',
+                        help="Path to the journal the outcome of each account "
+                             "is recorded in. Defaults to "
+                             "~/.cache/bct-account-provisioner/journal.jsonl"
+                        )
+    parser.add_argument('--resume',
+                        dest='Resume',
+                        action='store_true',
+                        default=None,
+                        help="Skips accounts the journal records as already "
+                             "provisioned with the same template and params."
+                        )
+    parser.add_argument('--rate-limits',
+                        dest='RateLimits',
+                        help="JSON object of service name to API calls per "
+                             "second allowed in each region across all "
+                             "accounts. Defaults to "
+                             "{\"cloudformation\": 4, \"sts\": 10}"
+                        )
+    parser.add_argument('--max-attempts',
+                        dest='MaxAttempts',
+                        type=int,
+                        help="Attempts made for each throttled or failed API "
+                             "call before giving up. Defaults to 10"
+                        )
+    parser.add_argument('--engine',
+                        dest='Engine',
+                        choices=['stacks', 'stackset'],
+                        help="stacks creates a stack in each account, "
+                             "stackset deploys the template with a "
+                             "CloudFormation StackSet. Defaults to stacks"
+                        )
+    parser.add_argument('--stack-set-admin-profile',
+                        dest='StackSetAdminProfile',
+                        help="Profile of the StackSet administrator account. "
+                             "Defaults to the Organizations management "
+                             "profile or the default credentials."
+                        )
+    parser.add_argument('--failure-tolerance',
+                        dest='FailureToleranceCount',
+                        type=int,
+                        help="Accounts that can fail in each region before a "
+                             "StackSet operation is stopped. Defaults to 0"
+                        )
+    parser.add_argument('--canary-size',
+                        dest='CanarySize',
+                        type=int,
+                        help="Provisions this many accounts in a first wave, "
+                             "before the other accounts are provisioned in "
+                             "waves growing by --wave-growth. Defaults to 0, "
+                             "all accounts in one wave"
+                        )
+    parser.add_argument('--wave-growth',
+                        dest='WaveGrowth',
+                        type=float,
+                        help="Factor each wave of accounts is larger than "
+                             "the previous one. Defaults to 2"
+                        )
+    parser.add_argument('--failure-threshold',
+                        dest='FailureThreshold',
+                        type=float,
+                        help="Percentage of finished stacks that can fail "
+                             "before the stacks in flight are cancelled and "
+                             "no more are started."
+                        )
+    parser.add_argument('--metrics-file',
+                        dest='MetricsFile',
+                        help="Writes API call counts and phase timings to "
+                             "this file, in Prometheus textfile format if it "
+                             "ends in .prom and JSON otherwise."
+                        )
+    parser.add_argument('--progress-file',
+                        dest='ProgressFile',
+                        help="Streams the state of each account, region and "
+                             "stack to this file as NDJSON events, - for "
+                             "stdout in which case the summary is printed "
+                             "to stderr."
+                        )
+    parser.add_argument('--progress-summary',
+                        dest='ProgressSummary',
+                        action='store_true',
+                        default=None,
+                        help="Shows a live summary of finished and in "
+                             "flight stacks, throughput and ETA on stderr."
+                        )
+    parser.add_argument('--log-level',
+                        dest='LogLevel',
+                        default='warn',
+                        help="Log level sent to the console.")
+    return parser
+
+
+def build_config(config_dict, args_dict):
+    """Returns dict based on dict of config file contents and dict of args"""
+
+    # Set defaults
+    config = {
+                'AwsRegion': 'us-east-1',
+                'MaxWorkers': 1,
+                'IdentityCacheFile':
+                    '~/.cache/bct-account-provisioner/identities.json',
+                'IdentityCacheTtl': 86400,
+                'StackWaitTimeout': 1800,
+                'TemplateCacheDir':
+                    '~/.cache/bct-account-provisioner/templates',
+                'VerifyDeployed': False,
+                'ValidateTemplate': False,
+                'NoTemplateCheck': False,
+                'Plan': False,
+                'Apply': False,
+                'PlanFile': 'plan.json',
+                'JournalFile':
+                    '~/.cache/bct-account-provisioner/journal.jsonl',
+                'Resume': False,
+                'RateLimits': {},
+                'MaxAttempts': 10,
+                'OrgRoleName': 'OrganizationAccountAccessRole',
+                'Engine': 'stacks',
+                'FailureToleranceCount': 0,
+                'CanarySize': 0,
+                'WaveGrowth': 2,
+                'ProgressSummary': False
+    }
+
+    args_with_values = {
+        key: value for key, value in args_dict.items() if value is not None
+    }
+
+    # If arg is a string then check to see if the arg is JSON and if so then
+    # deserialize it. If it can not be deserialized, then see if it can be
+    # split into a list.
+    for key, value in args_with_values.items():
+        if type(value) is str:
+            try:
+                args_with_values[key] = dict(json.loads(value))
+                logger.debug("Deserialized JSON into dict: {}".format(value))
+                continue
+            except ValueError:
+                pass
+
+        if type(value) is str and ',' in value:
+            args_with_values[key] = value.split(',')
+            logger.debug("Split string into list: {}".format(value))
+
+    # Check to see if any JSON has been deserialized into a dict. If so,
+    # then either update an existing k:v in config_dict or create a new k:v
+    for key, value in args_with_values.items():
+        if type(value) is dict and config_dict.get(key):
+            config_dict[key].update(args_with_values[key])
+        else:
+            config_dict[key] = args_with_values[key]
+
+    config.update(config_dict)
+
+    if config.get('Stacks'):
+        # A manifest of several stacks replaces the single stack options
+        for stack in config['Stacks']:
+            validate_template_url(stack.get('CfnTemplateUrl'))
+            if not stack.get('CfnStackName'):
+                stack['CfnStackName'] = stack_name_from_url(
+                    stack['CfnTemplateUrl'])
+        if config['Engine'] != 'stacks' or config['Plan'] or config['Apply']:
+            raise ValueError("Stacks require the stacks Engine without "
+                             "Plan or Apply")
+        # Raises on unknown or cyclic dependencies before any AWS setup
+        Manifest.from_config(config['Stacks'], config.get('CfnParams'))
+    else:
+        validate_template_url(config.get('CfnTemplateUrl'))
+
+    if config['Plan'] and config['Apply']:
+        raise ValueError("Plan and Apply can not be used together")
+
+    if config['Engine'] != 'stacks' and (config['Plan'] or config['Apply']):
+        raise ValueError("Plan and Apply require the stacks Engine")
+
+    if type(config['MaxWorkers']) is not int or config['MaxWorkers'] < 1:
+        raise ValueError("MaxWorkers must be a positive integer")
+
+    if type(config['MaxAttempts']) is not int or config['MaxAttempts'] < 1:
+        raise ValueError("MaxAttempts must be a positive integer")
+
+    if type(config['CanarySize']) is not int or config['CanarySize'] < 0:
+        raise ValueError("CanarySize must be a positive integer or 0")
+
+    if config['WaveGrowth'] < 1:
+        raise ValueError("WaveGrowth must be at least 1")
+
+    if (config.get('FailureThreshold') is not None
+            and not 0 <= config['FailureThreshold'] < 100):
+        raise ValueError("FailureThreshold must be a percentage from 0 up "
+                         "to 100")
+
+    if ((config['CanarySize'] or config.get('FailureThreshold') is not None)
+            and (config['Engine'] != 'stacks' or config['Plan']
+                 or config['Apply'])):
+        raise ValueError("CanarySize and FailureThreshold require the stacks "
+                         "Engine without Plan or Apply")
+
+    # Set stack name based on template file
+    if not config.get('Stacks') and not config.get('CfnStackName'):
+        config['CfnStackName'] = stack_name_from_url(config['CfnTemplateUrl'])
+
+    logger.debug("config dict: {}".format(config))
+    return config
+
+
+def stack_name_from_url(template_url):
+    """Returns the name of the template file without its extension."""
+    path_parts = template_url.split('/')
+    filename_parts = path_parts[-1].split('.')
+    if filename_parts[-1].lower() not in ['json', 'template',
+                                          'yaml', 'yml']:
+        raise ValueError(
+            "CfnTemplateUrl must end with json, template , yaml or yml"
+        )
+    return filename_parts[-2]
+
+
+def validate_template_url(template_url):
+    if (not template_url
+        or not (template_url.startswith("s3://")
+           or template_url.startswith("file://"))):
+                raise ValueError(
+                    "CfnTemplateUrl must start with s3:// or file://"
+                )
+
+
+def load_config_file(config_path):
+    """Returns the dict in a yaml config file, or an empty dict when the
+    file does not exist."""
+    if not Path(config_path).exists():
+        logger.debug(
+            "{} not found, so just using CLI args".format(config_path)
+        )
+        return {}
+    import yaml
+    with open(config_path) as config_file:
+        try:
+            config_dict = yaml.safe_load(config_file.read())
+        except yaml.YAMLError as e:
+            raise ValueError("Could not parse {}: {}".format(config_path, e))
+    if config_dict is None:
+        return {}
+    if type(config_dict) is not dict:
+        raise ValueError("{} must contain a mapping".format(config_path))
+    return config_dict
+
+
+def provision_accounts(config):
+    """Provisions AWS Accounts"""
+    from lib.plans import Plan
+    from lib.provisioners import AwsProvisioner
+
+    manifest = (Manifest.from_config(config['Stacks'],
+                                     config.get('CfnParams'))
+                if config.get('Stacks') else None)
+
+    aws_provisioner = AwsProvisioner(
+                             config.get('CfnTemplateUrl'),
+                             config['AwsRegion'],
+                             config.get('CfnStackName'),
+                             config.get('CfnParams', {}),
+                             include_profiles=config.get('IncludeProfiles'),
+                             exclude_profiles=config.get('ExcludeProfiles'),
+                             max_workers=config['MaxWorkers'],
+                             identity_cache_path=(
+                                 config['IdentityCacheFile']
+                                 if config['IdentityCacheTtl'] > 0 else None),
+                             identity_cache_ttl=config['IdentityCacheTtl'],
+                             wait_timeout=config['StackWaitTimeout'],
+                             template_cache_dir=config['TemplateCacheDir'],
+                             verify_deployed=config['VerifyDeployed'],
+                             journal_path=config['JournalFile'],
+                             resume=config['Resume'],
+                             rate_limits=config['RateLimits'],
+                             max_attempts=config['MaxAttempts'],
+                             org_management_profile=config.get(
+                                 'OrgManagementProfile'),
+                             org_role_name=config['OrgRoleName'],
+                             org_units=config.get('OrgUnits'),
+                             org_account_tags=config.get('OrgAccountTags'),
+                             engine=config['Engine'],
+                             stack_set_admin_profile=config.get(
+                                 'StackSetAdminProfile'),
+                             failure_tolerance_count=config[
+                                 'FailureToleranceCount'],
+                             manifest=manifest,
+                             template_staging_url=config.get(
+                                 'TemplateStagingUrl'),
+                             validate_template=config['ValidateTemplate'],
+                             check_template=not config['NoTemplateCheck'],
+                             canary_size=config['CanarySize'],
+                             wave_growth=config['WaveGrowth'],
+                             failure_threshold=config.get('FailureThreshold')
+                                     )
+
+    # Keep stdout to the progress events when they are streamed there
+    output = sys.stderr if config.get('ProgressFile') == '-' else sys.stdout
+    if config['Plan']:
+        plan = aws_provisioner.plan_accounts()
+        plan.save(config['PlanFile'])
+        print(plan, file=output)
+        return plan
+
+    if config['Apply']:
+        summary = aws_provisioner.apply_plan(
+            Plan.load(config['PlanFile']),
+            confirm=not config['NoConfirm']
+        )
+    else:
+        summary = aws_provisioner.provision_accounts(
+            confirm=not config['NoConfirm']
+        )
+    print(summary, file=output)
+    return summary
+
+
+def configure_logging(log_level):
+    """Sends the log records of the lib package to the console."""
+    lib_logger = logging.getLogger('lib')
+    lib_logger.setLevel(LOG_LEVELS[log_level.lower()])
+    if not lib_logger.handlers:
+        console_handler = logging.StreamHandler()
+        console_handler.addFilter(ContextFilter())
+        console_handler.setFormatter(
+            logging.Formatter('%(context)s%(message)s')
+        )
+        lib_logger.addHandler(console_handler)
+
+
+def main(argv=None):
+    """Runs the provisioner and returns its exit status.
+
+    The config is read and validated before anything is imported from boto3
+    or any AWS session is set up. Invalid args or config exit with status 2
+    like argparse errors.
+
+    Args:
+        argv:   List of command line arguments. Defaults to sys.argv[1:].
+
+    """
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.LogLevel.lower() not in LOG_LEVELS:
+        parser.error("--log-level must be one of {}".format(
+            ', '.join(LOG_LEVELS)
+        ))
+    configure_logging(args.LogLevel)
+
+    try:
+        provision_config = build_config(load_config_file(args.ConfigFile),
+                                        vars(args))
+    except ValueError as e:
+        parser.error(str(e))
+
+    progress_file = None
+    if provision_config.get('ProgressFile') == '-':
+        progress_file = sys.stdout
+    elif provision_config.get('ProgressFile'):
+        progress_file = open(provision_config['ProgressFile'], 'w')
+    progress.start(
+        stream=progress_file,
+        summary_stream=(sys.stderr if provision_config['ProgressSummary']
+                        else None)
+    )
+    try:
+        # Either a ProvisionSummary or a Plan, both list their failures
+        provision_summary = provision_accounts(provision_config)
+    finally:
+        progress.stop()
+        if progress_file and progress_file is not sys.stdout:
+            progress_file.close()
+    logger.info(metrics)
+    if provision_config.get('MetricsFile'):
+        metrics.write(provision_config['MetricsFile'])
+    return 1 if provision_summary.failed else 0
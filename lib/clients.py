@@ -0,0 +1,150 @@
+import copy
+import logging
+import threading
+
+import boto3
+import botocore.hooks
+import botocore.loaders
+import botocore.session
+from botocore.config import Config
+
+from lib.metrics import metrics
+from lib.profiles import SharedConfig
+
+logger = logging.getLogger(__name__)
+
+# botocore's default, used when no concurrency is configured
+DEFAULT_MAX_POOL_CONNECTIONS = 10
+
+
+class ClientPool:
+    """Creates and reuses boto3 sessions and clients.
+
+    Sessions are cached per profile and clients per profile, service and
+    region, until release() drops those of a profile. All sessions share
+    one botocore loader, so service models and endpoint data are read from
+    disk once per run instead of once per session, and one SharedConfig,
+    so the AWS config and credentials files are parsed once as well. The builtin botocore event handlers are
+    registered once and copied into each session, which is most of the cost
+    of creating one. Every session is instrumented with the shared Metrics
+    and, if given, the RateLimiter.
+
+    Args:
+        max_pool_connections:   HTTP connections kept open by each client,
+                                should be at least the number of threads
+                                using a client at the same time.
+        rate_limiter:           RateLimiter applied to every session.
+        client_config:          botocore Config merged into the config of
+                                every client, i.e. for retries.
+        shared_config:          SharedConfig the profiles are read from.
+
+    """
+
+    def __init__(self, max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS,
+                 rate_limiter=None, client_config=None, shared_config=None):
+        self._client_config = Config(
+            max_pool_connections=max(max_pool_connections,
+                                     DEFAULT_MAX_POOL_CONNECTIONS)
+        )
+        if client_config:
+            self._client_config = self._client_config.merge(client_config)
+        self._clients = {}
+        self._event_hooks = None
+        self._loader = botocore.loaders.create_loader()
+        self._lock = threading.RLock()
+        self._rate_limiter = rate_limiter
+        self._sessions = {}
+        self._shared_config = shared_config or SharedConfig()
+
+    def client(self, service_name, profile_name=None, region_name=None):
+        """Returns the client of a service for a profile and region.
+
+        The default credentials and region are used when profile_name or
+        region_name are not provided.
+        """
+        key = (service_name, region_name)
+        with self._lock:
+            # Sessions are not thread safe, so clients are created under
+            # the lock. Clients are thread safe once created.
+            clients = self._clients.setdefault(profile_name, {})
+            if key not in clients:
+                logger.debug("Creating {} client for profile {} in "
+                             "{}".format(service_name,
+                                         profile_name or 'default',
+                                         region_name or 'default region'))
+                clients[key] = self.session(profile_name).client(
+                    service_name, region_name=region_name
+                )
+            return clients[key]
+
+    def release(self, profile_name):
+        """Drops the session and clients of a profile and closes the HTTP
+        connections of its clients."""
+        with self._lock:
+            self._sessions.pop(profile_name, None)
+            clients = self._clients.pop(profile_name, {})
+        for client in clients.values():
+            # Clients of older botocore versions can not be closed
+            if hasattr(client, 'close'):
+                client.close()
+
+    def session(self, profile_name=None, account=None,
+                credential_provider=None):
+        """Returns the boto3 session of a profile.
+
+        Args:
+            profile_name:   Name of the profile, the default credentials are
+                            used when not provided.
+            account:        Account calls of the session are attributed to
+                            in the metrics, either a string or a function
+                            returning a string. Defaults to profile_name.
+            credential_provider: botocore CredentialProvider tried before
+                            any other. When provided, profile_name is only
+                            the name the session is cached under and is not
+                            read from the AWS config files.
+
+        """
+        with self._lock:
+            if profile_name not in self._sessions:
+                self._sessions[profile_name] = self.__create_session(
+                    profile_name, account or profile_name, credential_provider
+                )
+            return self._sessions[profile_name]
+
+    def __create_session(self, profile_name, account, credential_provider):
+        if self._event_hooks is None:
+            # Registered on first use rather than in __init__, so handlers
+            # added to botocore's BUILTIN_HANDLERS after import, i.e. by
+            # moto, are included
+            self._event_hooks = botocore.hooks.HierarchicalEmitter()
+            botocore.session.Session(event_hooks=self._event_hooks)
+        botocore_session = botocore.session.Session(
+            profile=None if credential_provider else profile_name,
+            event_hooks=copy.copy(self._event_hooks),
+            include_builtin_handlers=False
+        )
+        self._shared_config.apply(botocore_session)
+        if credential_provider:
+            botocore_session.get_component(
+                'credential_provider'
+            ).insert_before('env', credential_provider)
+        botocore_session.register_component('data_loader', self._loader)
+        botocore_session.set_default_client_config(self._client_config)
+        session = boto3.session.Session(botocore_session=botocore_session)
+        # boto3 appends its data path to the loader of every session it
+        # wraps, which is only needed once for a shared loader
+        search_paths = self._loader.search_paths
+        if search_paths.count(search_paths[-1]) > 1:
+            search_paths.pop()
+        metrics.instrument(session, account=account)
+        if self._rate_limiter:
+            self._rate_limiter.instrument(session)
+        return session
+
+    @property
+    def shared_config(self):
+        return self._shared_config
+
+
+# Used by objects that are not given a client or pool
+client_pool = ClientPool()
@@ -0,0 +1,92 @@
+import datetime
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Outcomes that mean a stack does not need to be provisioned again
+COMPLETED_STATUSES = ('created', 'updated', 'unchanged')
+
+
+class RunJournal:
+    """Append-only JSONL journal of the outcome of each provisioned stack.
+
+    Every account, region and stack outcome is appended as one line along
+    with the template and parameters hexdigest it was provisioned with. The
+    journal is read back on start up so a later run can skip stacks that
+    were already provisioned with the same inputs.
+
+    Args:
+        path:   Path to the journal file, it is created if needed.
+
+    """
+
+    def __init__(self, path):
+        self._path = os.path.expanduser(path)
+        self._lock = threading.Lock()
+        self._latest = self.__load()
+
+    def is_completed(self, account_id, region, stack_name,
+                     template_hexdigest, parameters_hexdigest):
+        """Returns True if the latest outcome for the stack was successful
+        and used the same template and parameters."""
+        with self._lock:
+            entry = self._latest.get((account_id, region, stack_name))
+        return bool(entry
+                    and entry['status'] in COMPLETED_STATUSES
+                    and entry['template_hexdigest'] == template_hexdigest
+                    and entry['parameters_hexdigest'] == parameters_hexdigest)
+
+    @property
+    def path(self):
+        return self._path
+
+    def record(self, account_id, region, stack_name, template_hexdigest,
+               parameters_hexdigest, status, profile_name=None, error=None):
+        """Appends the outcome of provisioning a stack to the journal."""
+        entry = {
+            'account_id': account_id,
+            'error': str(error) if error else None,
+            'parameters_hexdigest': parameters_hexdigest,
+            'profile_name': profile_name,
+            'region': region,
+            'stack_name': stack_name,
+            'status': status,
+            'template_hexdigest': template_hexdigest,
+            'timestamp': datetime.datetime.now(
+                datetime.timezone.utc).isoformat()
+        }
+        line = json.dumps(entry, sort_keys=True)
+        with self._lock:
+            directory = os.path.dirname(self._path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self._path, 'a') as journal_file:
+                journal_file.write(line + '\n')
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+            self._latest[(account_id, region, stack_name)] = entry
+
+    def __load(self):
+        """Returns a dict of (account_id, region, stack_name) to the latest
+        entry in the journal."""
+        latest = {}
+        if not os.path.exists(self._path):
+            return latest
+        with open(self._path) as journal_file:
+            for line_number, line in enumerate(journal_file, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Likely a partial line written when a run was killed
+                    logger.warning("Skipping invalid journal line {} in "
+                                   "{}".format(line_number, self._path))
+                    continue
+                key = (entry['account_id'], entry['region'],
+                       entry['stack_name'])
+                latest[key] = entry
+        return latest
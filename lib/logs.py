@@ -0,0 +1,39 @@
+from contextlib import contextmanager
+import contextvars
+import logging
+
+# A context variable rather than a thread local, so the label follows
+# coroutines and the calls they make with asyncio.to_thread
+_label = contextvars.ContextVar('log_context', default=None)
+
+
+@contextmanager
+def log_context(label):
+    """Tags every log record emitted by the current thread or task with a
+    label.
+
+    Used to keep log output attributable to an account when several
+    accounts are provisioned at the same time.
+
+    Args:
+        label:  String prepended to log messages, i.e. an account id.
+
+    """
+    token = _label.set(label)
+    try:
+        yield
+    finally:
+        _label.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    """Adds the current log context to records as the `context` attribute.
+
+    The attribute is an empty string when no context is set so that it can
+    always be used in a format string, i.e. '%(context)s%(message)s'.
+    """
+
+    def filter(self, record):
+        label = _label.get()
+        record.context = "[{}] ".format(label) if label else ''
+        return True
@@ -0,0 +1,189 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Key of a parameter value that refers to the output of another stack,
+# i.e. {'StackOutput': 'BctTools.RoleArn'}
+OUTPUT_REFERENCE_KEY = 'StackOutput'
+
+
+def output_references(parameters):
+    """Returns a dict of parameter name to (stack name, output key) for the
+    parameters that refer to the output of another stack."""
+    references = {}
+    for key, value in (parameters or {}).items():
+        if type(value) is dict and OUTPUT_REFERENCE_KEY in value:
+            stack_name, _, output_key = value[OUTPUT_REFERENCE_KEY].partition(
+                '.')
+            if not stack_name or not output_key:
+                raise ValueError(
+                    "{} of parameter {} must be in the form "
+                    "StackName.OutputKey".format(OUTPUT_REFERENCE_KEY, key)
+                )
+            references[key] = (stack_name, output_key)
+    return references
+
+
+def resolve_parameters(parameters, outputs):
+    """Returns the parameters with output references replaced by values.
+
+    Args:
+        parameters: A dict of CFN parameters.
+        outputs:    A dict of stack name to a dict of its outputs.
+
+    """
+    resolved = dict(parameters or {})
+    for key, (stack_name, output_key) in output_references(
+            parameters).items():
+        stack_outputs = outputs.get(stack_name, {})
+        if output_key not in stack_outputs:
+            raise ValueError(
+                "Stack {} has no output {} for parameter {}".format(
+                    stack_name, output_key, key)
+            )
+        resolved[key] = stack_outputs[output_key]
+    return resolved
+
+
+class StackSpec:
+    """A stack of a manifest.
+
+    Args:
+        name:           Name of the CFN stack.
+        template_path:  Path to the template, either in file:// or s3://
+                        format.
+        parameters:     A dict of CFN parameters. Values can refer to an
+                        output of another stack with
+                        {'StackOutput': 'StackName.OutputKey'}.
+        depends_on:     A list of names of stacks that have to be
+                        provisioned first. Stacks that are referred to by
+                        parameters are added automatically.
+
+    """
+
+    def __init__(self, name, template_path, parameters=None,
+                 depends_on=None):
+        self._name = name
+        self._parameters = dict(parameters or {})
+        self._template_path = template_path
+        depends_on = list(depends_on or [])
+        for stack_name, _ in output_references(self._parameters).values():
+            if stack_name not in depends_on:
+                depends_on.append(stack_name)
+        self._depends_on = depends_on
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def depends_on(self):
+        return list(self._depends_on)
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def parameters(self):
+        return dict(self._parameters)
+
+    @property
+    def template_path(self):
+        return self._template_path
+
+
+class Manifest:
+    """Stacks that are provisioned together, ordered by their dependencies.
+
+    Args:
+        stacks:     A list of StackSpec objects.
+
+    Raises ValueError when stack names are not unique, a stack depends on a
+    stack that is not in the manifest or the dependencies form a cycle.
+    """
+
+    def __init__(self, stacks):
+        self._stacks = list(stacks)
+        if not self._stacks:
+            raise ValueError("A manifest needs at least one stack")
+        names = [spec.name for spec in self._stacks]
+        duplicates = sorted({name for name in names if names.count(name) > 1})
+        if duplicates:
+            raise ValueError("Duplicate stacks in manifest: {}".format(
+                ', '.join(duplicates)
+            ))
+        for spec in self._stacks:
+            unknown = [name for name in spec.depends_on if name not in names]
+            if unknown:
+                raise ValueError(
+                    "Stack {} depends on stacks not in the manifest: "
+                    "{}".format(spec.name, ', '.join(unknown))
+                )
+        self._order = self.__sort()
+
+    def __iter__(self):
+        return iter(self._order)
+
+    def __len__(self):
+        return len(self._stacks)
+
+    @classmethod
+    def from_config(cls, stacks_config, default_parameters=None):
+        """Builds a manifest from the Stacks list of a config file.
+
+        Each entry has a CfnStackName, a CfnTemplateUrl, optional CfnParams,
+        which override default_parameters, and an optional DependsOn list.
+        """
+        stacks = []
+        for entry in stacks_config:
+            if not entry.get('CfnStackName') or not entry.get(
+                    'CfnTemplateUrl'):
+                raise ValueError(
+                    "Each stack needs a CfnStackName and a CfnTemplateUrl"
+                )
+            parameters = dict(default_parameters or {})
+            parameters.update(entry.get('CfnParams') or {})
+            depends_on = entry.get('DependsOn') or []
+            stacks.append(StackSpec(
+                entry['CfnStackName'],
+                entry['CfnTemplateUrl'],
+                parameters=parameters,
+                depends_on=([depends_on] if type(depends_on) is str
+                            else depends_on)
+            ))
+        return cls(stacks)
+
+    def dependents(self, stack_name):
+        """Returns the names of the stacks that depend on a stack."""
+        return [spec.name for spec in self._order
+                if stack_name in spec.depends_on]
+
+    def get(self, stack_name):
+        for spec in self._stacks:
+            if spec.name == stack_name:
+                return spec
+        return None
+
+    @property
+    def stacks(self):
+        """Returns the StackSpec objects, dependencies first."""
+        return list(self._order)
+
+    def __sort(self):
+        """Returns the stacks in dependency order, keeping the manifest order
+        between stacks that do not depend on each other."""
+        order = []
+        done = set()
+        remaining = list(self._stacks)
+        while remaining:
+            ready = [spec for spec in remaining
+                     if all(name in done for name in spec.depends_on)]
+            if not ready:
+                raise ValueError(
+                    "Dependency cycle between stacks: {}".format(
+                        ', '.join(spec.name for spec in remaining))
+                )
+            order.append(ready[0])
+            done.add(ready[0].name)
+            remaining.remove(ready[0])
+        return order
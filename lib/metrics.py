@@ -0,0 +1,223 @@
+from collections import Counter
+from contextlib import contextmanager
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Error codes AWS uses when a call is throttled
+THROTTLING_CODES = (
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottledException',
+    'TooManyRequestsException',
+    'RequestLimitExceeded',
+    'SlowDown'
+)
+
+
+class Metrics:
+    """Counts AWS API calls and times the phases of a run.
+
+    Calls are counted by hooking the botocore event system of each boto3
+    session or client passed to instrument(), and are broken down by
+    account, service and operation. Phases are timed with phase(); when a
+    phase runs in several threads at once its time is the sum of all of
+    them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def __str__(self):
+        calls, phases, retries, seconds, throttles = self.__copy()
+        lines = ["{:<16} {:<16} {:<32} {:>7} {:>7} {:>9} {:>9}".format(
+            'ACCOUNT', 'SERVICE', 'OPERATION', 'CALLS', 'RETRIES',
+            'THROTTLES', 'SECONDS'
+        )]
+        for key in sorted(calls):
+            lines.append(
+                "{:<16} {:<16} {:<32} {:>7} {:>7} {:>9} {:>9.2f}".format(
+                    key[0], key[1], key[2],
+                    calls[key],
+                    retries[key],
+                    throttles[key],
+                    seconds[key]
+                )
+            )
+        lines.append('')
+        lines.append("{:<32} {:>9}".format('PHASE', 'SECONDS'))
+        for phase in sorted(phases):
+            lines.append("{:<32} {:>9.2f}".format(phase, phases[phase]))
+        return '\n'.join(lines)
+
+    def __copy(self):
+        """Returns copies of the counters so they can be read safely."""
+        with self._lock:
+            return (Counter(self._calls),
+                    Counter(self._phases),
+                    Counter(self._retries),
+                    Counter(self._seconds),
+                    Counter(self._throttles))
+
+    def instrument(self, target, account=None):
+        """Registers handlers on a boto3 session or client.
+
+        Clients created from an instrumented session are instrumented as
+        well.
+
+        Args:
+            target:     A boto3 session or client.
+            account:    Account the calls are attributed to. Either a string
+                        or a function returning a string, which is useful
+                        when the account id is not known yet.
+
+        """
+        events = (target.meta.events if hasattr(target, 'meta')
+                  else target.events)
+
+        def label():
+            value = account() if callable(account) else account
+            return value or '-'
+
+        def before_call(context, **kwargs):
+            context['metrics_start'] = time.monotonic()
+
+        def after_call(event_name, parsed, context, **kwargs):
+            _, service, operation = event_name.split('.', 2)
+            seconds = time.monotonic() - context.get('metrics_start',
+                                                     time.monotonic())
+            metadata = parsed.get('ResponseMetadata', {})
+            self.record_call(label(), service, operation,
+                             seconds=seconds,
+                             retries=metadata.get('RetryAttempts', 0))
+
+        def needs_retry(event_name, response, **kwargs):
+            if not response:
+                return None
+            error_code = response[1].get('Error', {}).get('Code')
+            if error_code in THROTTLING_CODES:
+                _, service, operation = event_name.split('.', 2)
+                self.record_throttle(label(), service, operation)
+            return None
+
+        events.register('before-call', before_call)
+        events.register('after-call', after_call)
+        events.register('needs-retry', needs_retry)
+        return target
+
+    @contextmanager
+    def phase(self, name):
+        """Adds the time spent in the with block to the named phase."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._phases[name] += time.monotonic() - start
+
+    @property
+    def calls(self):
+        """Returns a dict of (account, service, operation) to calls made."""
+        return dict(self.__copy()[0])
+
+    @property
+    def phases(self):
+        """Returns a dict of phase name to seconds."""
+        return dict(self.__copy()[1])
+
+    @property
+    def throttles(self):
+        """Returns a dict of (account, service, operation) to throttled
+        attempts."""
+        return dict(self.__copy()[4])
+
+    def record_call(self, account, service, operation, seconds=0.0,
+                    retries=0):
+        key = (account, service, operation)
+        with self._lock:
+            self._calls[key] += 1
+            self._retries[key] += retries
+            self._seconds[key] += seconds
+
+    def record_throttle(self, account, service, operation):
+        with self._lock:
+            self._throttles[(account, service, operation)] += 1
+
+    def reset(self):
+        with self._lock:
+            self._calls = Counter()
+            self._phases = Counter()
+            self._retries = Counter()
+            self._seconds = Counter()
+            self._throttles = Counter()
+
+    def to_dict(self):
+        calls, phases, retries, seconds, throttles = self.__copy()
+        return {
+            'calls': [
+                {
+                    'account': key[0],
+                    'service': key[1],
+                    'operation': key[2],
+                    'calls': calls[key],
+                    'retries': retries[key],
+                    'throttles': throttles[key],
+                    'seconds': round(seconds[key], 3)
+                }
+                for key in sorted(calls)
+            ],
+            'phases': {phase: round(phase_seconds, 3)
+                       for phase, phase_seconds in sorted(phases.items())}
+        }
+
+    def to_prometheus(self):
+        """Returns the metrics in the Prometheus text exposition format."""
+        calls, phases, retries, seconds, throttles = self.__copy()
+        lines = []
+        series = (
+            ('api_calls_total', 'AWS API calls made', calls),
+            ('api_retries_total', 'AWS API call retries', retries),
+            ('api_throttles_total', 'Throttled AWS API calls', throttles),
+            ('api_call_seconds_total', 'Seconds spent in AWS API calls',
+             seconds)
+        )
+        for name, description, counter in series:
+            lines.append("# HELP bct_provisioner_{} {}".format(name,
+                                                               description))
+            lines.append("# TYPE bct_provisioner_{} counter".format(name))
+            for key in sorted(calls):
+                lines.append(
+                    'bct_provisioner_{}{{account="{}",service="{}",'
+                    'operation="{}"}} {}'.format(name, key[0], key[1], key[2],
+                                                 counter[key])
+                )
+        lines.append("# HELP bct_provisioner_phase_seconds Seconds spent in "
+                     "each phase of the run")
+        lines.append("# TYPE bct_provisioner_phase_seconds gauge")
+        for phase in sorted(phases):
+            lines.append('bct_provisioner_phase_seconds{{phase="{}"}} '
+                         '{}'.format(phase, phases[phase]))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Writes the metrics to a file.
+
+        Files ending in .prom are written in the Prometheus text exposition
+        format, used by the node exporter textfile collector, all others
+        as JSON.
+        """
+        with open(path, 'w') as metrics_file:
+            if path.endswith('.prom'):
+                metrics_file.write(self.to_prometheus())
+            else:
+                json.dump(self.to_dict(), metrics_file, indent=2)
+        logger.info("Metrics written to {}".format(path))
+
+
+# Shared by all sessions and clients created by the provisioner
+metrics = Metrics()
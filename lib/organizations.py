@@ -0,0 +1,232 @@
+import asyncio
+import logging
+
+from botocore.credentials import (AssumeRoleCredentialFetcher,
+                                  CredentialProvider,
+                                  DeferredRefreshableCredentials)
+
+from lib import aio
+from lib.accounts import AwsAccount, AwsAccounts
+from lib.clients import client_pool as default_client_pool
+from lib.progress import progress
+
+logger = logging.getLogger(__name__)
+
+# Role created by Organizations in every account it creates
+DEFAULT_ROLE_NAME = 'OrganizationAccountAccessRole'
+
+ROLE_SESSION_NAME = 'bct-account-provisioner'
+
+
+class AssumeRoleProvider(CredentialProvider):
+    """botocore CredentialProvider that assumes a role in another account.
+
+    The credentials are fetched on first use and refreshed before they
+    expire. Fetched credentials are stored in the cache, so sessions that
+    assume the same role share them.
+
+    Args:
+        client_creator: Callable that returns the STS client used to assume
+                        the role, with the arguments of
+                        botocore's Session.create_client.
+        source_credentials: botocore Credentials the role is assumed with.
+        role_arn:       ARN of the role to assume.
+        cache:          dict like object the credentials are cached in.
+
+    """
+
+    METHOD = 'bct-assume-role'
+
+    def __init__(self, client_creator, source_credentials, role_arn,
+                 cache=None):
+        super().__init__()
+        self._fetcher = AssumeRoleCredentialFetcher(
+            client_creator,
+            source_credentials,
+            role_arn,
+            extra_args={'RoleSessionName': ROLE_SESSION_NAME},
+            cache=cache
+        )
+
+    def load(self):
+        return DeferredRefreshableCredentials(
+            refresh_using=self._fetcher.fetch_credentials,
+            method=self.METHOD
+        )
+
+
+class OrganizationAccounts(AwsAccounts):
+    """Provides the accounts of an AWS Organization as AwsAccount objects.
+
+    Accounts are listed from Organizations with the management profile,
+    filtered, and then accessed by assuming a role in each of them. Roles
+    are assumed concurrently while the accounts are discovered, so accounts
+    that can not be accessed are left out before provisioning starts.
+
+    Args:
+        management_profile: Profile of the management account, or of an
+                            account that is a delegated administrator.
+        role_name:          Name of the role assumed in each account.
+                            Defaults to OrganizationAccountAccessRole.
+        include:            A list or regex of account names or ids that
+                            should be provisioned.
+        exclude:            A list or regex of account names or ids that
+                            should not be provisioned. Exclude is processed
+                            before includes.
+        organizational_units: A list of OU ids. Only accounts in these OUs,
+                            or OUs nested in them, are provisioned.
+        tags:               A dict of tag keys and values an account must
+                            have to be provisioned.
+        max_workers:        Number of roles assumed at the same time.
+        client_pool:        ClientPool shared by all accounts.
+
+    """
+
+    def __init__(self, management_profile, role_name=DEFAULT_ROLE_NAME,
+                 include=None, exclude=None, organizational_units=None,
+                 tags=None, max_workers=1, client_pool=None):
+        super().__init__(include=include,
+                         exclude=exclude,
+                         max_workers=max_workers,
+                         client_pool=client_pool)
+        self._client_pool = client_pool or default_client_pool
+        self._credential_cache = {}
+        self._management_profile = management_profile
+        self._organizational_units = ([organizational_units]
+                                      if type(organizational_units) is str
+                                      else organizational_units)
+        self._role_name = role_name
+        self._source_credentials = None
+        self._tags = tags
+
+    async def _discover_async(self):
+        organizations = await asyncio.to_thread(
+            self._client_pool.client,
+            'organizations',
+            profile_name=self._management_profile
+        )
+        accounts = await asyncio.to_thread(self.__active_accounts,
+                                           organizations)
+        logger.info("Found {} active accounts in the organization".format(
+            len(accounts)
+        ))
+
+        ou_account_ids = (await asyncio.to_thread(self.__ou_account_ids,
+                                                  organizations)
+                          if self._organizational_units else None)
+        target_accounts = []
+        for account in accounts:
+            label = "{} ({})".format(account['Id'], account['Name'])
+            if (self._exclude
+                    and self.__match_account(account, self._exclude)):
+                logger.info("Excluding account {}".format(label))
+            elif (self._include
+                    and not self.__match_account(account, self._include)):
+                continue
+            elif (ou_account_ids is not None
+                    and account['Id'] not in ou_account_ids):
+                logger.debug("Account {} is not in the organizational "
+                             "units".format(label))
+            else:
+                target_accounts.append(account)
+
+        self._source_credentials = await asyncio.to_thread(
+            lambda: self._client_pool.session(
+                self._management_profile
+            ).get_credentials()
+        )
+        async for (index, _), aws_account in aio.iter_blocking(
+                lambda item: self.__resolve(organizations, item[1]),
+                enumerate(target_accounts),
+                self._max_workers):
+            if aws_account:
+                yield index, aws_account
+
+    @staticmethod
+    def __active_accounts(organizations):
+        paginator = organizations.get_paginator('list_accounts')
+        return [account
+                for page in paginator.paginate()
+                for account in page['Accounts']
+                if account['Status'] == 'ACTIVE']
+
+    def __assume_role_provider(self, account):
+        # Partition of the account, i.e. aws or aws-us-gov
+        partition = account['Arn'].split(':')[1]
+        role_arn = "arn:{}:iam::{}:role/{}".format(partition,
+                                                   account['Id'],
+                                                   self._role_name)
+        return AssumeRoleProvider(self.__sts_client,
+                                  self._source_credentials,
+                                  role_arn,
+                                  cache=self._credential_cache)
+
+    def __has_tags(self, organizations, account_id):
+        paginator = organizations.get_paginator('list_tags_for_resource')
+        tags = {tag['Key']: tag['Value']
+                for page in paginator.paginate(ResourceId=account_id)
+                for tag in page['Tags']}
+        return all(tags.get(key) == str(value)
+                   for key, value in self._tags.items())
+
+    def __match_account(self, account, criteria):
+        return (self._match(account['Name'], criteria)
+                or self._match(account['Id'], criteria))
+
+    def __ou_account_ids(self, organizations):
+        """Returns the set of account ids in the organizational units and
+        the OUs nested in them."""
+        account_ids = set()
+        parent_ids = list(self._organizational_units)
+        while parent_ids:
+            parent_id = parent_ids.pop()
+            for page in organizations.get_paginator(
+                    'list_accounts_for_parent').paginate(ParentId=parent_id):
+                account_ids.update(account['Id']
+                                   for account in page['Accounts'])
+            for page in organizations.get_paginator(
+                    'list_organizational_units_for_parent').paginate(
+                        ParentId=parent_id):
+                parent_ids.extend(ou['Id']
+                                  for ou in page['OrganizationalUnits'])
+        return account_ids
+
+    def __resolve(self, organizations, account):
+        """Returns an AwsAccount using the assumed role, or None if the
+        account is filtered out by its tags or the role can not be
+        assumed."""
+        label = "{} ({})".format(account['Id'], account['Name'])
+        # Keys the account's session and clients in the ClientPool, so it
+        # is the unique account id rather than the account name
+        profile_name = "{}/{}".format(account['Id'], self._role_name)
+        progress.emit('discovering', account_id=account['Id'],
+                      profile_name=profile_name)
+        try:
+            if self._tags and not self.__has_tags(organizations,
+                                                  account['Id']):
+                logger.debug("Account {} does not have the tags".format(
+                    label
+                ))
+                return None
+            aws_account = AwsAccount(
+                profile_name,
+                account_id=account['Id'],
+                client_pool=self._client_pool,
+                credential_provider=self.__assume_role_provider(account)
+            )
+            # Assume the role now so inaccessible accounts are found early
+            aws_account.session.get_credentials().get_frozen_credentials()
+        except Exception as e:
+            logger.error("Excluding account {}, unable to access it with "
+                         "role {}: {}".format(label, self._role_name, e))
+            return None
+        logger.info("Including account {}".format(label))
+        return aws_account
+
+    def __sts_client(self, service_name, **kwargs):
+        """Returns the management profile's STS client for
+        AssumeRoleCredentialFetcher, which would otherwise create a client
+        for every role it assumes."""
+        return self._client_pool.client(
+            service_name, profile_name=self._management_profile
+        )
@@ -0,0 +1,163 @@
+import json
+import logging
+
+from lib.stacks import ChangeSet
+
+logger = logging.getLogger(__name__)
+
+
+class PlannedChange:
+    """Planned change to the stack in a single account and region.
+
+    Args:
+        account_id:     Id of the account.
+        profile_name:   Name of the profile used for the account.
+        region:         AWS region the stack is in.
+        action:         'create', 'update', 'none' or 'failed'.
+        change_set:     ChangeSet that makes the change, if any.
+        error:          Message of the error raised while planning, if any.
+
+    """
+
+    def __init__(self, account_id, profile_name, region, action,
+                 change_set=None, error=None):
+        self._account_id = account_id
+        self._action = action
+        self._change_set = change_set
+        self._error = error
+        self._profile_name = profile_name
+        self._region = region
+
+    def __str__(self):
+        line = "{} ({}) {} {}".format(self.account_id,
+                                      self.profile_name,
+                                      self.region,
+                                      self.action)
+        if self.change_set:
+            line = "{}: {}".format(line, self.change_set)
+        if self.error:
+            line = "{}: {}".format(line, self.error)
+        return line
+
+    @property
+    def account_id(self):
+        return self._account_id
+
+    @property
+    def action(self):
+        return self._action
+
+    @property
+    def change_set(self):
+        return self._change_set
+
+    @property
+    def error(self):
+        return self._error
+
+    @property
+    def failed(self):
+        return self._action == 'failed'
+
+    @classmethod
+    def from_dict(cls, change):
+        change_set = (ChangeSet.from_dict(change['change_set'])
+                      if change.get('change_set') else None)
+        return cls(change['account_id'],
+                   change['profile_name'],
+                   change['region'],
+                   change['action'],
+                   change_set=change_set,
+                   error=change.get('error'))
+
+    @property
+    def profile_name(self):
+        return self._profile_name
+
+    @property
+    def region(self):
+        return self._region
+
+    def to_dict(self):
+        return {
+                'account_id': self.account_id,
+                'action': self.action,
+                'change_set': (self.change_set.to_dict()
+                               if self.change_set else None),
+                'error': self.error,
+                'profile_name': self.profile_name,
+                'region': self.region
+        }
+
+
+class Plan:
+    """Changes that applying a template would make across accounts.
+
+    Plans are saved to a JSON file so that the change sets can be executed
+    by a later run.
+
+    Args:
+        stack_name:         Name of the CFN stack.
+        template_hexdigest: sha1 hexdigest of the planned template.
+        changes:            A list of PlannedChange objects.
+
+    """
+
+    def __init__(self, stack_name, template_hexdigest, changes=None):
+        self._changes = list(changes) if changes else []
+        self._stack_name = stack_name
+        self._template_hexdigest = template_hexdigest
+
+    def __str__(self):
+        counts = {}
+        for change in self._changes:
+            counts[change.action] = counts.get(change.action, 0) + 1
+        lines = [
+            "Plan for CFN stack {}: {} create, {} update, {} no-op, "
+            "{} failed".format(self.stack_name,
+                               counts.get('create', 0),
+                               counts.get('update', 0),
+                               counts.get('none', 0),
+                               counts.get('failed', 0))
+        ]
+        lines.extend("  {}".format(change) for change in self._changes)
+        return '\n'.join(lines)
+
+    @property
+    def changes(self):
+        return list(self._changes)
+
+    @property
+    def failed(self):
+        return [change for change in self._changes if change.failed]
+
+    @classmethod
+    def load(cls, path):
+        """Reads a plan saved with save()."""
+        with open(path) as plan_file:
+            plan = json.load(plan_file)
+        return cls(plan['stack_name'],
+                   plan['template_hexdigest'],
+                   [PlannedChange.from_dict(change)
+                    for change in plan['changes']])
+
+    def save(self, path):
+        """Writes the plan to a JSON file."""
+        with open(path, 'w') as plan_file:
+            json.dump(self.to_dict(), plan_file, indent=2, sort_keys=True)
+        logger.info("Plan saved to {}".format(path))
+
+    @property
+    def stack_name(self):
+        return self._stack_name
+
+    @property
+    def template_hexdigest(self):
+        return self._template_hexdigest
+
+    def to_dict(self):
+        return {
+                'changes': [change.to_dict() for change in self._changes],
+                'stack_name': self.stack_name,
+                'template_hexdigest': self.template_hexdigest
+        }
@@ -0,0 +1,109 @@
+from hashlib import sha1
+import json
+import logging
+import os
+import threading
+
+import botocore.configloader
+from botocore.credentials import SharedCredentialProvider
+from botocore.exceptions import ConfigNotFound
+
+logger = logging.getLogger(__name__)
+
+
+class SharedConfig:
+    """The AWS shared config and credentials files, parsed once.
+
+    botocore parses both files whenever a session is created and again when
+    the session loads its credentials, so with a file of thousands of
+    profiles creating a session per profile takes time quadratic in the
+    number of profiles. Sessions set up with apply() use the files parsed
+    here instead. The files are parsed when first needed.
+
+    Args:
+        config_file:        Path to the config file. Defaults to the
+                            AWS_CONFIG_FILE env var or ~/.aws/config.
+        credentials_file:   Path to the credentials file. Defaults to the
+                            AWS_SHARED_CREDENTIALS_FILE env var or
+                            ~/.aws/credentials.
+
+    """
+
+    def __init__(self, config_file=None, credentials_file=None):
+        self._config_file = config_file
+        self._credentials_file = credentials_file
+        self._lock = threading.Lock()
+        self._parsed = None
+
+    def apply(self, botocore_session):
+        """Makes a botocore session read its profiles from this object."""
+        _, credentials, full_config = self.__parse()
+        # botocore has no public way to provide the parsed files, the
+        # session only parses them when _config is None
+        botocore_session._config = full_config
+        resolver = botocore_session.get_component('credential_provider')
+        for index, provider in enumerate(resolver.providers):
+            if provider.METHOD == SharedCredentialProvider.METHOD:
+                resolver.providers[index] = SharedCredentialProvider(
+                    self.credentials_file,
+                    botocore_session.profile,
+                    ini_parser=lambda path: credentials
+                )
+        return botocore_session
+
+    @property
+    def config_file(self):
+        return os.path.expanduser(self._config_file or os.environ.get(
+            'AWS_CONFIG_FILE', '~/.aws/config'))
+
+    @property
+    def credentials_file(self):
+        return os.path.expanduser(self._credentials_file or os.environ.get(
+            'AWS_SHARED_CREDENTIALS_FILE', '~/.aws/credentials'))
+
+    def fingerprint(self, profile):
+        """Returns a hash of the profile's entries in both files."""
+        config, credentials, _ = self.__parse()
+        entries = {
+            'credentials': credentials.get(profile, {}),
+            'config': config['profiles'].get(profile, {})
+        }
+        return sha1(json.dumps(entries, sort_keys=True).encode()).hexdigest()
+
+    @property
+    def profiles(self):
+        """Returns the names of the profiles in either file, config file
+        profiles first, like boto3's available_profiles."""
+        return list(self.__parse()[2]['profiles'])
+
+    def __parse(self):
+        """Returns the parsed config file, the parsed credentials file and
+        both merged the way botocore merges them."""
+        with self._lock:
+            if self._parsed is None:
+                try:
+                    config = botocore.configloader.load_config(
+                        self.config_file
+                    )
+                except ConfigNotFound:
+                    config = {'profiles': {}}
+                try:
+                    credentials = botocore.configloader.raw_config_parse(
+                        self.credentials_file
+                    )
+                except ConfigNotFound:
+                    credentials = {}
+                full_config = dict(config)
+                full_config['profiles'] = {
+                    name: dict(values)
+                    for name, values in config['profiles'].items()
+                }
+                for name, values in credentials.items():
+                    full_config['profiles'].setdefault(name, {}).update(
+                        values
+                    )
+                logger.debug("Parsed {} profiles".format(
+                    len(full_config['profiles'])
+                ))
+                self._parsed = (config, credentials, full_config)
+            return self._parsed
@@ -0,0 +1,222 @@
+from contextlib import contextmanager
+import contextvars
+import datetime
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# States of an account, or of a stack in an account and region, roughly in
+# the order they are reached
+STATES = (
+    'discovering',
+    'discovered',
+    'queued',
+    'planning',
+    'deleting',
+    'creating',
+    'updating',
+    'executing',
+    'waiting',
+    'done',
+    'skipped',
+    'failed',
+    'cancelled'
+)
+
+# States after which a stack is not worked on any more
+TERMINAL_STATES = ('done', 'skipped', 'failed', 'cancelled')
+
+# The stack the current thread or task is working on, so code that does not
+# know about accounts, i.e. lib.stacks, can report its state
+_unit = contextvars.ContextVar('progress_unit', default=None)
+
+
+class Progress:
+    """Streams state transitions as NDJSON events and keeps a live summary.
+
+    Every transition is written as one JSON object per line, flushed right
+    away so a pipeline can read the stream while the run is going on:
+
+        {"account_id": "123456789012", "error": null, "event": "state",
+         "profile_name": "prod", "region": "us-east-1",
+         "stack_name": "BctTools", "state": "waiting", ...}
+
+    Transitions of stacks, which have a region, are also counted for a one
+    line summary of finished and in flight stacks, throughput and ETA.
+    Nothing is written until start() is called.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stream = None
+        self._summary_stream = None
+        self._summary_interval = 1.0
+        self.reset()
+
+    def __str__(self):
+        with self._lock:
+            return self.__summary_line()
+
+    def emit(self, state, account_id=None, profile_name=None, region=None,
+             stack_name=None, action=None, error=None):
+        """Records a state transition and writes its event.
+
+        Fields that are not given are taken from the current unit().
+        """
+        if state not in STATES:
+            raise ValueError("Unknown progress state {}".format(state))
+        unit = _unit.get() or {}
+        event = {
+            'account_id': account_id or unit.get('account_id'),
+            'action': action,
+            'elapsed': None,
+            'error': str(error) if error else None,
+            'event': 'state',
+            'profile_name': profile_name or unit.get('profile_name'),
+            'region': region or unit.get('region'),
+            'stack_name': stack_name or unit.get('stack_name'),
+            'state': state,
+            'timestamp': None
+        }
+        with self._lock:
+            if event['region']:
+                key = (event['account_id'], event['region'],
+                       event['stack_name'])
+                if self._states.get(key) not in TERMINAL_STATES:
+                    self._states[key] = state
+            elif state == 'discovered':
+                self._discovered += 1
+            self.__write(event)
+            self.__write_summary()
+
+    def reset(self):
+        with self._lock:
+            self._states = {}
+            self._discovered = 0
+            self._start = time.monotonic()
+            self._last_summary = None
+
+    def start(self, stream=None, summary_stream=None, summary_interval=1.0):
+        """Starts writing events and summaries.
+
+        Args:
+            stream:             File object NDJSON events are written to.
+            summary_stream:     File object the summary line is written to.
+                                It is redrawn in place when the stream is a
+                                terminal.
+            summary_interval:   Least seconds between two summary lines.
+
+        """
+        self.reset()
+        with self._lock:
+            self._stream = stream
+            self._summary_stream = summary_stream
+            self._summary_interval = summary_interval
+
+    def stop(self):
+        """Writes a final summary event and line, and stops writing."""
+        with self._lock:
+            counts = self.__counts()
+            self.__write({
+                'elapsed': None,
+                'event': 'summary',
+                'cancelled': counts['cancelled'],
+                'discovered': self._discovered,
+                'done': counts['done'],
+                'failed': counts['failed'],
+                'skipped': counts['skipped'],
+                'timestamp': None,
+                'total': len(self._states)
+            })
+            self.__write_summary(final=True)
+            self._stream = None
+            self._summary_stream = None
+
+    def state(self, state, **kwargs):
+        """Emits a state of the current unit, if there is one."""
+        if _unit.get() is not None:
+            self.emit(state, **kwargs)
+
+    @property
+    def states(self):
+        """Returns a dict of (account_id, region, stack_name) to the latest
+        state of each stack."""
+        with self._lock:
+            return dict(self._states)
+
+    @contextmanager
+    def unit(self, account_id, profile_name, region, stack_name):
+        """Attributes the states emitted in the with block to a stack in an
+        account and region."""
+        token = _unit.set({
+            'account_id': account_id,
+            'profile_name': profile_name,
+            'region': region,
+            'stack_name': stack_name
+        })
+        try:
+            yield
+        finally:
+            _unit.reset(token)
+
+    def __counts(self):
+        counts = dict.fromkeys(TERMINAL_STATES, 0)
+        counts['in_flight'] = 0
+        for state in self._states.values():
+            if state in TERMINAL_STATES:
+                counts[state] += 1
+            elif state != 'queued':
+                counts['in_flight'] += 1
+        return counts
+
+    def __summary_line(self):
+        counts = self.__counts()
+        finished = sum(counts[state] for state in TERMINAL_STATES)
+        elapsed = time.monotonic() - self._start
+        throughput = finished / elapsed if elapsed > 0 else 0.0
+        remaining = len(self._states) - finished
+        eta = ("{:.0f}s".format(remaining / throughput) if throughput
+               else '-')
+        return ("{}/{} stacks finished ({} failed, {} skipped), {} in "
+                "flight, {} accounts discovered, {:.2f}/s, ETA {}".format(
+                    finished, len(self._states), counts['failed'],
+                    counts['skipped'], counts['in_flight'],
+                    self._discovered, throughput, eta))
+
+    def __write(self, event):
+        if not self._stream:
+            return
+        event['elapsed'] = round(time.monotonic() - self._start, 3)
+        event['timestamp'] = datetime.datetime.now(
+            datetime.timezone.utc).isoformat()
+        try:
+            self._stream.write(json.dumps(event, sort_keys=True) + '\n')
+            self._stream.flush()
+        except (OSError, ValueError) as e:
+            # i.e. the reading end of a pipe went away, the run goes on
+            logger.warning("Stopped writing progress events: {}".format(e))
+            self._stream = None
+
+    def __write_summary(self, final=False):
+        if not self._summary_stream:
+            return
+        now = time.monotonic()
+        if (not final and self._last_summary is not None
+                and now - self._last_summary < self._summary_interval):
+            return
+        self._last_summary = now
+        line = self.__summary_line()
+        if self._summary_stream.isatty():
+            # Redraw the line in place, ending it once the run is over
+            self._summary_stream.write("\r\033[K" + line
+                                       + ('\n' if final else ''))
+        else:
+            self._summary_stream.write(line + '\n')
+        self._summary_stream.flush()
+
+
+# Shared by the provisioner, account discovery and stacks
+progress = Progress()
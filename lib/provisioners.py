@@ -1,13 +1,223 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import sys
 
-from lib.accounts import AwsAccounts
-from lib.stacks import Stack, Template
+from lib import aio
+from lib.accounts import AwsAccounts, IdentityCache
+from lib.clients import ClientPool
+from lib.journal import RunJournal
+from lib.logs import log_context
+from lib.manifests import Manifest, StackSpec, resolve_parameters
+from lib.metrics import metrics
+from lib.organizations import DEFAULT_ROLE_NAME, OrganizationAccounts
+from lib.plans import Plan, PlannedChange
+from lib.progress import progress
+from lib.rollouts import Rollout
+from lib.stacks import StackInventory, Template, parameters_hexdigest
+from lib.stacksets import StackSet
+from lib.throttling import DEFAULT_MAX_ATTEMPTS, RateLimiter, retry_config
 
 logger = logging.getLogger(__name__)
 
+# 'stacks' applies the template to a stack in each account from here,
+# 'stackset' deploys it with a CloudFormation StackSet
+ENGINES = ('stacks', 'stackset')
+
+
+class ProvisionResult:
+    """Outcome of provisioning a single account in a region.
+
+    Args:
+        account_id:     Id of the provisioned account.
+        profile_name:   Name of the profile used to provision the account.
+        region:         AWS region the stack is in.
+        action:         'created', 'updated', 'unchanged', 'skipped',
+                        'failed' or 'cancelled' when a Rollout was stopped
+                        before the stack was provisioned.
+        error:          Exception raised while provisioning, if any.
+        diff:           StackDiff the action was based on, if any.
+        stack_name:     Name of the stack, when several stacks are
+                        provisioned.
+
+    """
+
+    # A run keeps one result per stack in every account and region
+    __slots__ = ('_account_id', '_action', '_diff', '_error', '_profile_name',
+                 '_region', '_stack_name')
+
+    def __init__(self, account_id, profile_name, region, action, error=None,
+                 diff=None, stack_name=None):
+        self._account_id = account_id
+        self._profile_name = profile_name
+        self._region = region
+        self._action = action
+        self._diff = diff
+        self._error = error
+        self._stack_name = stack_name
+
+    def __str__(self):
+        line = "{} ({}) {} {}".format(self.account_id,
+                                      self.profile_name,
+                                      self.region,
+                                      self.action)
+        if self.stack_name:
+            line = "{} ({}) {} {} {}".format(self.account_id,
+                                             self.profile_name,
+                                             self.region,
+                                             self.stack_name,
+                                             self.action)
+        if self.error:
+            line = "{}: {}".format(line, self.error)
+        return line
+
+    @property
+    def account_id(self):
+        return self._account_id
+
+    @property
+    def action(self):
+        return self._action
+
+    @property
+    def diff(self):
+        return self._diff
+
+    @property
+    def error(self):
+        return self._error
+
+    @property
+    def failed(self):
+        return self._action in ('failed', 'cancelled')
+
+    @property
+    def profile_name(self):
+        return self._profile_name
+
+    @property
+    def region(self):
+        return self._region
+
+    @property
+    def stack_name(self):
+        return self._stack_name
+
+
+class ProvisionSummary:
+    """Collection of ProvisionResult objects for a provisioning run.
+
+    Args:
+        results:    A list of ProvisionResult objects.
+
+    """
+
+    def __init__(self, results=None):
+        self._results = list(results) if results else []
+
+    def __str__(self):
+        lines = ["Provisioning summary: {} succeeded, {} failed".format(
+            len(self.succeeded), len(self.failed)
+        )]
+        lines.extend("  {}".format(result) for result in self._results)
+        return '\n'.join(lines)
+
+    def add(self, result):
+        self._results.append(result)
+
+    @property
+    def failed(self):
+        return [result for result in self._results if result.failed]
+
+    @property
+    def results(self):
+        return list(self._results)
+
+    @property
+    def succeeded(self):
+        return [result for result in self._results if not result.failed]
+
 
 class AwsProvisioner:
+    """Applies a CloudFormation template to each of the target accounts.
+
+    Accounts are discovered and the template is read once, then each
+    account and region pair is provisioned as a separate unit of work.
+
+    Args:
+        cfn_template_path:  Path to template, either in file:// or s3://
+                            format.
+        region:             AWS region, or list of regions, the stack is
+                            created in.
+        stack_name:         Name of the CFN stack.
+        cfn_params:         A dict of parameters used for the CFN stack.
+        include_profiles:   A list or regex of profiles to provision.
+        exclude_profiles:   A list or regex of profiles to not provision.
+        max_workers:        Number of accounts that are discovered, and
+                            account and region pairs that are provisioned,
+                            at the same time. Defaults to 1.
+        identity_cache_path: Path to the on-disk cache of profile account
+                            ids. No cache is used when not provided.
+        identity_cache_ttl: Number of seconds cached account ids are valid.
+        wait_timeout:       Seconds to wait for each stack operation to
+                            finish. Defaults to 1800.
+        template_cache_dir: Directory used to cache templates read from S3.
+        verify_deployed:    Compare against the deployed template instead of
+                            the hexdigest tags recorded on the stack.
+        journal_path:       Path to the RunJournal the outcome of each
+                            account and region is recorded in.
+        resume:             Skip accounts and regions the journal records
+                            as provisioned with the same template and
+                            parameters.
+        rate_limits:        A dict of service name to API calls per second
+                            allowed in each region, across all accounts.
+                            Merged with the default limits.
+        max_attempts:       Attempts made for each API call before a
+                            throttling or transient error is raised.
+        org_management_profile: Profile of the Organizations management
+                            account. When provided, the accounts of the
+                            organization are provisioned through org_role_name
+                            instead of the profiles in the credentials file,
+                            and include_profiles and exclude_profiles match
+                            account names and ids.
+        org_role_name:      Role assumed in each account of the organization.
+        org_units:          A list of OU ids the organization accounts must
+                            be in.
+        org_account_tags:   A dict of tags the organization accounts must
+                            have.
+        engine:             'stacks' or 'stackset'. The stackset engine
+                            deploys the template with a self-managed StackSet
+                            named stack_name, with up to max_workers accounts
+                            at a time in each region.
+        stack_set_admin_profile: Profile of the StackSet administrator
+                            account. Defaults to org_management_profile, or
+                            the default credentials. The StackSet is created
+                            in the first region.
+        failure_tolerance_count: Accounts that can fail in each region before
+                            the StackSet operation is stopped there.
+        template_staging_url: s3://bucket/prefix templates too large to send
+                            inline are uploaded to. Defaults to the bucket of
+                            a template read from S3.
+        validate_template:  Validate each template with CloudFormation's
+                            ValidateTemplate once, before any account is
+                            provisioned.
+        check_template:     Check the structure of each template locally
+                            before any account is provisioned.
+        canary_size:        Accounts provisioned in a first wave before any
+                            other account, 0 to provision all accounts in
+                            one wave. Only supported by the stacks engine.
+        wave_growth:        Factor each following wave of accounts is
+                            larger than the previous one.
+        failure_threshold:  Percentage of finished stacks that can fail
+                            before the stacks in flight are cancelled and no
+                            more are started. None to never stop.
+        manifest:           Manifest of several stacks to provision in each
+                            account instead of a single stack, in which case
+                            cfn_template_path, stack_name and cfn_params are
+                            not used. Only supported by the stacks engine
+                            without plans.
+
+    """
 
     def __init__(self,
                  cfn_template_path,
@@ -15,55 +225,706 @@ class AwsProvisioner:
                  stack_name,
                  cfn_params,
                  include_profiles=None,
-                 exclude_profiles=None):
-        self._region = region
-        self._stack_name = stack_name
-        self._template_path = cfn_template_path
-        self._template = Template(cfn_template_path)
-        self._cfn_params = cfn_params
-        self._accounts = AwsAccounts(
-                                    include=include_profiles,
-                                    exclude=exclude_profiles
-                                    ).target_accounts
+                 exclude_profiles=None,
+                 max_workers=1,
+                 identity_cache_path=None,
+                 identity_cache_ttl=86400,
+                 wait_timeout=1800,
+                 template_cache_dir=None,
+                 verify_deployed=False,
+                 journal_path=None,
+                 resume=False,
+                 rate_limits=None,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 org_management_profile=None,
+                 org_role_name=DEFAULT_ROLE_NAME,
+                 org_units=None,
+                 org_account_tags=None,
+                 engine='stacks',
+                 stack_set_admin_profile=None,
+                 failure_tolerance_count=0,
+                 manifest=None,
+                 template_staging_url=None,
+                 validate_template=False,
+                 check_template=True,
+                 canary_size=0,
+                 wave_growth=2,
+                 failure_threshold=None):
+        if max_workers < 1:
+            raise ValueError("max_workers must be at least 1")
+        if resume and not journal_path:
+            raise ValueError("resume requires a journal_path")
+        if engine not in ENGINES:
+            raise ValueError(
+                "engine must be one of {}".format(', '.join(ENGINES))
+            )
+        if engine != 'stacks' and (canary_size
+                                   or failure_threshold is not None):
+            raise ValueError("Rollouts require the stacks engine")
+        self._engine = engine
+        self._failure_tolerance_count = failure_tolerance_count
+        self._stack_set_admin_profile = (stack_set_admin_profile
+                                         or org_management_profile)
+        self._journal = RunJournal(journal_path) if journal_path else None
+        self._resume = resume
+        self._max_workers = max_workers
+        self._regions = [region] if type(region) is str else list(region)
+        if not self._regions:
+            raise ValueError("At least one region is required")
+        if manifest is None:
+            manifest = Manifest([StackSpec(stack_name, cfn_template_path,
+                                           parameters=cfn_params)])
+        elif len(manifest) > 1 and engine != 'stacks':
+            raise ValueError("Manifests require the stacks engine")
+        self._manifest = manifest
+        # Checks the arguments, every run gets a Rollout of its own
+        self._rollout_args = (canary_size, wave_growth, failure_threshold,
+                              len(manifest) * len(self._regions))
+        Rollout(*self._rollout_args)
+        self._verify_deployed = verify_deployed
+        self._wait_timeout = wait_timeout
+        self._client_pool = ClientPool(
+            max_pool_connections=max_workers,
+            rate_limiter=RateLimiter(rate_limits),
+            client_config=retry_config(max_attempts)
+        )
+        with metrics.phase('template'):
+            templates = {}
+            for spec in manifest:
+                if spec.template_path not in templates:
+                    templates[spec.template_path] = Template(
+                        spec.template_path,
+                        cache_dir=template_cache_dir,
+                        client_pool=self._client_pool
+                    )
+            # Done once per template, so an unusable template fails the run
+            # before any account is discovered
+            validation_client = (self._client_pool.client(
+                'cloudformation',
+                profile_name=self._stack_set_admin_profile,
+                region_name=self._regions[0]
+            ) if validate_template else None)
+            for template in templates.values():
+                if template.needs_staging:
+                    template.stage(template_staging_url)
+                template.validate(cfn_client=validation_client,
+                                  check_structure=check_template)
+        self._templates = {spec.name: templates[spec.template_path]
+                           for spec in manifest}
+        # Plans and the stackset engine work on the first, and only, stack
+        self._stack_name = manifest.stacks[0].name
+        self._template_path = manifest.stacks[0].template_path
+        self._template = self._templates[self._stack_name]
+        self._cfn_params = manifest.stacks[0].parameters
+        self._parameters_hexdigest = parameters_hexdigest(self._cfn_params)
+        if org_management_profile:
+            aws_accounts = OrganizationAccounts(
+                                        org_management_profile,
+                                        role_name=org_role_name,
+                                        include=include_profiles,
+                                        exclude=exclude_profiles,
+                                        organizational_units=org_units,
+                                        tags=org_account_tags,
+                                        max_workers=max_workers,
+                                        client_pool=self._client_pool
+                                        )
+        else:
+            identity_cache = (IdentityCache(identity_cache_path,
+                                            ttl=identity_cache_ttl)
+                              if identity_cache_path else None)
+            aws_accounts = AwsAccounts(
+                                        include=include_profiles,
+                                        exclude=exclude_profiles,
+                                        max_workers=max_workers,
+                                        identity_cache=identity_cache,
+                                        client_pool=self._client_pool
+                                        )
+        self._aws_accounts = aws_accounts
 
     @property
     def accounts(self):
-        return self._accounts
+        """Returns the target accounts, discovering them on first access.
+
+        provision_accounts without confirmation does not wait for discovery
+        to finish, it starts on each account as soon as it is resolved.
+        """
+        if not self._aws_accounts.discovered:
+            with metrics.phase('discovery'):
+                self._aws_accounts.target_accounts
+        return self._aws_accounts.target_accounts
+
+    @property
+    def manifest(self):
+        return self._manifest
+
+    @property
+    def regions(self):
+        return list(self._regions)
 
     @property
     def template(self):
         return self._template.body
 
-    def provision_accounts(self, confirm=True):
+    def apply_plan(self, plan, confirm=True):
+        """Executes the change sets of a plan made by plan_accounts.
+
+        Args:
+            plan:       Plan to apply, it must have been made for the same
+                        template and stack.
+            confirm:    Prompt before executing the change sets.
+
+        Returns:
+            A ProvisionSummary with the result of each account in the plan.
+
+        """
+        self.__require_stacks_engine()
+        if (plan.template_hexdigest != self._template.hexdigest
+                or plan.stack_name != self._stack_name):
+            raise ValueError(
+                "Plan was made for a different template or stack, "
+                "create a new plan"
+            )
         if confirm:
+            self._confirm("The following plan will be applied. \n\n{}".format(
+                plan
+            ))
+
+        accounts = {account.id: account for account in self.accounts}
+        for change in plan.changes:
+            progress.emit('queued', account_id=change.account_id,
+                          profile_name=change.profile_name,
+                          region=change.region, stack_name=self._stack_name)
+        with metrics.phase('apply'), \
+                ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            futures = [executor.submit(self._apply_change,
+                                       accounts.get(change.account_id),
+                                       change)
+                       for change in plan.changes]
+            summary = ProvisionSummary(future.result() for future in futures)
+
+        logger.info(summary)
+        return summary
+
+    def plan_accounts(self):
+        """Creates a change set in each target account without executing it.
+
+        Returns:
+            A Plan with the planned change for each account.
+
+        """
+        self.__require_stacks_engine()
+        for account, region in self._units():
+            progress.emit('queued', account_id=account.id,
+                          profile_name=account.profile_name, region=region,
+                          stack_name=self._stack_name)
+        with metrics.phase('plan'), \
+                ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            futures = [executor.submit(self._plan_account, account, region)
+                       for account, region in self._units()]
+            plan = Plan(self._stack_name,
+                        self._template.hexdigest,
+                        [future.result() for future in futures])
+
+        logger.info(plan)
+        return plan
+
+    def provision_accounts(self, confirm=True):
+        """Provisions all target accounts.
+
+        Up to max_workers accounts are provisioned concurrently. A failure
+        in one account does not stop the others from being provisioned, a
+        failed stack only stops the stacks that depend on it in the same
+        account and region, unless more than failure_threshold percent of
+        the stacks fail. Accounts are provisioned in waves when there is a
+        canary_size.
+
+        Returns:
+            A ProvisionSummary with the result of each account.
+
+        """
+        if confirm and len(self._manifest) > 1:
+            self._confirm(
+                "The following accounts will be provisioned. \n"
+                "These CloudFormation stacks will be created in each account "
+                "in {}: \n{} \n\n{}".format(
+                    ', '.join(self._regions),
+                    '\n'.join("{} using the template {}".format(
+                        spec.name, spec.template_path)
+                        for spec in self._manifest),
+                    '\n'.join("{} ({})".format(account.id,
+                                               account.profile_name)
+                              for account in self.accounts))
+            )
+        elif confirm:
             account_id_names = []
-            for account in self._accounts:
+            for account in self.accounts:
                 id_name = "{} ({})".format(account.id, account.profile_name)
                 account_id_names.append(id_name)
-            print(
+            self._confirm(
                 "The following accounts will be provisioned. \n"
                 "A CloudFormation stack named {} will be created in each "
-                "account using the template {}. \n\n{}".format(
+                "account in {} using the template {}. \n\n{}".format(
                     self._stack_name,
+                    ', '.join(self._regions),
                     self._template_path,
                     '\n'.join(account_id_names))
             )
-            proceed = input("\nProceed? [Y]/N ") or "Y"
-            if proceed.upper() != "Y" and proceed.upper() != "YES":
-                sys.exit()
-        for account in self._accounts:
-            cfn = account.session.client('cloudformation',
-                                         region_name=self._region)
-            logger.info("Provisioning account {} ({})".format(
-                account.id, account.profile_name
-            ))
-            stack = Stack(self._stack_name, cfn_client=cfn)
-            stack.apply_template(self._template.body,
-                                 parameters=self._cfn_params)
 
+        with metrics.phase('provision'):
+            if self._engine == 'stackset':
+                summary = self._provision_stack_set()
+            else:
+                summary = self._provision_stacks()
+
+        logger.info(summary)
+        return summary
+
+    def _apply_change(self, account, change):
+        with log_context("{} {}".format(change.account_id, change.region)), \
+                progress.unit(change.account_id, change.profile_name,
+                              change.region, self._stack_name):
+            result = self.__apply_change(account, change)
+            self._record(result)
+            self._report(result)
+            return result
+
+    def __apply_change(self, account, change):
+        if change.action == 'none':
+            return ProvisionResult(change.account_id,
+                                   change.profile_name,
+                                   change.region,
+                                   'unchanged')
+        try:
+            if change.failed:
+                raise RuntimeError(
+                    "Planning failed: {}".format(change.error)
+                )
+            if not account:
+                raise RuntimeError(
+                    "Account is not one of the target accounts"
+                )
+            stack = self._stack(account, change.region)
+            action = stack.execute_change_set(change.change_set)
+        except Exception as e:
+            logger.error("Applying plan to account {} ({}) in {} failed: "
+                         "{}".format(change.account_id,
+                                     change.profile_name,
+                                     change.region, e))
+            return ProvisionResult(change.account_id, change.profile_name,
+                                   change.region, 'failed', error=e)
+        return ProvisionResult(change.account_id, change.profile_name,
+                               change.region, action)
+
+    @staticmethod
+    def _confirm(message):
+        """Prints message and exits unless the user chooses to proceed."""
+        print(message)
+        proceed = input("\nProceed? [Y]/N ") or "Y"
+        if proceed.upper() != "Y" and proceed.upper() != "YES":
+            sys.exit()
+
+    def _plan_account(self, account, region):
+        with log_context("{} {}".format(account.id, region)), \
+                progress.unit(account.id, account.profile_name, region,
+                              self._stack_name):
+            change = self.__plan_account(account, region)
+            progress.emit('failed' if change.failed else 'done',
+                          action=change.action, error=change.error)
+            return change
+
+    def __plan_account(self, account, region):
+        logger.info("Planning account {} ({}) in {}".format(
+            account.id, account.profile_name, region
+        ))
+        try:
+            stack = self._stack(account, region)
+            change_set = stack.create_change_set(
+                self._template.body,
+                parameters=self._cfn_params,
+                template_url=self._template.url
+            )
+        except Exception as e:
+            logger.error("Planning account {} ({}) in {} failed: "
+                         "{}".format(account.id, account.profile_name,
+                                     region, e))
+            return PlannedChange(account.id, account.profile_name, region,
+                                 'failed', error=str(e))
+        if not change_set:
+            return PlannedChange(account.id, account.profile_name, region,
+                                 'none')
+        return PlannedChange(account.id, account.profile_name, region,
+                             change_set.type.lower(),
+                             change_set=change_set)
+
+    def _is_completed(self, account, region, stack_name, template_hexdigest,
+                      params_hexdigest):
+        """Returns True if resuming and the journal records the stack as
+        provisioned with the same template and parameters."""
+        if not (self._resume and self._journal.is_completed(
+                account.id, region, stack_name, template_hexdigest,
+                params_hexdigest)):
+            return False
+        logger.info("Skipping account {} ({}) in {}, already "
+                    "provisioned".format(account.id, account.profile_name,
+                                         region))
+        return True
+
+    async def _provision_stack_async(self, account, region, spec, inventory,
+                                     outputs):
+        """Provisions a stack of the manifest in an account and region.
+
+        Args:
+            spec:       StackSpec of the stack.
+            inventory:  StackInventory of the account and region.
+            outputs:    A dict of stack name to the outputs of the stacks
+                        spec depends on.
+
+        Returns:
+            A (ProvisionResult, outputs) tuple. outputs is a dict of the
+            stack's outputs when other stacks depend on it.
 
+        """
+        context = (account.id, region, spec.name)
+        if len(self._manifest) == 1:
+            context = context[:2]
+        with log_context(' '.join(context)), \
+                progress.unit(account.id, account.profile_name, region,
+                              spec.name):
+            template = self._templates[spec.name]
+            stack_name = spec.name if len(self._manifest) > 1 else None
+            try:
+                parameters = resolve_parameters(spec.parameters, outputs)
+            except ValueError as e:
+                logger.error("Provisioning stack {} in account {} ({}) in {} "
+                             "failed: {}".format(spec.name, account.id,
+                                                 account.profile_name,
+                                                 region, e))
+                result = ProvisionResult(account.id, account.profile_name,
+                                         region, 'failed', error=e,
+                                         stack_name=stack_name)
+                self._record(result, template.hexdigest,
+                             parameters_hexdigest(spec.parameters))
+                self._report(result)
+                return result, {}
+            params_hexdigest = parameters_hexdigest(parameters)
+            stack = inventory.stack(spec.name,
+                                    wait_timeout=self._wait_timeout,
+                                    verify_deployed=self._verify_deployed)
+            if self._is_completed(account, region, spec.name,
+                                  template.hexdigest, params_hexdigest):
+                result = ProvisionResult(account.id, account.profile_name,
+                                         region, 'skipped',
+                                         stack_name=stack_name)
+            else:
+                result = await self.__provision_stack_async(
+                    account, region, stack, template, parameters, stack_name
+                )
+                self._record(result, template.hexdigest, params_hexdigest)
 
+            stack_outputs = {}
+            if not result.failed and self._manifest.dependents(spec.name):
+                try:
+                    stack_outputs = await asyncio.to_thread(
+                        lambda: stack.outputs
+                    )
+                except Exception as e:
+                    logger.error("Reading the outputs of stack {} failed: "
+                                 "{}".format(spec.name, e))
+            self._report(result)
+            return result, stack_outputs
 
+    async def __provision_stack_async(self, account, region, stack, template,
+                                      parameters, stack_name):
+        logger.info("Provisioning account {} ({}) in {}".format(
+            account.id, account.profile_name, region
+        ))
+        try:
+            action = await stack.apply_template_async(
+                template.body,
+                parameters=parameters,
+                template_url=template.url
+            )
+            logger.debug("CFN API calls: {}".format(stack.api_calls))
+        except Exception as e:
+            logger.error("Provisioning account {} ({}) in {} failed: "
+                         "{}".format(account.id, account.profile_name,
+                                     region, e))
+            return ProvisionResult(account.id, account.profile_name,
+                                   region, 'failed', error=e,
+                                   stack_name=stack_name)
+        return ProvisionResult(account.id, account.profile_name, region,
+                               action, diff=stack.last_diff,
+                               stack_name=stack_name)
+
+    def _provision_stack_set(self):
+        """Provisions all target accounts and regions with a StackSet.
+
+        Returns:
+            A ProvisionSummary with the result of each account and region.
+
+        """
+        units = [(account, region) for account, region in self._units()
+                 if not self._is_completed(account, region,
+                                           self._stack_name,
+                                           self._template.hexdigest,
+                                           self._parameters_hexdigest)]
+        targets = [(account.id, region) for account, region in units]
+        for account, region in units:
+            progress.emit('queued', account_id=account.id,
+                          profile_name=account.profile_name, region=region,
+                          stack_name=self._stack_name)
+        outcomes = {}
+        if targets:
+            stack_set = StackSet(
+                self._stack_name,
+                cfn_client=self._client_pool.client(
+                    'cloudformation',
+                    profile_name=self._stack_set_admin_profile,
+                    region_name=self._regions[0]
+                ),
+                wait_timeout=self._wait_timeout,
+                max_concurrent_count=self._max_workers,
+                failure_tolerance_count=self._failure_tolerance_count
+            )
+            try:
+                outcomes = stack_set.apply_template(
+                    self._template.body,
+                    targets,
+                    parameters=self._cfn_params,
+                    template_url=self._template.url
+                )
+            except Exception as e:
+                logger.error("Provisioning stack set {} failed: {}".format(
+                    self._stack_name, e
+                ))
+                outcomes = {target: ('failed', e) for target in targets}
+            logger.debug("CFN API calls: {}".format(stack_set.api_calls))
+
+        summary = ProvisionSummary()
+        for account, region in self._units():
+            if (account.id, region) not in outcomes:
+                result = ProvisionResult(account.id, account.profile_name,
+                                         region, 'skipped')
+                self._report(result)
+                summary.add(result)
+                continue
+            action, error = outcomes[(account.id, region)]
+            result = ProvisionResult(account.id, account.profile_name,
+                                     region, action, error=error)
+            if result.failed:
+                logger.error("Provisioning account {} ({}) in {} failed: "
+                             "{}".format(account.id, account.profile_name,
+                                         region, error))
+            self._record(result)
+            self._report(result)
+            summary.add(result)
+        return summary
+
+    def _provision_stacks(self):
+        """Provisions the stacks of the manifest in all target accounts and
+        regions.
+
+        Every account and region is a coroutine, and so is every stack in
+        it. A stack starts as soon as the stacks it depends on are
+        provisioned in its account and region, so independent stacks are
+        provisioned at the same time. A semaphore keeps at most max_workers
+        stacks in flight, and their blocking CFN calls share a pool of at
+        most aio.DEFAULT_MAX_THREADS threads. Waiting for a stack does not
+        hold a thread, so max_workers can be well above the thread count.
+
+        Returns:
+            A ProvisionSummary with the result of each stack.
+
+        """
+        return aio.run(self._provision_stacks_async(),
+                       max_threads=min(self._max_workers,
+                                       aio.DEFAULT_MAX_THREADS))
+
+    async def _provision_stacks_async(self):
+        semaphore = asyncio.Semaphore(self._max_workers)
+        rollout = Rollout(*self._rollout_args)
+        tasks = {}
+        waves = {}
+        # The latest task of each account id. Profiles of the same account
+        # share its stacks, so they are provisioned one after the other.
+        account_tasks = {}
+        with metrics.phase('discovery'):
+            async for account in self._aws_accounts.accounts_async():
+                wave = rollout.wave(len(tasks))
+                after = list(waves.get(wave - 1, ()))
+                if account.id in account_tasks:
+                    after.append(account_tasks[account.id])
+                tasks[account] = asyncio.ensure_future(
+                    self._provision_account_async(account, semaphore,
+                                                  rollout, after)
+                )
+                waves.setdefault(wave, []).append(tasks[account])
+                account_tasks[account.id] = tasks[account]
+        summary = ProvisionSummary()
+        for account in self.accounts:
+            for results in await tasks[account]:
+                for result in results:
+                    summary.add(result)
+        return summary
+
+    async def _provision_account_async(self, account, semaphore, rollout,
+                                       after=()):
+        """Provisions an account in every region once the tasks in after
+        are done: the accounts of the previous wave, and an earlier profile
+        of the same account. Then releases its session and clients so that
+        only accounts in flight hold any.
+
+        Accounts with cancelled stacks are not released, as the blocking
+        calls of a cancelled stack go on in their threads with the
+        account's clients.
+
+        Returns:
+            A list with the list of ProvisionResult objects of each region.
 
+        """
+        if after:
+            await asyncio.wait(after)
+        results = await asyncio.gather(*(
+            self._provision_unit_async(account, region, semaphore, rollout)
+            for region in self._regions
+        ))
+        if not any(result.action == 'cancelled'
+                   for region_results in results
+                   for result in region_results):
+            account.release()
+        return results
 
+    async def _provision_unit_async(self, account, region, semaphore,
+                                    rollout):
+        """Provisions the stacks of the manifest in an account and region,
+        which share one StackInventory.
+
+        Returns:
+            A list of ProvisionResult objects in manifest order.
+
+        """
+        def cancelled(spec):
+            result = ProvisionResult(
+                account.id, account.profile_name, region, 'cancelled',
+                error=RuntimeError("Rollout stopped: {}".format(
+                    rollout.reason)),
+                stack_name=spec.name if len(self._manifest) > 1 else None
+            )
+            self._record(result, self._templates[spec.name].hexdigest,
+                         parameters_hexdigest(spec.parameters))
+            self._report(result)
+            return result, {}
+
+        # Neither a session nor an assumed role for a stopped rollout
+        if rollout.stopped:
+            return [cancelled(spec)[0] for spec in self._manifest]
+        cfn_client = await asyncio.to_thread(account.client,
+                                             'cloudformation',
+                                             region_name=region)
+        inventory = StackInventory(cfn_client=cfn_client)
+        tasks = {}
+
+        async def provision(spec):
+            """Provisions a stack once its dependencies are done, stacks that
+            depend on a failed stack fail without being provisioned."""
+            dependencies = {name: await tasks[name]
+                            for name in spec.depends_on}
+            if rollout.stopped:
+                return cancelled(spec)
+            failed = [name for name, (result, _) in dependencies.items()
+                      if result.failed]
+            if failed:
+                logger.error("Not provisioning stack {} in account {} ({}) "
+                             "in {}, it depends on failed stacks {}".format(
+                                 spec.name, account.id, account.profile_name,
+                                 region, ', '.join(failed)))
+                result = ProvisionResult(
+                    account.id, account.profile_name, region, 'failed',
+                    error=RuntimeError("Depends on failed stacks {}".format(
+                        ', '.join(failed))),
+                    stack_name=spec.name
+                )
+                self._record(result, self._templates[spec.name].hexdigest,
+                             parameters_hexdigest(spec.parameters))
+                self._report(result)
+                return result, {}
+            async with semaphore:
+                provisioned = await rollout.run(self._provision_stack_async(
+                    account, region, spec, inventory,
+                    {name: stack_outputs
+                     for name, (_, stack_outputs) in dependencies.items()}
+                ))
+            if provisioned is None:
+                logger.info("Cancelled stack {} in account {} ({}) in {}, "
+                            "the rollout was stopped".format(
+                                spec.name, account.id, account.profile_name,
+                                region))
+                return cancelled(spec)
+            rollout.record(provisioned[0])
+            return provisioned
+
+        # The manifest is in dependency order, so the tasks of a stack's
+        # dependencies exist before its own task is created
+        for spec in self._manifest:
+            progress.emit('queued', account_id=account.id,
+                          profile_name=account.profile_name, region=region,
+                          stack_name=spec.name)
+            tasks[spec.name] = asyncio.ensure_future(provision(spec))
+        return [(await tasks[spec.name])[0] for spec in self._manifest]
+
+    def _record(self, result, template_hexdigest=None, params_hexdigest=None):
+        """Records a ProvisionResult in the journal, if there is one.
+
+        The template and parameters hexdigest default to those of the first
+        stack.
+        """
+        if self._journal:
+            self._journal.record(
+                result.account_id,
+                result.region,
+                result.stack_name or self._stack_name,
+                template_hexdigest or self._template.hexdigest,
+                params_hexdigest or self._parameters_hexdigest,
+                result.action,
+                profile_name=result.profile_name,
+                error=result.error
+            )
+
+    def _report(self, result):
+        """Emits the progress event of a ProvisionResult's outcome."""
+        if result.action in ('skipped', 'cancelled'):
+            state = result.action
+        elif result.failed:
+            state = 'failed'
+        else:
+            state = 'done'
+        progress.emit(state,
+                      account_id=result.account_id,
+                      profile_name=result.profile_name,
+                      region=result.region,
+                      stack_name=result.stack_name or self._stack_name,
+                      action=result.action,
+                      error=result.error)
+
+    def _stack(self, account, region):
+        """Returns the Stack in an account and region, backed by a
+        StackInventory."""
+        cfn = account.client('cloudformation', region_name=region)
+        inventory = StackInventory(cfn_client=cfn).load()
+        logger.debug("CFN API calls: {}".format(inventory.api_calls))
+        return inventory.stack(self._stack_name,
+                               wait_timeout=self._wait_timeout,
+                               verify_deployed=self._verify_deployed)
+
+    def __require_stacks_engine(self):
+        if self._engine != 'stacks' or len(self._manifest) > 1:
+            raise ValueError(
+                "Plans are only supported by the stacks engine for a single "
+                "stack"
+            )
 
+    def _units(self):
+        """Returns the (account, region) pairs to be provisioned."""
+        return [(account, region)
+                for account in self.accounts
+                for region in self._regions]
@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import math
+
+logger = logging.getLogger(__name__)
+
+
+class Rollout:
+    """Provisions accounts in waves and stops once too many stacks fail.
+
+    The first canary_size accounts form the first wave, and each following
+    wave is wave_growth times larger than the one before. A wave only
+    starts once the previous wave is finished. Without a canary_size all
+    accounts are provisioned in one wave.
+
+    Every finished stack is counted, and once more than failure_threshold
+    percent of them failed the rollout is stopped: stacks in flight are
+    cancelled and pending stacks are not started. Stacks waited on when
+    the rollout is stopped are left to finish in CloudFormation.
+
+    The threshold is only checked once enough stacks finished for a single
+    failure not to decide it. With a canary that is every stack of the
+    canary, so the canary is judged as a whole and a failing canary stops
+    the rollout before the next wave, as intended. Without one, it is the
+    fewest stacks of which one can fail within the threshold, i.e. 10 for
+    10%. A failure_threshold of 0 stops the rollout on the first failure
+    either way.
+
+    Args:
+        canary_size:        Accounts in the first wave, 0 for a single wave.
+        wave_growth:        Factor each wave is larger than the previous one.
+        failure_threshold:  Percentage of finished stacks that can fail
+                            before the rollout is stopped, None to never
+                            stop.
+        stacks_per_account: Stacks provisioned in each account, across
+                            regions.
+
+    """
+
+    def __init__(self, canary_size=0, wave_growth=2, failure_threshold=None,
+                 stacks_per_account=1):
+        if type(canary_size) is not int or canary_size < 0:
+            raise ValueError("canary_size must be a positive integer or 0")
+        if wave_growth < 1:
+            raise ValueError("wave_growth must be at least 1")
+        if failure_threshold is not None and not 0 <= failure_threshold < 100:
+            raise ValueError("failure_threshold must be a percentage from 0 "
+                             "up to 100")
+        self._canary_size = canary_size
+        self._wave_growth = wave_growth
+        self._failure_threshold = failure_threshold
+        if not failure_threshold:
+            self._min_finished = 1
+        elif canary_size:
+            self._min_finished = canary_size * stacks_per_account
+        else:
+            self._min_finished = math.ceil(100 / failure_threshold)
+        self._failed = 0
+        self._finished = 0
+        self._reason = None
+        self._tasks = set()
+
+    def __str__(self):
+        return "{} of {} finished stacks failed".format(self._failed,
+                                                        self._finished)
+
+    def record(self, result):
+        """Counts the ProvisionResult of a stack and stops the rollout if
+        the failure threshold is exceeded."""
+        if result.action in ('skipped', 'cancelled'):
+            return
+        self._finished += 1
+        if result.failed:
+            self._failed += 1
+        if (self._failure_threshold is not None
+                and self._finished >= self._min_finished
+                and self._failed * 100 > self._failure_threshold
+                * self._finished):
+            self.stop("{}, more than the {}% failure threshold".format(
+                self, self._failure_threshold
+            ))
+
+    @property
+    def reason(self):
+        """Returns why the rollout was stopped, None while it goes on."""
+        return self._reason
+
+    async def run(self, coroutine):
+        """Runs a coroutine as a task stop() cancels.
+
+        Returns:
+            The result of the coroutine, or None if the rollout was stopped
+            before or while it ran.
+
+        """
+        if self.stopped:
+            coroutine.close()
+            return None
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.add(task)
+        try:
+            return await task
+        except asyncio.CancelledError:
+            # Only swallow the cancellations made by stop()
+            if not (self.stopped and task.cancelled()):
+                raise
+            return None
+        finally:
+            self._tasks.discard(task)
+
+    def stop(self, reason):
+        """Stops the rollout, cancelling the tasks started by run()."""
+        if self.stopped:
+            return
+        self._reason = reason
+        logger.error("Stopping the rollout, {}. Stack operations in progress "
+                     "go on in CloudFormation.".format(reason))
+        for task in self._tasks:
+            task.cancel()
+
+    @property
+    def stopped(self):
+        return self._reason is not None
+
+    def wave(self, index):
+        """Returns the number of the wave the account at index is in."""
+        if not self._canary_size:
+            return 0
+        wave = 0
+        size = self._canary_size
+        end = size
+        while index >= end:
+            wave += 1
+            size = math.ceil(size * self._wave_growth)
+            end += size
+        return wave
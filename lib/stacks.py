@@ -1,180 +1,627 @@
+import asyncio
+from collections import Counter
+import functools
 from hashlib import sha1
+import json
 import logging
+import os
+import threading
+import time
 
-import boto3
-from botocore.exceptions import ClientError, WaiterError
+from botocore.exceptions import ClientError
+import yaml
+
+from lib.clients import client_pool
+from lib.metrics import metrics
+from lib.progress import progress
 
 logger = logging.getLogger(__name__)
 
+# Stack tags used to record what was last applied by the provisioner
+PARAMETERS_HEXDIGEST_TAG = 'bct:parameters-sha1'
+TEMPLATE_HEXDIGEST_TAG = 'bct:template-sha1'
+
+# Value describe_stacks returns for NoEcho parameters
+NO_ECHO_MASK = '****'
+
+# Largest template CFN accepts as a TemplateBody, larger ones have to be
+# read from S3 with a TemplateURL, up to MAX_TEMPLATE_URL_BYTES
+MAX_TEMPLATE_BODY_BYTES = 51200
+MAX_TEMPLATE_URL_BYTES = 1000000
+
+# Seconds a presigned URL of a staged template is valid for, the longest
+# S3 allows
+STAGED_TEMPLATE_URL_EXPIRY = 604800
+
+TEMPLATE_SECTIONS = ('AWSTemplateFormatVersion', 'Conditions', 'Description',
+                     'Hooks', 'Mappings', 'Metadata', 'Outputs',
+                     'Parameters', 'Resources', 'Rules', 'Transform')
+
+
+class _CfnYamlLoader(yaml.SafeLoader):
+    """YAML loader that accepts CFN short form functions such as !Ref."""
+
+
+def _construct_cfn_function(loader, tag_suffix, node):
+    if isinstance(node, yaml.ScalarNode):
+        value = loader.construct_scalar(node)
+    elif isinstance(node, yaml.SequenceNode):
+        value = loader.construct_sequence(node, deep=True)
+    else:
+        value = loader.construct_mapping(node, deep=True)
+    name = tag_suffix if tag_suffix == 'Ref' else 'Fn::' + tag_suffix
+    return {name: value}
+
+
+_CfnYamlLoader.add_multi_constructor('!', _construct_cfn_function)
+
+
+def parse_template(template):
+    """Returns a JSON or YAML CFN template body as a dict.
+
+    Raises ValueError if the template can not be parsed.
+    """
+    try:
+        # JSON first, YAML does not allow the tabs JSON templates may have
+        document = json.loads(template)
+    except ValueError:
+        try:
+            document = yaml.load(template, Loader=_CfnYamlLoader)
+        except yaml.YAMLError as e:
+            raise ValueError("Unable to parse template: {}".format(e))
+    if type(document) is not dict:
+        raise ValueError("Template must be a JSON or YAML object")
+    return document
+
+
+@functools.lru_cache(maxsize=32)
+def template_parameter_names(template):
+    """Returns a frozenset of parameters declared in a template.
+
+    Returns None if the template can not be parsed.
+    """
+    try:
+        document = parse_template(template)
+    except ValueError:
+        return None
+    return frozenset(document.get('Parameters') or {})
+
+
+@functools.lru_cache(maxsize=32)
+def template_no_echo_names(template):
+    """Returns a frozenset of the NoEcho parameters declared in a template.
+
+    Returns an empty frozenset if the template can not be parsed.
+    """
+    try:
+        document = parse_template(template)
+    except ValueError:
+        return frozenset()
+    parameters = document.get('Parameters') or {}
+    if type(parameters) is not dict:
+        return frozenset()
+    return frozenset(
+        name for name, parameter in parameters.items()
+        if type(parameter) is dict
+        and str(parameter.get('NoEcho', '')).lower() == 'true'
+    )
+
+
+@functools.lru_cache(maxsize=32)
+def template_errors(template):
+    """Returns a tuple of the structural problems of a template body, empty
+    if there are none.
+
+    Only the overall structure is checked: the sections, that resources
+    have a Type, parameters a Type and outputs a Value. Resources,
+    parameters and outputs are not checked in templates with a Transform,
+    which can rewrite them, i.e. the Fn::ForEach loops of
+    AWS::LanguageExtensions. The result is cached per template body.
+    """
+    errors = []
+    size = len(template.encode())
+    if size > MAX_TEMPLATE_URL_BYTES:
+        errors.append("Template is {} bytes, CloudFormation accepts at "
+                      "most {}".format(size, MAX_TEMPLATE_URL_BYTES))
+    try:
+        document = parse_template(template)
+    except ValueError as e:
+        return tuple(errors + [str(e)])
+    unknown = sorted(str(key) for key in document
+                     if key not in TEMPLATE_SECTIONS)
+    if unknown:
+        errors.append("Unknown template sections: {}".format(
+            ', '.join(unknown)))
+    if 'Transform' in document:
+        return tuple(errors)
+    resources = document.get('Resources')
+    if not resources or type(resources) is not dict:
+        errors.append("Template must declare at least one resource")
+        resources = {}
+    for name, resource in resources.items():
+        if type(resource) is not dict or not resource.get('Type'):
+            errors.append("Resource {} has no Type".format(name))
+    for section, key in (('Parameters', 'Type'), ('Outputs', 'Value')):
+        entries = document.get(section) or {}
+        if type(entries) is not dict:
+            errors.append("{} must be a mapping".format(section))
+            continue
+        for name, entry in entries.items():
+            if type(entry) is not dict or key not in entry:
+                errors.append("{} {} has no {}".format(
+                    section[:-1], name, key))
+    return tuple(errors)
+
+
+def template_source(template, template_url=None):
+    """Returns the TemplateURL, or else TemplateBody, kwarg of a CFN call."""
+    if template_url:
+        return {'TemplateURL': template_url}
+    return {'TemplateBody': template}
+
+
+def parameters_hexdigest(parameters):
+    """Returns the sha1 hexdigest of a dict of CFN parameters."""
+    return sha1(
+        json.dumps(parameters or {}, sort_keys=True).encode()
+    ).hexdigest()
+
 
 class Stack:
     """CRUD for CloudFormation Stack.
 
+    The stack is described at most once and the response is kept as a
+    snapshot that all read-only properties are served from. The snapshot is
+    invalidated whenever the stack is created, updated or deleted so that
+    the next read describes the stack again. Use refresh() to force a new
+    describe and api_calls to see how many calls were made.
+
+    When a StackInventory is provided, the first snapshot is taken from the
+    inventory instead of describing the stack.
+
+    The hexdigest of the template and parameters are recorded as stack tags
+    whenever the stack is created or updated. apply_template uses these
+    tags to decide if the stack is up-to-date without downloading the
+    deployed template, unless verify_deployed is set or the tags are
+    missing.
+
     Args:
         stack_name:     name of CFN stack
         stack_arn:      ARN of CFN stack
         cfn_client:     boto3 cloudformation client that should be used,
                         default client will be used if one is not provided
+        inventory:      StackInventory of the account/region the stack is in
+        wait_timeout:   seconds to wait for a create, update or delete to
+                        finish
+        verify_deployed: compare against the deployed template instead of
+                        the recorded hexdigest tags
         """
 
-    def __init__(self, stack_name, stack_arn=None, cfn_client=None):
+    def __init__(self, stack_name, stack_arn=None, cfn_client=None,
+                 inventory=None, wait_timeout=1800, verify_deployed=False):
+        self._api_calls = Counter()
         self._arn = stack_arn
-        self._cfn = (cfn_client if cfn_client
-                     else boto3.client('cloudformation'))
+        if cfn_client:
+            self._cfn = cfn_client
+        elif inventory is not None:
+            self._cfn = inventory.cfn_client
+        else:
+            self._cfn = client_pool.client('cloudformation')
+        self._described = False
+        self._events = []
         self._hexdigest = None
+        self._inventory = inventory
+        self._inventory_seeded = False
+        self._last_diff = None
         self._name = stack_name
-        self._parameters = None
+        self._snapshot = None
+        self._verify_deployed = verify_deployed
+        self._wait_timeout = wait_timeout
 
     def __str__(self):
         return str(self.to_dict())
 
-    def apply_template(self, template, parameters=None):
+    @property
+    def api_calls(self):
+        """Returns a dict of CFN operation name to number of calls made."""
+        return dict(self._api_calls)
+
+    def apply_template(self, template, parameters=None, template_url=None):
+        """Blocking version of apply_template_async."""
+        return asyncio.run(self.apply_template_async(
+            template, parameters, template_url=template_url
+        ))
+
+    async def apply_template_async(self, template, parameters=None,
+                                   template_url=None):
         """applies a cfn template to stack.
 
         This may create the stack from scratch or update an existing stack.
-        Will clean up stacks that are in "ROLLBACK_COMPLETE" state before
-        trying to create a stack.
+        Will clean up stacks that are in "ROLLBACK_COMPLETE" or
+        "REVIEW_IN_PROGRESS" state before trying to create a stack. At most
+        one create or update is made, the StackDiff it was based on is
+        available as last_diff afterwards.
+
+        CFN calls are made with asyncio.to_thread, while waiting for the
+        stack to finish only holds the event loop.
 
         Arg:
             template:       A string obj of the CFN template.
             parameters:     A dict of parameters to be used when creating the
                             CFN stack.
+            template_url:   URL of the same template in S3, sent instead of
+                            the body when provided, i.e. for templates over
+                            MAX_TEMPLATE_BODY_BYTES.
+
+        Returns:
+            'created', 'updated' or 'unchanged' depending on the action that
+            was taken on the stack.
 
         """
-        # Check if stack already exists, if rolled back, then _delete stack
-        if self.status == 'ROLLBACK_COMPLETE':
+        # Check if stack already exists, if rolled back or only created by
+        # a change set that was never executed, then _delete stack
+        status = await asyncio.to_thread(lambda: self.status)
+        if status in ('ROLLBACK_COMPLETE', 'REVIEW_IN_PROGRESS'):
             logger.warning(
-                "CFN stack {} in a ROLLBACK_COMPLETE state.".format(self.name)
+                "CFN stack {} in a {} state.".format(self.name, status)
             )
-            self._delete()
+            await self._delete_async()
 
-        if parameters:
-            cfn_params = [
-                {'ParameterKey': key,
-                 'ParameterValue': parameters[key]}
-                for key in parameters]
-        else:
-            cfn_params = []
-        logger.debug("CFN Params to be used: {}".format(cfn_params))
-
-        # First see if the supplied template is the same as what is
-        # currently used for the stack. This is done by comparing the
-        # hexdigest of the template with the stack. If the stack's hexdigest
-        # is none, then that means the stack does not exist and should be
-        # created.
-        stack_updated = False
+        if not template.endswith('\n'):
+            template = template + '\n'
+        progress.state('planning')
+        diff = await asyncio.to_thread(self.diff, template, parameters)
+        self._last_diff = diff
+        logger.debug("CFN Params to be used: {}".format(diff.cfn_parameters))
+
+        tags = self.__tags(diff.hexdigest, diff.parameters_hexdigest)
+        if diff.action == 'create':
+            await self._create_async(template, diff.cfn_parameters, tags=tags,
+                                     template_url=template_url)
+            return 'created'
+        elif diff.action == 'update':
+            logger.debug("CFN stack {} changes: {}".format(self.name, diff))
+            try:
+                await self._update_async(template, diff.cfn_parameters,
+                                         tags=tags, template_url=template_url)
+            except ClientError as e:
+                # Only CloudFormation can compare NoEcho parameter values
+                if ("No updates are to be performed"
+                        not in e.response['Error']['Message']):
+                    raise
+                logger.info(
+                    "CFN stack {} already up-to-date.".format(self.name)
+                )
+                return 'unchanged'
+            return 'updated'
+
+        logger.info("CFN stack {} already up-to-date.".format(self.name))
+        return 'unchanged'
+
+    def diff(self, template, parameters=None):
+        """Compares a template and parameters with the stack.
+
+        Parameters that are not declared in the template are left out. Stack
+        parameters that are still declared in the template but not supplied
+        keep their current value.
+
+        Arg:
+            template:       A string obj of the CFN template.
+            parameters:     A dict of parameters to be used for the stack.
+
+        Returns:
+            A StackDiff.
+
+        """
         if not template.endswith('\n'):
             template = template + '\n'
         hexdigest = sha1(template.encode()).hexdigest()
-        if self.hexdigest is None:
-            self._create(template, cfn_params)
-            stack_updated = True
-        elif hexdigest != self.hexdigest:
-            self._update(template, cfn_params)
-            stack_updated = True
-            # remove cached hexdigest
-            self._hexdigest = None
-
-        # If the stack hasn't been updated then check to see if the supplied
-        #  params match the stacks current params. If they don't match then
-        # the params have been updated and the stack needs to be updated.
-        if not stack_updated:
-            stack_params = {
-                stack_param['ParameterKey']: stack_param['ParameterValue']
-                for stack_param in self.parameters
-            }
-            for param in cfn_params:
-                key = param['ParameterKey']
-                value = param['ParameterValue']
-                stack_value = stack_params.get(key, '')
-                if value != stack_value:
+        parameters = dict(parameters or {})
+
+        declared = template_parameter_names(template)
+        ignored = []
+        if declared is not None:
+            ignored = sorted(key for key in parameters if key not in declared)
+            for key in ignored:
+                logger.info(
+                    "Ignoring param {} as it is not declared in the "
+                    "template".format(key)
+                )
+                del parameters[key]
+        no_echo = template_no_echo_names(template)
+        params_hexdigest = parameters_hexdigest(
+            {key: value for key, value in parameters.items()
+             if key not in no_echo}
+        )
+
+        deployed_hexdigest = self.__deployed_hexdigest()
+        if deployed_hexdigest is None:
+            return StackDiff('create', hexdigest, parameters,
+                             added=parameters, ignored=ignored,
+                             no_echo=no_echo)
+
+        stack_params = {
+            stack_param['ParameterKey']: stack_param.get('ParameterValue')
+            for stack_param in self.parameters
+        }
+        removed = sorted(key for key in stack_params
+                         if declared is not None and key not in declared)
+        previous = sorted(key for key in stack_params
+                          if key not in parameters and key not in removed)
+
+        # The recorded parameters hexdigest is trusted when present. NoEcho
+        # values are kept out of it, as the tag is copied to the stack's
+        # resources, and describe_stacks masks them, so supplied NoEcho
+        # parameters are left for CloudFormation to compare on update.
+        added = {}
+        changed = {}
+        for key in sorted(no_echo):
+            if key in parameters and key in stack_params:
+                changed[key] = (NO_ECHO_MASK, NO_ECHO_MASK)
+        if (self._verify_deployed
+                or self.recorded_parameters_hexdigest != params_hexdigest):
+            for key, value in parameters.items():
+                if key in no_echo and key in stack_params:
+                    continue
+                if key not in stack_params:
+                    added[key] = value
+                elif value != stack_params[key]:
                     logger.debug(
                         "Template param {}:{} differs from "
                         "stack param {}:{}".format(key, value,
-                                                   key, stack_value)
+                                                   key, stack_params[key])
                     )
-                    self._update(template, cfn_params)
-                    stack_updated = True
+                    changed[key] = (stack_params[key], value)
 
-        if not stack_updated:
+        template_changed = hexdigest != deployed_hexdigest
+        action = ('update' if template_changed or added or changed or removed
+                  else 'none')
+        return StackDiff(action, hexdigest, parameters,
+                         template_changed=template_changed,
+                         added=added,
+                         changed=changed,
+                         removed=removed,
+                         previous=previous,
+                         ignored=ignored,
+                         no_echo=no_echo)
+
+    def create_change_set(self, template, parameters=None,
+                          change_set_name=None, template_url=None):
+        """Creates a change set for applying a template to the stack.
+
+        The change set is not executed, see execute_change_set.
+
+        Arg:
+            template:           A string obj of the CFN template.
+            parameters:         A dict of parameters to be used for the stack.
+            change_set_name:    Name of the change set, defaults to a name
+                                based on the current time.
+            template_url:       URL of the same template in S3, sent instead
+                                of the body when provided.
+
+        Returns:
+            A ChangeSet, or None if the stack is already up-to-date.
+
+        """
+        if self.status == 'ROLLBACK_COMPLETE':
+            raise RuntimeError(
+                "CFN stack {} is in a ROLLBACK_COMPLETE state and needs to "
+                "be deleted before a change set can be created".format(
+                    self.name)
+            )
+        if not template.endswith('\n'):
+            template = template + '\n'
+        progress.state('planning')
+        diff = self.diff(template, parameters)
+        self._last_diff = diff
+        if not diff.has_changes:
             logger.info("CFN stack {} already up-to-date.".format(self.name))
+            return None
+
+        change_set_type = 'CREATE' if diff.action == 'create' else 'UPDATE'
+        change_set_name = change_set_name or 'bct-provisioner-{}'.format(
+            time.strftime('%Y%m%d%H%M%S', time.gmtime())
+        )
+        logger.info("Creating {} change set {} for CFN stack {}".format(
+            change_set_type, change_set_name, self.name
+        ))
+        response = self._call(
+            'create_change_set',
+            StackName=self.name,
+            **template_source(template, template_url),
+            Capabilities=['CAPABILITY_IAM', 'CAPABILITY_NAMED_IAM'],
+            Parameters=diff.cfn_parameters,
+            Tags=self.__tags(diff.hexdigest, diff.parameters_hexdigest),
+            ChangeSetName=change_set_name,
+            ChangeSetType=change_set_type
+        )
+        # A CREATE change set creates the stack in REVIEW_IN_PROGRESS
+        self.invalidate()
+
+        with metrics.phase('change_set_wait'):
+            description = self.__wait_for_change_set(response['Id'])
+        if description['Status'] == 'FAILED':
+            reason = description.get('StatusReason') or ''
+            if ("didn't contain changes" in reason
+                    or "No updates are to be performed" in reason):
+                logger.info(
+                    "CFN stack {} already up-to-date.".format(self.name)
+                )
+                self._call('delete_change_set', ChangeSetName=response['Id'])
+                return None
+            raise RuntimeError("Change set {} for stack {} failed: {}".format(
+                change_set_name, self.name, reason
+            ))
+        return ChangeSet(response['Id'],
+                         response['StackId'],
+                         change_set_type,
+                         description['Changes'])
+
+    def execute_change_set(self, change_set):
+        """Executes a change set and waits for the stack to finish.
+
+        Arg:
+            change_set:     A ChangeSet created for this stack.
+
+        Returns:
+            'created' or 'updated' depending on the change set type.
+
+        """
+        self._arn = change_set.stack_id
+        since_event_id = self.__latest_event_id()
+        logger.info("Executing change set {} for CFN stack {}".format(
+            change_set.id, self.name
+        ))
+        progress.state('executing')
+        self._call('execute_change_set', ChangeSetName=change_set.id)
+        if change_set.type == 'CREATE':
+            self.__wait('create', since_event_id=since_event_id)
+            return 'created'
+        self.__wait('update', since_event_id=since_event_id)
+        return 'updated'
+
+    def __wait_for_change_set(self, change_set_id):
+        """Waits for a change set to be created and returns its description
+        including all of its changes."""
+        deadline = time.monotonic() + self._wait_timeout
+        delay = 1
+        while True:
+            description = self._call('describe_change_set',
+                                     ChangeSetName=change_set_id)
+            if description['Status'] in ('CREATE_COMPLETE', 'FAILED'):
+                break
+            if time.monotonic() >= deadline:
+                raise RuntimeError(
+                    "Timed out after {} seconds waiting for change set "
+                    "{}".format(self._wait_timeout, change_set_id)
+                )
+            time.sleep(delay)
+            delay = min(delay * 2, 15)
+
+        changes = list(description.get('Changes', []))
+        next_token = description.get('NextToken')
+        while next_token:
+            page = self._call('describe_change_set',
+                              ChangeSetName=change_set_id,
+                              NextToken=next_token)
+            changes.extend(page.get('Changes', []))
+            next_token = page.get('NextToken')
+        description['Changes'] = changes
+        return description
+
+    @property
+    def last_diff(self):
+        """Returns the StackDiff used by the last apply_template call."""
+        return self._last_diff
 
     @property
     def arn(self):
-        if self.status:
-            if not self._arn:
-                try:
-                    response = self._cfn.describe_stacks(StackName=self.name)
-                except ClientError as e:
-                    if "does not exist" in e.response['Error']['Message']:
-                        return None
-                    else:
-                        raise
-                self._arn = response['Stacks'][0]['StackId']
-        else:
-            self._arn = None
-        return self._arn
+        if self._snapshot_stack:
+            self._arn = self._snapshot_stack['StackId']
+            return self._arn
+        return None
 
     @arn.setter
     def arn(self, arn):
         self._arn = arn
+        self.invalidate()
+
+    def __wait(self, operation, since_event_id=None):
+        """Blocking version of __wait_async."""
+        asyncio.run(self.__wait_async(operation,
+                                      since_event_id=since_event_id))
+
+    async def __wait_async(self, operation, since_event_id=None):
+        """Waits for a create, update or delete of the stack to finish.
 
-    def __cfn_wait(self, condition):
-        create_waiter = self._cfn.get_waiter(condition)
-        waiter_delay = 10
-        waiter_max_attempts = 18
-        logger.info("Waiting up to {} seconds for {}.".format(
-            str(waiter_delay * waiter_max_attempts),
-            condition
+        Raises RuntimeError if the stack does not end up in the expected
+        state or the wait times out.
+        """
+        waiter = StackWaiter(self._cfn,
+                             self._arn or self.name,
+                             since_event_id=since_event_id,
+                             timeout=self._wait_timeout,
+                             call=self._call)
+        logger.info("Waiting up to {} seconds for stack {} to {}.".format(
+            self._wait_timeout, self.name, operation
         ))
+        progress.state('waiting')
         try:
-            create_waiter.wait(StackName=self.arn,
-                               WaiterConfig={
-                                   'Delay': waiter_delay,
-                                   'MaxAttempts': waiter_max_attempts
-                               }
-                               )
-        except WaiterError:
-            events_response = self._cfn.describe_stack_events(
-                StackName=self.name)
-            for event in events_response['StackEvents']:
-                if event['ResourceStatus'] == 'CREATE_FAILED':
-                    logger.error(event['ResourceStatusReason'])
+            with metrics.phase('stack_wait'):
+                status = await waiter.wait_async()
+        finally:
+            self._events = waiter.events
+            self.invalidate()
+        if status != StackWaiter.COMPLETE_STATUSES[operation]:
             raise RuntimeError(
-                "Stack failed to _create with status {}".format(
-                    self.status))
-
-    def _create(self, template, param_list=None):
-            logger.info(
-                "Creating CFN stack {} with Params {}".format(
-                    self.name,
-                    param_list
-                )
-            )
-            response = self._cfn.create_stack(
-                StackName=self.name,
-                TemplateBody=template,
-                Capabilities=['CAPABILITY_IAM', 'CAPABILITY_NAMED_IAM'],
-                Parameters=param_list
+                "Stack {} failed to {} with status {}".format(
+                    self.name, operation, status))
+
+    @property
+    def events(self):
+        """Returns the stack events seen during the last wait, oldest first."""
+        return list(self._events)
+
+    def __latest_event_id(self):
+        """Returns the id of the newest stack event, used to skip old events
+        when waiting for an update or delete."""
+        response = self._call('describe_stack_events',
+                              StackName=self._arn or self.name)
+        events = response['StackEvents']
+        return events[0]['EventId'] if events else None
+
+    def _call(self, operation, **kwargs):
+        """Calls a CFN client operation and counts it in api_calls."""
+        self._api_calls[operation] += 1
+        return getattr(self._cfn, operation)(**kwargs)
+
+    def _create(self, template, param_list=None, tags=None,
+                template_url=None):
+        asyncio.run(self._create_async(template, param_list, tags=tags,
+                                       template_url=template_url))
+
+    async def _create_async(self, template, param_list=None, tags=None,
+                            template_url=None):
+        progress.state('creating')
+        logger.info(
+            "Creating CFN stack {} with Params {}".format(
+                self.name,
+                param_list
             )
+        )
+        response = await asyncio.to_thread(
+            self._call,
+            'create_stack',
+            StackName=self.name,
+            **template_source(template, template_url),
+            Capabilities=['CAPABILITY_IAM', 'CAPABILITY_NAMED_IAM'],
+            Parameters=param_list,
+            Tags=tags or []
+        )
 
-            arn = response['StackId']
-            logger.info("StackId {}".format(arn))
-            self.__cfn_wait('stack_create_complete')
-            logger.info("Stack {} created".format(self.name))
+        self._arn = response['StackId']
+        logger.info("StackId {}".format(self._arn))
+        await self.__wait_async('create')
+        logger.info("Stack {} created".format(self.name))
 
     def _delete(self):
-        arn = self.arn
+        asyncio.run(self._delete_async())
+
+    async def _delete_async(self):
+        arn = await asyncio.to_thread(lambda: self.arn)
+        since_event_id = await asyncio.to_thread(self.__latest_event_id)
         logger.info("Deleting stack with ARN {}".format(arn))
-        self._cfn.delete_stack(StackName=arn)
-        self.__cfn_wait('stack_delete_complete')
+        progress.state('deleting')
+        await asyncio.to_thread(self._call, 'delete_stack', StackName=arn)
+        await self.__wait_async('delete', since_event_id=since_event_id)
         logger.info("Stack {} deleted".format(self.name))
 
     @property
     def hexdigest(self):
         if self.status:
             if not self._hexdigest:
-                cfn_response = self._cfn.get_template(StackName=self.arn)
+                cfn_response = self._call('get_template',
+                                          StackName=self.arn)
                 stack_template = cfn_response['TemplateBody']
                 self._hexdigest = sha1(stack_template.encode()).hexdigest()
             return self._hexdigest
@@ -185,6 +632,26 @@ class Stack:
     def hexdigest(self, digest):
         self._hexdigest = digest
 
+    def __deployed_hexdigest(self):
+        """Returns the hexdigest of the deployed template.
+
+        The recorded tag is used when available, otherwise the deployed
+        template is downloaded. Returns None if the stack does not exist, or
+        was only created by a change set that was never executed, which
+        leaves it in REVIEW_IN_PROGRESS with the tags of that change set.
+        """
+        if self.status in (None, 'REVIEW_IN_PROGRESS'):
+            return None
+        if not self._verify_deployed and self.recorded_hexdigest:
+            return self.recorded_hexdigest
+        return self.hexdigest
+
+    def invalidate(self):
+        """Discards the snapshot so the next read describes the stack."""
+        self._described = False
+        self._snapshot = None
+        self._hexdigest = None
+
     @property
     def name(self):
         return self._name
@@ -192,33 +659,98 @@ class Stack:
     @name.setter
     def name(self, name):
         self._name = name
+        self._arn = None
+        self.invalidate()
+
+    @property
+    def outputs(self):
+        """Returns a dict of the stack's output keys and values."""
+        if self._snapshot_stack:
+            return {output['OutputKey']: output['OutputValue']
+                    for output in self._snapshot_stack.get('Outputs', [])}
+        return {}
 
     @property
     def parameters(self):
-        if self.status:
-            if not self._parameters:
-                try:
-                    response = self._cfn.describe_stacks(StackName=self.name)
-                except ClientError as e:
-                    if "does not exist" in e.response['Error']['Message']:
-                        return None
-                    else:
-                        raise
-                self._parameters = response['Stacks'][0]['Parameters']
-        else:
-            self._parameters = None
-        return self._parameters
+        if self._snapshot_stack:
+            return self._snapshot_stack.get('Parameters', [])
+        return None
 
     @property
-    def status(self):
+    def recorded_hexdigest(self):
+        """Returns the template hexdigest recorded in the stack tags."""
+        return self.tags.get(TEMPLATE_HEXDIGEST_TAG)
+
+    @property
+    def recorded_parameters_hexdigest(self):
+        """Returns the parameters hexdigest recorded in the stack tags."""
+        return self.tags.get(PARAMETERS_HEXDIGEST_TAG)
+
+    def refresh(self):
+        """Describes the stack and replaces the snapshot.
+
+        The stack is described by ARN once it is known, so a deleted stack
+        is reported as not existing instead of as DELETE_COMPLETE.
+        """
         try:
-            response = self._cfn.describe_stacks(StackName=self.name)
+            response = self._call('describe_stacks',
+                                  StackName=self._arn or self.name)
         except ClientError as e:
             if "does not exist" in e.response['Error']['Message']:
-                return None
+                response = {'Stacks': []}
             else:
                 raise
-        return response['Stacks'][0]['StackStatus']
+        stacks = response['Stacks']
+        if stacks and stacks[0]['StackStatus'] != 'DELETE_COMPLETE':
+            self.__set_snapshot(stacks[0])
+        else:
+            self.__set_snapshot(None)
+        if self._inventory is not None:
+            self._inventory.set(self.name, self._snapshot)
+        return self._snapshot
+
+    def __set_snapshot(self, stack):
+        self._hexdigest = None
+        self._described = True
+        self._snapshot = stack
+        self._arn = stack['StackId'] if stack else None
+
+    @property
+    def _snapshot_stack(self):
+        """Returns the described stack, describing it if needed.
+
+        The inventory, if any, is only used for the first snapshot. Once the
+        snapshot is invalidated the stack is described directly.
+        """
+        if not self._described:
+            if self._inventory is not None and not self._inventory_seeded:
+                self.__set_snapshot(self._inventory.get(self.name))
+                self._inventory_seeded = True
+            else:
+                self.refresh()
+        return self._snapshot
+
+    @property
+    def status(self):
+        if self._snapshot_stack:
+            return self._snapshot_stack['StackStatus']
+        return None
+
+    @property
+    def tags(self):
+        """Returns a dict of the stack's tags."""
+        if self._snapshot_stack:
+            return {tag['Key']: tag['Value']
+                    for tag in self._snapshot_stack.get('Tags', [])}
+        return {}
+
+    def __tags(self, hexdigest, params_hexdigest):
+        """Returns the stack's tags with updated hexdigest tags."""
+        tags = self.tags
+        tags[TEMPLATE_HEXDIGEST_TAG] = hexdigest
+        tags[PARAMETERS_HEXDIGEST_TAG] = params_hexdigest
+        return [{'Key': key, 'Value': value}
+                for key, value in sorted(tags.items())]
 
     def to_dict(self):
         return {
@@ -228,32 +760,427 @@ class Stack:
                 'status': self.status
         }
 
-    def _update(self, template, param_list=None):
+    def _update(self, template, param_list=None, tags=None,
+                template_url=None):
+        asyncio.run(self._update_async(template, param_list, tags=tags,
+                                       template_url=template_url))
+
+    async def _update_async(self, template, param_list=None, tags=None,
+                            template_url=None):
+        progress.state('updating')
         logger.info(
             "Updating CFN stack {} with Params {}".format(
                 self.name,
                 param_list
             )
         )
-        self._cfn.update_stack(
+        since_event_id = await asyncio.to_thread(self.__latest_event_id)
+        await asyncio.to_thread(
+            self._call,
+            'update_stack',
             StackName=self.name,
-            TemplateBody=template,
+            **template_source(template, template_url),
             Capabilities=['CAPABILITY_IAM', 'CAPABILITY_NAMED_IAM'],
-            Parameters=param_list
+            Parameters=param_list,
+            Tags=tags or []
         )
-        self.__cfn_wait('stack_update_complete')
+        await self.__wait_async('update', since_event_id=since_event_id)
         logger.info("Stack {} updated".format(self.name))
 
 
+class ChangeSet:
+    """A CloudFormation change set created for a stack.
+
+    Args:
+        change_set_id:      ARN of the change set.
+        stack_id:           ARN of the stack the change set is for.
+        change_set_type:    'CREATE' or 'UPDATE'.
+        changes:            A list of changes as returned by
+                            describe_change_set.
+
+    """
+
+    def __init__(self, change_set_id, stack_id, change_set_type, changes):
+        self._changes = list(changes)
+        self._id = change_set_id
+        self._stack_id = stack_id
+        self._type = change_set_type
+
+    def __str__(self):
+        line = "{} change set with {} changes".format(self.type,
+                                                      len(self.changes))
+        if self.replacements:
+            line = "{}, replaces {}".format(line,
+                                            ', '.join(self.replacements))
+        return line
+
+    @property
+    def changes(self):
+        return list(self._changes)
+
+    @classmethod
+    def from_dict(cls, change_set):
+        return cls(change_set['id'],
+                   change_set['stack_id'],
+                   change_set['type'],
+                   change_set['changes'])
+
+    @property
+    def id(self):
+        return self._id
+
+    @property
+    def replacements(self):
+        """Returns logical ids of resources that will or may be replaced."""
+        return [
+            change['ResourceChange']['LogicalResourceId']
+            for change in self._changes
+            if change.get('ResourceChange', {}).get('Replacement')
+            in ('True', 'Conditional')
+        ]
+
+    @property
+    def stack_id(self):
+        return self._stack_id
+
+    def to_dict(self):
+        return {
+                'changes': self.changes,
+                'id': self.id,
+                'stack_id': self.stack_id,
+                'type': self.type
+        }
+
+    @property
+    def type(self):
+        return self._type
+
+
+class StackDiff:
+    """Changes needed to bring a stack in line with a template.
+
+    Args:
+        action:             'create', 'update' or 'none'.
+        hexdigest:          sha1 hexdigest of the template.
+        parameters:         A dict of the parameters that will be supplied.
+        template_changed:   True if the template differs from the stack's.
+        added:              A dict of parameters the stack does not have.
+        changed:            A dict of parameter key to (old, new) values.
+        removed:            A list of stack parameters no longer declared in
+                            the template.
+        previous:           A list of stack parameters that were not supplied
+                            and keep their current value.
+        ignored:            A list of supplied parameters that are not
+                            declared in the template.
+        no_echo:            Names of the NoEcho parameters, which are left
+                            out of parameters_hexdigest.
+
+    """
+
+    def __init__(self, action, hexdigest, parameters, template_changed=False,
+                 added=None, changed=None, removed=None, previous=None,
+                 ignored=None, no_echo=None):
+        self._action = action
+        self._added = dict(added or {})
+        self._changed = dict(changed or {})
+        self._hexdigest = hexdigest
+        self._ignored = list(ignored or [])
+        self._no_echo = frozenset(no_echo or ())
+        self._parameters = dict(parameters)
+        self._previous = list(previous or [])
+        self._removed = list(removed or [])
+        self._template_changed = template_changed
+
+    def __str__(self):
+        return str(self.to_dict())
+
+    @property
+    def action(self):
+        return self._action
+
+    @property
+    def added(self):
+        return dict(self._added)
+
+    @property
+    def cfn_parameters(self):
+        """Returns the parameter list used for create_stack/update_stack."""
+        cfn_params = [{'ParameterKey': key, 'ParameterValue': value}
+                      for key, value in self._parameters.items()]
+        cfn_params.extend({'ParameterKey': key, 'UsePreviousValue': True}
+                          for key in self._previous)
+        return cfn_params
+
+    @property
+    def changed(self):
+        return dict(self._changed)
+
+    @property
+    def has_changes(self):
+        return self._action != 'none'
+
+    @property
+    def hexdigest(self):
+        return self._hexdigest
+
+    @property
+    def ignored(self):
+        return list(self._ignored)
+
+    @property
+    def parameters_hexdigest(self):
+        """Returns the hexdigest of the parameters without NoEcho values,
+        which is recorded in the stack tags."""
+        return parameters_hexdigest(
+            {key: value for key, value in self._parameters.items()
+             if key not in self._no_echo}
+        )
+
+    @property
+    def previous(self):
+        return list(self._previous)
+
+    @property
+    def removed(self):
+        return list(self._removed)
+
+    @property
+    def template_changed(self):
+        return self._template_changed
+
+    def to_dict(self):
+        return {
+                'action': self.action,
+                'added': self.added,
+                'changed': self.changed,
+                'ignored': self.ignored,
+                'previous': self.previous,
+                'removed': self.removed,
+                'template_changed': self.template_changed
+        }
+
+
+class StackInventory:
+    """Index of the stacks in an account/region keyed by stack name.
+
+    All stacks are listed with a single paginated describe_stacks call so
+    that several Stack objects in the same account/region do not each have
+    to describe themselves. The stacks are listed when first needed and an
+    inventory can be shared by threads working in the same account/region.
+
+    Args:
+        cfn_client:     boto3 cloudformation client that should be used,
+                        default client will be used if one is not provided
+    """
+
+    def __init__(self, cfn_client=None):
+        self._api_calls = Counter()
+        self._cfn = (cfn_client if cfn_client
+                     else client_pool.client('cloudformation'))
+        self._lock = threading.Lock()
+        self._stacks = None
+
+    @property
+    def api_calls(self):
+        """Returns a dict of CFN operation name to number of calls made."""
+        return dict(self._api_calls)
+
+    @property
+    def cfn_client(self):
+        return self._cfn
+
+    def get(self, stack_name):
+        """Returns the described stack or None if it does not exist."""
+        self.__ensure_loaded()
+        return self._stacks.get(stack_name)
+
+    def load(self):
+        """Lists all stacks in the account/region, replacing the index."""
+        stacks = {}
+        with metrics.phase('stack_inventory'):
+            paginator = self._cfn.get_paginator('describe_stacks')
+            for page in paginator.paginate():
+                self._api_calls['describe_stacks'] += 1
+                for stack in page['Stacks']:
+                    if stack['StackStatus'] != 'DELETE_COMPLETE':
+                        stacks[stack['StackName']] = stack
+        logger.debug("Found {} CFN stacks".format(len(stacks)))
+        self._stacks = stacks
+        return self
+
+    @property
+    def names(self):
+        self.__ensure_loaded()
+        return sorted(self._stacks)
+
+    def __ensure_loaded(self):
+        with self._lock:
+            if self._stacks is None:
+                self.load()
+
+    def set(self, stack_name, stack):
+        """Replaces the indexed stack, removing it when stack is None."""
+        if self._stacks is None:
+            return
+        if stack:
+            self._stacks[stack_name] = stack
+        else:
+            self._stacks.pop(stack_name, None)
+
+    def stack(self, stack_name, **kwargs):
+        """Returns a Stack backed by this inventory.
+
+        Additional keyword arguments are passed on to Stack.
+        """
+        return Stack(stack_name, inventory=self, **kwargs)
+
+
+class StackWaiter:
+    """Waits for a stack operation to finish by polling its events.
+
+    Each poll only reads the events that are newer than the last one seen
+    and the delay between polls grows from min_delay to max_delay, so short
+    operations are noticed quickly while long ones are polled less often.
+    The wait ends as soon as the stack itself reports a terminal status.
+
+    Args:
+        cfn_client:     boto3 cloudformation client that should be used
+        stack_id:       name or ARN of the CFN stack, use the ARN to follow
+                        a stack that is being deleted
+        since_event_id: id of the newest event before the operation started,
+                        older events are ignored
+        timeout:        seconds to wait before giving up
+        min_delay:      seconds to wait after the first poll
+        max_delay:      maximum number of seconds between polls
+        call:           function used to make CFN calls, called with the
+                        operation name and its keyword arguments
+        on_event:       function called with each new event, oldest first
+    """
+
+    COMPLETE_STATUSES = {
+        'create': 'CREATE_COMPLETE',
+        'update': 'UPDATE_COMPLETE',
+        'delete': 'DELETE_COMPLETE'
+    }
+
+    def __init__(self, cfn_client, stack_id, since_event_id=None,
+                 timeout=1800, min_delay=1, max_delay=15, call=None,
+                 on_event=None):
+        self._call = (call if call
+                      else lambda operation, **kwargs:
+                      getattr(cfn_client, operation)(**kwargs))
+        self._events = []
+        self._last_event_id = since_event_id
+        self._max_delay = max_delay
+        self._min_delay = min_delay
+        self._on_event = on_event
+        self._stack_id = stack_id
+        self._timeout = timeout
+
+    @property
+    def events(self):
+        """Returns the events seen so far, oldest first."""
+        return list(self._events)
+
+    def poll(self):
+        """Reads new events and returns the terminal stack status, if any."""
+        new_events = []
+        kwargs = {'StackName': self._stack_id}
+        while True:
+            response = self._call('describe_stack_events', **kwargs)
+            seen_last_event = False
+            for event in response['StackEvents']:
+                if event['EventId'] == self._last_event_id:
+                    seen_last_event = True
+                    break
+                new_events.append(event)
+            if seen_last_event or not response.get('NextToken'):
+                break
+            kwargs['NextToken'] = response['NextToken']
+
+        if new_events:
+            self._last_event_id = new_events[0]['EventId']
+
+        status = None
+        # events are returned newest first
+        for event in reversed(new_events):
+            self._events.append(event)
+            self.__log_event(event)
+            if self._on_event:
+                self._on_event(event)
+            if self.__is_terminal(event):
+                status = event['ResourceStatus']
+        return status
+
+    def wait(self):
+        """Blocking version of wait_async."""
+        return asyncio.run(self.wait_async())
+
+    async def wait_async(self):
+        """Polls until the stack reaches a terminal status and returns it.
+
+        Polls are made with asyncio.to_thread and the delays between them
+        are spent in asyncio.sleep, so no thread is held while waiting.
+
+        Raises RuntimeError when the timeout is reached first.
+        """
+        deadline = time.monotonic() + self._timeout
+        delay = self._min_delay
+        while True:
+            status = await asyncio.to_thread(self.poll)
+            if status:
+                return status
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise RuntimeError(
+                    "Timed out after {} seconds waiting for stack {}".format(
+                        self._timeout, self._stack_id))
+            await asyncio.sleep(min(delay, remaining))
+            delay = min(delay * 2, self._max_delay)
+
+    @staticmethod
+    def __is_terminal(event):
+        status = event['ResourceStatus']
+        return (event['ResourceType'] == 'AWS::CloudFormation::Stack'
+                and event['LogicalResourceId'] == event['StackName']
+                and status.endswith(('_COMPLETE', '_FAILED'))
+                and 'CLEANUP' not in status)
+
+    @staticmethod
+    def __log_event(event):
+        message = "{} {} {}".format(event['LogicalResourceId'],
+                                    event['ResourceType'],
+                                    event['ResourceStatus'])
+        if event.get('ResourceStatusReason'):
+            message = "{}: {}".format(message, event['ResourceStatusReason'])
+        if event['ResourceStatus'].endswith('_FAILED'):
+            logger.error(message)
+        else:
+            logger.debug(message)
+
+
 class Template:
     """Reads and validates a template from S3 or file.
 
+    When a cache_dir is provided, templates read from S3 are stored in it
+    under their sha1 hexdigest along with the S3 ETag. Later reads only
+    download the template again if the ETag has changed.
+
+    Templates larger than CFN accepts as a TemplateBody are staged in S3
+    with stage(), after which url is sent in their place.
+
     Args:
         template_path:   Path to Template, either in file:// or s3:// format
+        cache_dir:       Directory used to cache templates read from S3
+        s3_client:       boto3 s3 client that should be used, default client
+                         will be created when first needed if one is not
+                         provided
+        client_pool:     ClientPool the default client is taken from
 
     """
 
-    def __init__(self, template_path):
+    def __init__(self, template_path, cache_dir=None, s3_client=None,
+                 client_pool=None):
         if (template_path.startswith('file://')
             or template_path.startswith('s3://')):
                 self._template_path = template_path
@@ -261,6 +1188,11 @@ class Template:
             raise ValueError(
                 "template_path must start with 'file://' or 's3://'"
             )
+        self._cache_dir = (os.path.expanduser(cache_dir) if cache_dir
+                           else None)
+        self._client_pool = client_pool
+        self._s3 = s3_client
+        self._url = None
         self._body = self.__read_template()
         self._hexdigest = sha1(self._body.encode()).hexdigest()
 
@@ -275,20 +1207,119 @@ class Template:
     def hexdigest(self):
         return self._hexdigest
 
+    @property
+    def needs_staging(self):
+        """Returns True if the template is too large to send inline."""
+        return self.size > MAX_TEMPLATE_BODY_BYTES
+
+    @property
+    def s3_client(self):
+        if not self._s3:
+            self._s3 = (self._client_pool or client_pool).client('s3')
+        return self._s3
+
+    @property
+    def size(self):
+        """Returns the size of the body in bytes."""
+        return len(self._body.encode())
+
+    def stage(self, staging_url=None):
+        """Uploads the template to S3 to be read from there by CFN.
+
+        The object is named after the hexdigest, so a template is uploaded
+        once and reused by later runs. url is then a presigned URL of the
+        object, so that CFN in any account can read it without a bucket
+        policy.
+
+        Args:
+            staging_url:    s3://bucket/prefix the template is uploaded to.
+                            Defaults to the bucket of a template read from
+                            S3.
+
+        Returns:
+            The presigned URL of the staged template.
+
+        """
+        if not staging_url:
+            if not self._template_path.startswith('s3://'):
+                raise ValueError(
+                    "Template {} is {} bytes, templates over {} bytes need "
+                    "a staging url".format(self._template_path, self.size,
+                                           MAX_TEMPLATE_BODY_BYTES)
+                )
+            staging_url = "s3://{}/bct-account-provisioner".format(
+                self._template_path[len('s3://'):].split('/')[0]
+            )
+        if not staging_url.startswith('s3://'):
+            raise ValueError("staging_url must start with 's3://'")
+        s3_bucket, _, prefix = staging_url[len('s3://'):].partition('/')
+        s3_key = '/'.join(part for part in (prefix.strip('/'),
+                                            self._hexdigest + '.template')
+                          if part)
+        try:
+            self.s3_client.head_object(Bucket=s3_bucket, Key=s3_key)
+            logger.debug("Template already staged as s3://{}/{}".format(
+                s3_bucket, s3_key
+            ))
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('404', 'NoSuchKey',
+                                                    'NotFound'):
+                raise
+            logger.info("Staging template {} as s3://{}/{}".format(
+                self._template_path, s3_bucket, s3_key
+            ))
+            self.s3_client.put_object(Bucket=s3_bucket,
+                                      Key=s3_key,
+                                      Body=self._body.encode())
+        self._url = self.s3_client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': s3_bucket, 'Key': s3_key},
+            ExpiresIn=STAGED_TEMPLATE_URL_EXPIRY
+        )
+        return self._url
+
+    @property
+    def url(self):
+        """Returns the URL of the staged template, or None if it is not
+        staged."""
+        return self._url
+
+    def validate(self, cfn_client=None, check_structure=True):
+        """Checks the structure of the template, unless check_structure is
+        False, and with CloudFormation's ValidateTemplate when a cfn_client
+        is provided.
+
+        Raises ValueError with every problem found.
+        """
+        errors = template_errors(self._body) if check_structure else ()
+        if errors:
+            raise ValueError("Template {} is invalid: {}".format(
+                self._template_path, '; '.join(errors)
+            ))
+        if self.needs_staging and not self._url:
+            raise ValueError(
+                "Template {} is {} bytes and has to be staged in S3 to be "
+                "used".format(self._template_path, self.size)
+            )
+        if cfn_client:
+            try:
+                cfn_client.validate_template(
+                    **template_source(self._body, self._url)
+                )
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ValidationError':
+                    raise
+                raise ValueError("Template {} is invalid: {}".format(
+                    self._template_path, e.response['Error']['Message']
+                ))
+
     def __read_template(self):
-        s3 = boto3.client('s3')
-        cfn = boto3.client('cloudformation')
         if self._template_path.startswith('file://'):
             file_path = self._template_path.replace('file://', '')
             with open(file_path) as template_file:
                 template_body = template_file.read()
         elif self._template_path.startswith('s3://'):
-            s3_path = self._template_path.replace('s3://', '')
-            s3_bucket, s3_key = s3_path.split('/', maxsplit=1)
-            response = s3.get_object(Bucket=s3_bucket,
-                                     Key=s3_key)
-            # response is a binary obj, need to decode it into a string
-            template_body = response['Body'].read().decode()
+            template_body = self.__read_s3_template()
         else:
             raise ValueError(
                 "Invalid template_path: {}".format(self._template_path)
@@ -298,3 +1329,55 @@ class Template:
         if not template_body.endswith('\n'):
             template_body = template_body + '\n'
         return template_body
+
+    def __read_s3_template(self):
+        s3_path = self._template_path.replace('s3://', '')
+        s3_bucket, s3_key = s3_path.split('/', maxsplit=1)
+        cache_index = self.__read_cache_index()
+        cached = cache_index.get(self._template_path)
+        cached_body_path = (self.__cache_path(cached['hexdigest'])
+                            if cached else None)
+
+        get_kwargs = {'Bucket': s3_bucket, 'Key': s3_key}
+        if cached_body_path and os.path.exists(cached_body_path):
+            get_kwargs['IfNoneMatch'] = cached['etag']
+        try:
+            response = self.s3_client.get_object(**get_kwargs)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('304', 'NotModified'):
+                logger.debug("Using cached template for {}".format(
+                    self._template_path
+                ))
+                with open(cached_body_path) as template_file:
+                    return template_file.read()
+            raise
+
+        # response is a binary obj, need to decode it into a string
+        template_body = response['Body'].read().decode()
+        if not template_body.endswith('\n'):
+            template_body = template_body + '\n'
+        if self._cache_dir:
+            hexdigest = sha1(template_body.encode()).hexdigest()
+            os.makedirs(self._cache_dir, exist_ok=True)
+            with open(self.__cache_path(hexdigest), 'w') as template_file:
+                template_file.write(template_body)
+            cache_index[self._template_path] = {
+                'etag': response['ETag'],
+                'hexdigest': hexdigest
+            }
+            with open(self.__cache_path('index', '.json'), 'w') as index:
+                json.dump(cache_index, index, indent=2, sort_keys=True)
+        return template_body
+
+    def __cache_path(self, name, extension='.template'):
+        return os.path.join(self._cache_dir, name + extension)
+
+    def __read_cache_index(self):
+        """Returns a dict of S3 template URL to cached ETag and hexdigest."""
+        if not self._cache_dir:
+            return {}
+        try:
+            with open(self.__cache_path('index', '.json')) as index:
+                return json.load(index)
+        except (OSError, ValueError):
+            return {}
@@ -0,0 +1,263 @@
+from collections import Counter
+import logging
+import time
+
+from botocore.exceptions import ClientError
+
+from lib.clients import client_pool
+from lib.metrics import metrics
+from lib.stacks import template_parameter_names, template_source
+
+logger = logging.getLogger(__name__)
+
+# Statuses of a stack set operation that has finished
+OPERATION_DONE_STATUSES = ('SUCCEEDED', 'FAILED', 'STOPPED')
+
+
+class StackSet:
+    """Deploys a template to many accounts and regions with a StackSet.
+
+    The stack set is created in the account and region of the cfn_client
+    with the self-managed permission model, so the administrator account
+    needs the AWSCloudFormationStackSetAdministrationRole and each target
+    account the AWSCloudFormationStackSetExecutionRole. Managed execution
+    is turned on so CloudFormation queues operations that can not run at
+    the same time instead of rejecting them.
+
+    Args:
+        stack_set_name:     name of the CFN stack set
+        cfn_client:         boto3 cloudformation client of the administrator
+                            account, default client will be used if one is
+                            not provided
+        wait_timeout:       seconds to wait for each stack set operation to
+                            finish
+        max_concurrent_count: accounts deployed to at the same time in each
+                            region
+        failure_tolerance_count: failed accounts in a region before the
+                            operation is stopped in that region
+    """
+
+    def __init__(self, stack_set_name, cfn_client=None, wait_timeout=1800,
+                 max_concurrent_count=1, failure_tolerance_count=0):
+        self._api_calls = Counter()
+        self._cfn = (cfn_client if cfn_client
+                     else client_pool.client('cloudformation'))
+        self._failure_tolerance_count = failure_tolerance_count
+        self._max_concurrent_count = max_concurrent_count
+        self._name = stack_set_name
+        self._wait_timeout = wait_timeout
+
+    @property
+    def api_calls(self):
+        """Returns a dict of CFN operation name to number of calls made."""
+        return dict(self._api_calls)
+
+    def _call(self, operation, **kwargs):
+        """Calls a CFN operation and counts it."""
+        self._api_calls[operation] += 1
+        return getattr(self._cfn, operation)(**kwargs)
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def operation_preferences(self):
+        # STRICT_FAILURE_TOLERANCE, the default, would keep concurrency to
+        # at most FailureToleranceCount + 1 accounts
+        return {
+            'ConcurrencyMode': 'SOFT_FAILURE_TOLERANCE',
+            'FailureToleranceCount': self._failure_tolerance_count,
+            'MaxConcurrentCount': self._max_concurrent_count,
+            'RegionConcurrencyType': 'PARALLEL'
+        }
+
+    def apply_template(self, template, targets, parameters=None,
+                       template_url=None):
+        """Applies a template to the stack instances of the targets.
+
+        The stack set is created if it does not exist and updated if its
+        template or parameters differ. Only the instances of the targets are
+        updated, others are left OUTDATED. Instances are then created for
+        the targets that do not have one.
+        Parameters that are not declared in the template are left out.
+
+        Args:
+            template:   Body of the template.
+            targets:    A list of (account_id, region) pairs.
+            parameters: A dict of CFN parameters.
+            template_url: URL of the same template in S3, sent instead of
+                        the body when provided.
+
+        Returns:
+            A dict of (account_id, region) to an (action, error) tuple, where
+            action is 'created', 'updated', 'unchanged' or 'failed' and error
+            is the reason CloudFormation gave for a failure.
+
+        """
+        parameters = dict(parameters or {})
+        declared = template_parameter_names(template)
+        if declared is not None:
+            parameters = {key: str(value)
+                          for key, value in parameters.items()
+                          if key in declared}
+        param_list = [{'ParameterKey': key, 'ParameterValue': value}
+                      for key, value in sorted(parameters.items())]
+
+        results = {}
+        stack_set = self.__describe()
+        if not stack_set:
+            logger.info("Creating CFN stack set {}".format(self.name))
+            self._call('create_stack_set',
+                       StackSetName=self.name,
+                       **template_source(template, template_url),
+                       Parameters=param_list,
+                       Capabilities=['CAPABILITY_IAM', 'CAPABILITY_NAMED_IAM'],
+                       PermissionModel='SELF_MANAGED',
+                       ManagedExecution={'Active': True})
+            instances = {}
+        else:
+            instances = self.instances()
+            outdated = [target for target in targets
+                        if target in instances
+                        and instances[target]['Status'] != 'CURRENT']
+            if (self.__changed(stack_set, template, parameters)
+                    or outdated):
+                existing = [target for target in targets
+                            if target in instances]
+                for accounts, regions in self.__group(existing):
+                    logger.info("Updating {} stack instances of {}".format(
+                        len(accounts) * len(regions), self.name
+                    ))
+                    operation_id = self._call(
+                        'update_stack_set',
+                        StackSetName=self.name,
+                        **template_source(template, template_url),
+                        Parameters=param_list,
+                        Capabilities=['CAPABILITY_IAM',
+                                      'CAPABILITY_NAMED_IAM'],
+                        Accounts=accounts,
+                        Regions=regions,
+                        OperationPreferences=self.operation_preferences
+                    )['OperationId']
+                    results.update(self.__wait(
+                        operation_id, 'updated',
+                        [(account_id, region)
+                         for account_id in accounts for region in regions]
+                    ))
+
+        missing = [target for target in targets if target not in instances]
+        for accounts, regions in self.__group(missing):
+            logger.info("Creating {} stack instances of {}".format(
+                len(accounts) * len(regions), self.name
+            ))
+            operation_id = self._call(
+                'create_stack_instances',
+                StackSetName=self.name,
+                Accounts=accounts,
+                Regions=regions,
+                OperationPreferences=self.operation_preferences
+            )['OperationId']
+            results.update(self.__wait(
+                operation_id, 'created',
+                [(account_id, region)
+                 for account_id in accounts for region in regions]
+            ))
+
+        return {target: results.get(target, ('unchanged', None))
+                for target in targets}
+
+    def instances(self):
+        """Returns a dict of (account_id, region) to stack instance
+        summary."""
+        paginator = self._cfn.get_paginator('list_stack_instances')
+        self._api_calls['list_stack_instances'] += 1
+        return {(summary['Account'], summary['Region']): summary
+                for page in paginator.paginate(StackSetName=self.name)
+                for summary in page['Summaries']}
+
+    @staticmethod
+    def __changed(stack_set, template, parameters):
+        deployed_parameters = {param['ParameterKey']: param['ParameterValue']
+                               for param in stack_set.get('Parameters', [])}
+        return (stack_set.get('TemplateBody') != template
+                or deployed_parameters != parameters)
+
+    def __describe(self):
+        """Returns the stack set or None if it does not exist."""
+        try:
+            return self._call('describe_stack_set',
+                              StackSetName=self.name)['StackSet']
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'StackSetNotFoundException':
+                return None
+            raise
+
+    @staticmethod
+    def __group(targets):
+        """Groups targets into (accounts, regions) pairs, accounts with the
+        same regions share one operation."""
+        account_regions = {}
+        for account_id, region in targets:
+            account_regions.setdefault(account_id, []).append(region)
+        groups = {}
+        for account_id, regions in account_regions.items():
+            groups.setdefault(tuple(sorted(regions)), []).append(account_id)
+        return [(accounts, list(regions))
+                for regions, accounts in groups.items()]
+
+    def __operation_results(self, operation_id):
+        paginator = self._cfn.get_paginator(
+            'list_stack_set_operation_results'
+        )
+        self._api_calls['list_stack_set_operation_results'] += 1
+        return [summary
+                for page in paginator.paginate(StackSetName=self.name,
+                                               OperationId=operation_id)
+                for summary in page['Summaries']]
+
+    def __wait(self, operation_id, action, targets):
+        """Waits for an operation and returns the result of each of the
+        targets it covers, successful instances get the action.
+
+        Targets that are missing from the operation results get the status
+        of the operation as a whole.
+        """
+        deadline = time.monotonic() + self._wait_timeout
+        delay = 1
+        with metrics.phase('stack_set_wait'):
+            while True:
+                operation = self._call(
+                    'describe_stack_set_operation',
+                    StackSetName=self.name,
+                    OperationId=operation_id
+                )['StackSetOperation']
+                if operation['Status'] in OPERATION_DONE_STATUSES:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise RuntimeError(
+                        "Timed out after {} seconds waiting for stack set "
+                        "operation {}".format(self._wait_timeout,
+                                              operation_id))
+                time.sleep(min(delay, remaining))
+                delay = min(delay * 2, 15)
+        logger.info("Stack set operation {} {}".format(operation_id,
+                                                       operation['Status']))
+
+        results = {}
+        for summary in self.__operation_results(operation_id):
+            target = (summary['Account'], summary['Region'])
+            if summary['Status'] == 'SUCCEEDED':
+                results[target] = (action, None)
+            else:
+                results[target] = ('failed', summary.get(
+                    'StatusReason', summary['Status']))
+        for target in targets:
+            if target not in results:
+                results[target] = (
+                    (action, None) if operation['Status'] == 'SUCCEEDED'
+                    else ('failed', "Stack set operation {}".format(
+                        operation['Status'].lower()))
+                )
+        return results
@@ -0,0 +1,141 @@
+import logging
+import threading
+import time
+
+from botocore.config import Config
+
+from lib.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Calls per second allowed for each service in each region, services that
+# are not listed are not rate limited
+DEFAULT_RATE_LIMITS = {
+    'cloudformation': 4,
+    'sts': 10
+}
+
+# Attempts made for each call, including the first, before an error is
+# raised
+DEFAULT_MAX_ATTEMPTS = 10
+
+
+def retry_config(max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """Returns a botocore Config that retries throttled and transient errors.
+
+    The standard retry mode backs off exponentially with full jitter, so
+    concurrent workers that are throttled at the same time do not retry in
+    lock step.
+    """
+    return Config(retries={'mode': 'standard',
+                           'total_max_attempts': max_attempts})
+
+
+class TokenBucket:
+    """Thread safe token bucket.
+
+    Args:
+        rate:   Tokens added per second.
+        burst:  Most tokens the bucket holds. Defaults to rate, or 1 if rate
+                is lower than 1.
+
+    """
+
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise ValueError("rate must be greater than 0")
+        self._rate = float(rate)
+        self._burst = float(burst or max(rate, 1))
+        self._tokens = self._burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Takes a token, sleeping until one is available.
+
+        Returns:
+            The number of seconds slept.
+
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._burst,
+                               self._tokens
+                               + (now - self._updated) * self._rate)
+            self._updated = now
+            # Tokens are reserved before sleeping, so callers are served in
+            # the order they arrived
+            self._tokens -= 1
+            delay = -self._tokens / self._rate if self._tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+        return delay
+
+    @property
+    def rate(self):
+        return self._rate
+
+
+class RateLimiter:
+    """Limits the rate of AWS API calls per service and region.
+
+    A single RateLimiter is shared by all the sessions and clients of a run,
+    so the limits apply to the combined calls of all accounts and workers.
+    Every attempt takes a token, including retries.
+
+    Args:
+        rate_limits:    A dict of service name to calls per second. Merged
+                        with DEFAULT_RATE_LIMITS, a rate of 0 or None
+                        removes the limit for a service.
+
+    """
+
+    def __init__(self, rate_limits=None):
+        self._rate_limits = dict(DEFAULT_RATE_LIMITS)
+        self._rate_limits.update(rate_limits or {})
+        for service, rate in self._rate_limits.items():
+            if rate is not None and rate < 0:
+                raise ValueError(
+                    "Rate limit of {} can not be negative".format(service)
+                )
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, service, region):
+        """Returns the TokenBucket of a service and region, or None if the
+        service is not rate limited."""
+        rate = self._rate_limits.get(service)
+        if not rate:
+            return None
+        with self._lock:
+            if (service, region) not in self._buckets:
+                self._buckets[(service, region)] = TokenBucket(rate)
+            return self._buckets[(service, region)]
+
+    def instrument(self, target):
+        """Registers the limiter on a boto3 session or client.
+
+        Clients created from an instrumented session are rate limited as
+        well.
+        """
+        events = (target.meta.events if hasattr(target, 'meta')
+                  else target.events)
+
+        def before_sign(event_name, region_name, operation_name, **kwargs):
+            service = event_name.split('.')[1]
+            bucket = self.bucket(service, region_name)
+            if not bucket:
+                return
+            with metrics.phase('rate_limit_wait'):
+                delay = bucket.acquire()
+            if delay:
+                logger.debug("Rate limited {} {} in {} for {:.2f}s".format(
+                    service, operation_name, region_name, delay
+                ))
+
+        events.register('before-sign', before_sign)
+        return target
+
+    @property
+    def rate_limits(self):
+        return dict(self._rate_limits)
@@ -6,3 +6,7 @@ os.environ['AWS_SHARED_CREDENTIALS_FILE'] = 'tests/aws_creds_file'
 
 VALID_TEMPLATE1_URL = 'file://tests/cfn_valid_template1.yaml'
 VALID_TEMPLATE2_URL = 'file://tests/cfn_valid_template2.yaml'
+VALID_TEMPLATE3_URL = 'file://tests/cfn_valid_template3.yaml'
+VALID_TEMPLATE4_URL = 'file://tests/cfn_valid_template4.yaml'
+VALID_TEMPLATE5_URL = 'file://tests/cfn_valid_template5.yaml'
+VALID_TEMPLATE6_URL = 'file://tests/cfn_valid_template6.yaml'
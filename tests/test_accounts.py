@@ -2,7 +2,8 @@ import botocore
 import moto
 import pytest
 
-from lib.accounts import AwsAccounts, AwsAccount
+from lib import aio
+from lib.accounts import AwsAccounts, AwsAccount, IdentityCache
 
 
 @moto.mock_sts
@@ -86,3 +87,70 @@ def test_account_object():
 def test_account_object_invalid_profile():
     with pytest.raises(botocore.exceptions.ProfileNotFound):
         AwsAccount('invalid')
+
+
+@moto.mock_sts
+def test_accounts_async():
+    """Accounts are yielded as they resolve and then kept in profile order"""
+    aws_accounts = AwsAccounts(include='profile-include', max_workers=2)
+
+    async def collect():
+        return [account.profile_name
+                async for account in aws_accounts.accounts_async()]
+
+    assert sorted(aio.run(collect())) == ['profile-include1',
+                                          'profile-include2']
+    assert aws_accounts.discovered
+    assert [account.profile_name
+            for account in aws_accounts.target_accounts] == [
+                'profile-include1', 'profile-include2']
+
+
+@moto.mock_sts
+def test_target_accounts_memoized():
+    aws_accounts = AwsAccounts(include=['profile-include1'])
+    assert aws_accounts.target_accounts is aws_accounts.target_accounts
+
+
+@moto.mock_sts
+def test_profiles_max_workers():
+    accounts = AwsAccounts(
+                            include='.*include*',
+                            max_workers=4
+                           ).target_accounts
+    profiles = [account.profile_name for account in accounts]
+    assert profiles == ['profile-include1', 'profile-include2']
+
+
+def test_identity_cache(tmp_path):
+    cache_path = str(tmp_path / 'identities.json')
+    with moto.mock_sts():
+        AwsAccounts(include=['profile-include1'],
+                    identity_cache=IdentityCache(cache_path)
+                    ).target_accounts
+
+    # STS is no longer mocked, so the id has to come from the cache
+    accounts = AwsAccounts(include=['profile-include1'],
+                           identity_cache=IdentityCache(cache_path)
+                           ).target_accounts
+    assert accounts[0].id == '123456789012'
+
+
+def test_identity_cache_expired_and_changed(tmp_path):
+    cache = IdentityCache(str(tmp_path / 'identities.json'), ttl=0)
+    cache.set('default', 'fingerprint', '123456789012')
+    assert cache.get('default', 'fingerprint') is None
+
+    cache = IdentityCache(str(tmp_path / 'identities.json'))
+    cache.set('default', 'fingerprint', '123456789012')
+    assert cache.get('default', 'fingerprint') == '123456789012'
+    assert cache.get('default', 'other-fingerprint') is None
+
+
+def test_account_session_on_demand():
+    """A known account does not need its profile until it is used"""
+    account = AwsAccount('invalid', account_id='123456789012')
+    assert account.id == '123456789012'
+    assert not hasattr(account, '__dict__')
+    with pytest.raises(botocore.exceptions.ProfileNotFound):
+        account.client('cloudformation', region_name='us-east-1')
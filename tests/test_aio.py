@@ -0,0 +1,54 @@
+import asyncio
+import logging
+import threading
+import time
+
+from lib import aio
+from lib.logs import ContextFilter, log_context
+
+
+def test_iter_blocking():
+    """Every item is yielded with its result and at most limit calls run at
+    the same time"""
+    lock = threading.Lock()
+    running = []
+    most_running = []
+
+    def square(number):
+        with lock:
+            running.append(number)
+            most_running.append(len(running))
+        time.sleep(0.01)
+        with lock:
+            running.remove(number)
+        return number * number
+
+    async def collect():
+        return [result async for result in aio.iter_blocking(square,
+                                                             range(8), 3)]
+
+    results = aio.run(collect(), max_threads=8)
+    assert sorted(results) == [(number, number * number)
+                               for number in range(8)]
+    assert max(most_running) <= 3
+
+
+def test_log_context_follows_threads():
+    """Blocking calls made by a task are logged with the task's context"""
+    def context():
+        record = logging.LogRecord('test', logging.INFO, __file__, 0, '',
+                                   None, None)
+        ContextFilter().filter(record)
+        return record.context
+
+    async def task(label):
+        with log_context(label):
+            await asyncio.sleep(0)
+            return await asyncio.to_thread(context)
+
+    async def main():
+        return await asyncio.gather(task('111 us-east-1'),
+                                    task('222 us-west-2'))
+
+    assert aio.run(main()) == ['[111 us-east-1] ', '[222 us-west-2] ']
+    assert context() == ''
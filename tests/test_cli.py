@@ -0,0 +1,121 @@
+import json
+import subprocess
+import sys
+
+import moto
+import pytest
+
+from lib.cli import build_config, main
+from tests import VALID_TEMPLATE1_URL
+
+# Cumulative microseconds importing lib.cli may take. Wrapper scripts run
+# the provisioner thousands of times, so its cold start is guarded here.
+IMPORT_BUDGET_US = 100000
+
+HEAVY_MODULES = ('boto3', 'botocore', 'yaml')
+
+
+def run_python(code):
+    return subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                          capture_output=True, text=True)
+
+
+def imported(stderr):
+    """Returns a dict of module name to cumulative import time from the
+    output of -X importtime."""
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        modules[name.strip()] = int(cumulative)
+    return modules
+
+
+def test_import_budget():
+    """Importing the cli loads neither boto3 nor yaml and stays in budget"""
+    modules = imported(run_python('import lib.cli').stderr)
+    assert not [name for name in modules
+                if name.split('.')[0] in HEAVY_MODULES]
+    assert modules['lib.cli'] < IMPORT_BUDGET_US
+
+
+def test_help_skips_heavy_imports():
+    result = run_python("from lib.cli import main; main(['--help'])")
+    assert result.returncode == 0
+    assert '--template-url' in result.stdout
+    assert not [name for name in imported(result.stderr)
+                if name.split('.')[0] in HEAVY_MODULES]
+
+
+def test_config_error_before_aws_setup(tmp_path):
+    """Invalid config exits with status 2 before boto3 is imported"""
+    config_path = tmp_path / 'config.yaml'
+    config_path.write_text(
+        "Stacks:\n"
+        "  - CfnTemplateUrl: file://a.yaml\n"
+        "    DependsOn: b\n"
+        "  - CfnTemplateUrl: file://b.yaml\n"
+        "    DependsOn: a\n"
+    )
+    result = run_python(
+        "from lib.cli import main; main(['--config-file', {!r}])".format(
+            str(config_path))
+    )
+    assert result.returncode == 2
+    assert 'Dependency cycle' in result.stderr
+    assert not [name for name in imported(result.stderr)
+                if name.split('.')[0] in ('boto3', 'botocore')]
+
+
+def test_build_config():
+    config = build_config({'CfnParams': {'A': '1'}}, {
+        'CfnTemplateUrl': VALID_TEMPLATE1_URL,
+        'CfnParams': '{"B": "2"}',
+        'AwsRegion': 'us-east-1,us-west-2',
+        'MaxWorkers': None
+    })
+    assert config['CfnStackName'] == 'cfn_valid_template1'
+    assert config['CfnParams'] == {'A': '1', 'B': '2'}
+    assert config['AwsRegion'] == ['us-east-1', 'us-west-2']
+    assert config['MaxWorkers'] == 1
+
+
+def test_build_config_errors():
+    with pytest.raises(ValueError):
+        build_config({}, {'CfnTemplateUrl': 'https://example.com/a.yaml'})
+    with pytest.raises(ValueError):
+        build_config({}, {'CfnTemplateUrl': VALID_TEMPLATE1_URL,
+                          'Plan': True, 'Apply': True})
+
+
+@moto.mock_sts
+@moto.mock_cloudformation
+def test_main(tmp_path):
+    assert main([
+        '--config-file', str(tmp_path / 'missing.yaml'),
+        '--template-url', VALID_TEMPLATE1_URL,
+        '--include-profiles', 'profile-include1',
+        '--identity-cache-ttl', '0',
+        '--journal-file', str(tmp_path / 'journal.jsonl'),
+        '--no-confirm'
+    ]) == 0
+
+
+@moto.mock_sts
+@moto.mock_cloudformation
+def test_main_progress_file(tmp_path):
+    progress_path = tmp_path / 'progress.jsonl'
+    main([
+        '--config-file', str(tmp_path / 'missing.yaml'),
+        '--template-url', VALID_TEMPLATE1_URL,
+        '--include-profiles', 'profile-include1',
+        '--identity-cache-ttl', '0',
+        '--journal-file', str(tmp_path / 'journal.jsonl'),
+        '--progress-file', str(progress_path),
+        '--no-confirm'
+    ])
+    events = [json.loads(line)
+              for line in progress_path.read_text().splitlines()]
+    assert events[-2]['state'] == 'done'
+    assert events[-1]['event'] == 'summary'
@@ -0,0 +1,59 @@
+import moto
+
+from lib.accounts import AwsAccount
+from lib.clients import ClientPool
+
+
+def test_client_reuse():
+    client_pool = ClientPool(max_pool_connections=32)
+    cfn = client_pool.client('cloudformation', 'default', 'us-east-1')
+    assert client_pool.client('cloudformation', 'default', 'us-east-1') is cfn
+    assert (client_pool.client('cloudformation', 'default', 'us-west-2')
+            is not cfn)
+    assert client_pool.session('default') is client_pool.session('default')
+    assert cfn.meta.config.max_pool_connections == 32
+
+
+def test_shared_loader():
+    client_pool = ClientPool()
+    first = client_pool.session('default')
+    second = client_pool.session('profile-include1')
+    assert first is not second
+    loader = first._session.get_component('data_loader')
+    assert second._session.get_component('data_loader') is loader
+    assert len(loader.search_paths) == len(set(loader.search_paths))
+
+
+@moto.mock_sts
+def test_account_clients():
+    client_pool = ClientPool()
+    account = AwsAccount('default', client_pool=client_pool)
+    assert account.session is client_pool.session('default')
+    assert (account.client('sts')
+            is client_pool.client('sts', profile_name='default'))
+
+
+def test_release():
+    client_pool = ClientPool()
+    session = client_pool.session('default')
+    cfn = client_pool.client('cloudformation', 'default', 'us-east-1')
+    other = client_pool.session('profile-include1')
+    client_pool.release('default')
+    assert client_pool.session('default') is not session
+    assert (client_pool.client('cloudformation', 'default', 'us-east-1')
+            is not cfn)
+    assert client_pool.session('profile-include1') is other
+
+
+def test_sessions_do_not_share_handlers():
+    """Sessions get their own copy of the builtin event handlers"""
+    client_pool = ClientPool()
+    first = client_pool.session('default')
+    second = client_pool.session('profile-include1')
+    created = []
+    first.events.register('creating-client-class',
+                          lambda **kwargs: created.append(kwargs))
+    second.client('sts', region_name='us-east-1')
+    assert not created
+    first.client('sts', region_name='us-east-1')
+    assert len(created) == 1
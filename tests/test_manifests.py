@@ -0,0 +1,42 @@
+import pytest
+
+from lib.manifests import Manifest, StackSpec, resolve_parameters
+
+
+def test_dependency_order():
+    manifest = Manifest.from_config([
+        {'CfnStackName': 'CloudHealth',
+         'CfnTemplateUrl': 'file://templates/CloudHealth.yaml',
+         'CfnParams': {'RoleArn': {'StackOutput': 'BctTools.RoleArn'}}},
+        {'CfnStackName': 'Other',
+         'CfnTemplateUrl': 'file://templates/Other.yaml',
+         'DependsOn': 'CloudHealth'},
+        {'CfnStackName': 'BctTools',
+         'CfnTemplateUrl': 'file://templates/BctTools.yaml'}
+    ], default_parameters={'ExternalId': 'test123'})
+
+    assert [spec.name for spec in manifest] == ['BctTools', 'CloudHealth',
+                                                'Other']
+    assert manifest.get('CloudHealth').depends_on == ['BctTools']
+    assert manifest.get('CloudHealth').parameters['ExternalId'] == 'test123'
+    assert manifest.dependents('BctTools') == ['CloudHealth']
+
+
+def test_invalid_manifests():
+    with pytest.raises(ValueError, match='cycle'):
+        Manifest([StackSpec('a', 'file://a.yaml', depends_on=['b']),
+                  StackSpec('b', 'file://b.yaml', depends_on=['a'])])
+    with pytest.raises(ValueError, match='not in the manifest'):
+        Manifest([StackSpec('a', 'file://a.yaml', depends_on=['c'])])
+    with pytest.raises(ValueError, match='Duplicate'):
+        Manifest([StackSpec('a', 'file://a.yaml'),
+                  StackSpec('a', 'file://b.yaml')])
+
+
+def test_resolve_parameters():
+    parameters = {'Key': 'value', 'Arn': {'StackOutput': 'a.Arn'}}
+    assert resolve_parameters(parameters, {'a': {'Arn': 'arn'}}) == {
+        'Key': 'value', 'Arn': 'arn'
+    }
+    with pytest.raises(ValueError):
+        resolve_parameters(parameters, {'a': {}})
@@ -0,0 +1,52 @@
+import json
+
+import boto3
+import moto
+
+from lib.metrics import Metrics
+
+
+@moto.mock_cloudformation
+def test_instrument_client():
+    metrics = Metrics()
+    cfn = metrics.instrument(
+        boto3.client('cloudformation', region_name='us-east-1'),
+        account='123456789012'
+    )
+    cfn.describe_stacks()
+    cfn.describe_stacks()
+    with metrics.phase('test'):
+        pass
+
+    key = ('123456789012', 'cloudformation', 'DescribeStacks')
+    assert metrics.calls == {key: 2}
+    assert list(metrics.phases) == ['test']
+
+
+@moto.mock_sts
+def test_instrument_session_clients():
+    metrics = Metrics()
+    session = metrics.instrument(
+        boto3.session.Session(profile_name='default'),
+        account=lambda: 'default'
+    )
+    session.client('sts', region_name='us-east-1').get_caller_identity()
+    assert metrics.calls == {('default', 'sts', 'GetCallerIdentity'): 1}
+
+
+def test_write(tmp_path):
+    metrics = Metrics()
+    metrics.record_call('123456789012', 'sts', 'GetCallerIdentity')
+    metrics.record_throttle('123456789012', 'sts', 'GetCallerIdentity')
+
+    json_path = tmp_path / 'metrics.json'
+    metrics.write(str(json_path))
+    calls = json.loads(json_path.read_text())['calls']
+    assert calls[0]['calls'] == 1
+    assert calls[0]['throttles'] == 1
+
+    prom_path = tmp_path / 'metrics.prom'
+    metrics.write(str(prom_path))
+    assert ('bct_provisioner_api_throttles_total{account="123456789012",'
+            'service="sts",operation="GetCallerIdentity"} 1'
+            in prom_path.read_text())
@@ -0,0 +1,78 @@
+import boto3
+import moto
+import pytest
+
+from lib.clients import ClientPool
+from lib.organizations import OrganizationAccounts
+
+
+@pytest.fixture
+def organization():
+    with moto.mock_organizations(), moto.mock_sts():
+        organizations = boto3.client('organizations', region_name='us-east-1')
+        organizations.create_organization(FeatureSet='ALL')
+        root_id = organizations.list_roots()['Roots'][0]['Id']
+        workloads = organizations.create_organizational_unit(
+            ParentId=root_id, Name='workloads'
+        )['OrganizationalUnit']['Id']
+        production = organizations.create_organizational_unit(
+            ParentId=workloads, Name='production'
+        )['OrganizationalUnit']['Id']
+
+        account_ids = {}
+        for name, parent_id, tags in (
+                ('sandbox', root_id, []),
+                ('app-dev', workloads, [{'Key': 'bct', 'Value': 'true'}]),
+                ('app-prod', production, [{'Key': 'bct', 'Value': 'true'}])):
+            account_id = organizations.create_account(
+                AccountName=name,
+                Email="{}@example.com".format(name),
+                Tags=tags
+            )['CreateAccountStatus']['AccountId']
+            organizations.move_account(AccountId=account_id,
+                                       SourceParentId=root_id,
+                                       DestinationParentId=parent_id)
+            account_ids[name] = account_id
+        account_ids['workloads'] = workloads
+        yield account_ids
+
+
+def test_assumed_role_accounts(organization):
+    accounts = OrganizationAccounts('default',
+                                    include='^app-',
+                                    max_workers=2,
+                                    client_pool=ClientPool()).target_accounts
+    assert sorted(account.id for account in accounts) == sorted(
+        [organization['app-dev'], organization['app-prod']]
+    )
+    account = accounts[0]
+    assert account.profile_name.endswith('/OrganizationAccountAccessRole')
+    credentials = account.session.get_credentials()
+    assert credentials.method == 'bct-assume-role'
+    assert credentials.get_frozen_credentials().token
+
+
+def test_organizational_unit_and_tag_filters(organization):
+    accounts = OrganizationAccounts(
+        'default',
+        exclude=[organization['app-dev']],
+        organizational_units=organization['workloads'],
+        tags={'bct': 'true'},
+        client_pool=ClientPool()
+    ).target_accounts
+    assert [account.id for account in accounts] == [organization['app-prod']]
+
+
+def test_same_named_accounts(organization):
+    """Accounts sharing a name get their own sessions and credentials"""
+    organizations = boto3.client('organizations', region_name='us-east-1')
+    for email in ('dup1@example.com', 'dup2@example.com'):
+        organizations.create_account(AccountName='app-dup', Email=email)
+    accounts = OrganizationAccounts('default',
+                                    include='^app-dup$',
+                                    client_pool=ClientPool()).target_accounts
+    assert len({account.id for account in accounts}) == 2
+    for account in accounts:
+        assert account.profile_name.startswith(account.id)
+        identity = account.client('sts').get_caller_identity()
+        assert identity['Account'] == account.id
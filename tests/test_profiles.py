@@ -0,0 +1,70 @@
+import botocore.configloader
+import botocore.session
+
+from lib.profiles import SharedConfig
+
+CONFIG = """[default]
+region = us-east-1
+
+[profile config-only]
+region = eu-west-1
+"""
+
+CREDENTIALS = """[default]
+aws_access_key_id = default-key
+aws_secret_access_key = default-secret
+
+[credentials-only]
+aws_access_key_id = credentials-key
+aws_secret_access_key = credentials-secret
+"""
+
+
+def shared_config(tmp_path, credentials=CREDENTIALS):
+    config_file = tmp_path / 'config'
+    config_file.write_text(CONFIG)
+    credentials_file = tmp_path / 'credentials'
+    credentials_file.write_text(credentials)
+    return SharedConfig(config_file=str(config_file),
+                        credentials_file=str(credentials_file))
+
+
+def test_profiles(tmp_path):
+    """Profiles of both files are listed, config file profiles first"""
+    assert shared_config(tmp_path).profiles == ['default', 'config-only',
+                                                'credentials-only']
+
+
+def test_fingerprint(tmp_path):
+    """Editing a profile changes only its fingerprint"""
+    before = shared_config(tmp_path)
+    fingerprints = {profile: before.fingerprint(profile)
+                    for profile in before.profiles}
+    after = shared_config(tmp_path, CREDENTIALS.replace('credentials-secret',
+                                                        'rotated-secret'))
+    assert {profile: after.fingerprint(profile) == fingerprint
+            for profile, fingerprint in fingerprints.items()} == {
+                'default': True,
+                'config-only': True,
+                'credentials-only': False
+            }
+
+
+def test_apply_parses_once(tmp_path, monkeypatch):
+    """Sessions read credentials and config without parsing the files"""
+    monkeypatch.delenv('AWS_DEFAULT_REGION', raising=False)
+    config = shared_config(tmp_path)
+    config.profiles
+    parsed = []
+    raw_config_parse = botocore.configloader.raw_config_parse
+    monkeypatch.setattr(botocore.configloader, 'raw_config_parse',
+                        lambda path, *args, **kwargs: parsed.append(path)
+                        or raw_config_parse(path, *args, **kwargs))
+
+    for profile, key, region in (('default', 'default-key', 'us-east-1'),
+                                 ('credentials-only', 'credentials-key',
+                                  None)):
+        session = config.apply(botocore.session.Session(profile=profile))
+        assert session.get_credentials().access_key == key
+        assert session.get_config_variable('region') == region
+    assert parsed == []
@@ -0,0 +1,84 @@
+import io
+import json
+
+import moto
+import pytest
+
+from lib.progress import Progress, progress
+from lib.provisioners import AwsProvisioner
+from tests import VALID_TEMPLATE1_URL
+
+
+def events(stream):
+    return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+
+def test_emit():
+    """Events are NDJSON lines and unit() fills in the stack"""
+    stream = io.StringIO()
+    tracker = Progress()
+    tracker.start(stream=stream)
+    tracker.emit('discovered', account_id='111', profile_name='one')
+    with tracker.unit('111', 'one', 'us-east-1', 'stack'):
+        tracker.state('creating')
+        tracker.emit('failed', error=RuntimeError('boom'))
+    # Ignored outside of a unit
+    tracker.state('waiting')
+    tracker.stop()
+
+    lines = events(stream)
+    assert [line['state'] for line in lines[:-1]] == ['discovered',
+                                                      'creating', 'failed']
+    assert lines[1]['stack_name'] == 'stack'
+    assert lines[1]['region'] == 'us-east-1'
+    assert lines[2]['error'] == 'boom'
+    assert lines[-1]['event'] == 'summary'
+    assert lines[-1]['failed'] == 1
+    assert lines[-1]['discovered'] == 1
+    assert tracker.states == {('111', 'us-east-1', 'stack'): 'failed'}
+    with pytest.raises(ValueError):
+        tracker.emit('unknown')
+
+
+def test_summary():
+    """The summary counts finished and in flight stacks"""
+    summary_stream = io.StringIO()
+    tracker = Progress()
+    tracker.start(summary_stream=summary_stream, summary_interval=0)
+    for region in ('us-east-1', 'us-west-2', 'eu-west-1'):
+        tracker.emit('queued', account_id='111', region=region)
+    tracker.emit('waiting', account_id='111', region='us-east-1')
+    tracker.emit('done', account_id='111', region='us-west-2')
+    # Terminal states are not left for a later transition
+    tracker.emit('waiting', account_id='111', region='us-west-2')
+
+    assert str(tracker).startswith(
+        "1/3 stacks finished (0 failed, 0 skipped), 1 in flight"
+    )
+    tracker.stop()
+    assert len(summary_stream.getvalue().splitlines()) == 7
+
+
+@moto.mock_sts
+@moto.mock_cloudformation
+def test_provision_accounts_progress():
+    """Provisioning streams the states of each stack"""
+    stream = io.StringIO()
+    progress.start(stream=stream)
+    try:
+        AwsProvisioner(VALID_TEMPLATE1_URL, 'us-east-1', 'test-stack', {},
+                       include_profiles=['profile-include1']
+                       ).provision_accounts(confirm=False)
+    finally:
+        progress.stop()
+
+    lines = events(stream)
+    states = [line['state'] for line in lines
+              if line['event'] == 'state' and line['region']]
+    assert states == ['queued', 'planning', 'creating', 'waiting', 'done']
+    assert [line['state'] for line in lines
+            if line['event'] == 'state' and not line['region']] == [
+                'discovering', 'discovered']
+    assert lines[-2]['action'] == 'created'
+    assert lines[-2]['stack_name'] == 'test-stack'
+    assert lines[-1]['done'] == 1
@@ -1,8 +1,18 @@
+import asyncio
+import json
+
+import botocore.exceptions
 import moto
 import pytest
 
+from lib.accounts import AwsAccount
+from lib.clients import ClientPool
+from lib.manifests import Manifest, StackSpec
+from lib.plans import Plan
 from lib.provisioners import AwsProvisioner
-from tests import VALID_TEMPLATE1_URL
+from lib.stacks import Stack
+from tests import (VALID_TEMPLATE1_URL, VALID_TEMPLATE4_URL,
+                   VALID_TEMPLATE5_URL, VALID_TEMPLATE6_URL)
 
 TEST_PARAMS = [
     {},
@@ -44,3 +54,374 @@ def test_provision_accounts(cfn_params):
 
     assert stack_status == ['CREATE_COMPLETE']
 
+
+@moto.mock_sts
+@moto.mock_cloudformation
+def test_provision_accounts_summary():
+    """Results are collected per account"""
+    provisioner = AwsProvisioner(
+                                    VALID_TEMPLATE1_URL,
+                                    'us-east-1',
+                                    'test-stack',
+                                    {},
+                                    include_profiles=['profile-include1'],
+                                    max_workers=2
+                                )
+
+    summary = provisioner.provision_accounts(confirm=False)
+    assert [result.action for result in summary.results] == ['created']
+    assert summary.failed == []
+
+
+@moto.mock_sts
+@moto.mock_cloudformation
+def test_provision_accounts_failures_collected(monkeypatch):
+    """A failing account does not stop the remaining accounts"""
+    async def apply_template_async(self, template, parameters=None,
+                                   template_url=None):
+        raise RuntimeError("apply failed")
+
+    monkeypatch.setattr(Stack, 'apply_template_async', apply_template_async)
+    provisioner = AwsProvisioner(
+                                    VALID_TEMPLATE1_URL,
+                                    'us-east-1',
+                                    'test-stack',
+                                    {},
+                                    include_profiles=['profile-include1',
+                                                      'profile-include2'],
+                                    max_workers=2
+                                )
+
+    summary = provisioner.provision_accounts(confirm=False)
+    assert len(summary.failed) == 2
+    assert str(summary.failed[0].error) == "apply failed"
+
+
+@moto.mock_sts
+@moto.mock_cloudformation
+def test_plan_and_apply(tmp_path):
+    """Change sets from a saved plan are executed by apply_plan"""
+    provisioner = AwsProvisioner(
+                                    VALID_TEMPLATE1_URL,
+                                    'us-east-1',
+                                    'test-stack',
+                                    {},
+                                    include_profiles=['profile-include1']
+                                )
+
+    plan = provisioner.plan_accounts()
+    assert [change.action for change in plan.changes] == ['create']
+    plan_path = str(tmp_path / 'plan.json')
+    plan.save(plan_path)
+
+    summary = provisioner.apply_plan(Plan.load(plan_path), confirm=False)
+    assert [result.action for result in summary.results] == ['created']
+
+    plan = provisioner.plan_accounts()
+    assert [change.action for change in plan.changes] == ['none']
+
+
+@moto.mock_sts
+@moto.mock_sqs
+@moto.mock_cloudformation
+def test_provision_accounts_regions():
+    """Each account is provisioned in every region"""
+    provisioner = AwsProvisioner(
+                                    VALID_TEMPLATE4_URL,
+                                    ['us-east-1', 'us-west-2'],
+                                    'test-stack',
+                                    {},
+                                    include_profiles=['profile-include1'],
+                                    max_workers=2
+                                )
+
+    summary = provisioner.provision_accounts(confirm=False)
+    assert [(result.region, result.action)
+            for result in summary.results] == [('us-east-1', 'created'),
+                                               ('us-west-2', 'created')]
+
+
+@moto.mock_sts
+@moto.mock_cloudformation
+def test_provision_accounts_resume(tmp_path):
+    """Accounts recorded in the journal are skipped when resuming"""
+    journal_path = str(tmp_path / 'journal.jsonl')
+    provisioner = AwsProvisioner(
+                                    VALID_TEMPLATE1_URL,
+                                    'us-east-1',
+                                    'test-stack',
+                                    {},
+                                    include_profiles=['profile-include1'],
+                                    journal_path=journal_path
+                                )
+    summary = provisioner.provision_accounts(confirm=False)
+    assert [result.action for result in summary.results] == ['created']
+
+    provisioner = AwsProvisioner(
+                                    VALID_TEMPLATE1_URL,
+                                    'us-east-1',
+                                    'test-stack',
+                                    {},
+                                    include_profiles=['profile-include1'],
+                                    journal_path=journal_path,
+                                    resume=True
+                                )
+    summary = provisioner.provision_accounts(confirm=False)
+    assert [result.action for result in summary.results] == ['skipped']
+
+    # Different params are not recorded in the journal yet
+    provisioner = AwsProvisioner(
+                                    VALID_TEMPLATE1_URL,
+                                    'us-east-1',
+                                    'test-stack',
+                                    {'Param': 'value'},
+                                    include_profiles=['profile-include1'],
+                                    journal_path=journal_path,
+                                    resume=True
+                                )
+    summary = provisioner.provision_accounts(confirm=False)
+    assert [result.action for result in summary.results] == ['unchanged']
+
+
+@moto.mock_sts
+@moto.mock_sqs
+@moto.mock_cloudformation
+def test_provision_accounts_stack_set():
+    """StackSet results map back to each account and region"""
+    provisioner = AwsProvisioner(
+                                    VALID_TEMPLATE4_URL,
+                                    ['us-east-1', 'us-west-2'],
+                                    'test-stack-set',
+                                    {},
+                                    include_profiles=['profile-include1',
+                                                      'profile-include2'],
+                                    max_workers=2,
+                                    engine='stackset'
+                                )
+
+    summary = provisioner.provision_accounts(confirm=False)
+    assert [result.action for result in summary.results] == ['created'] * 4
+    assert ({(result.account_id, result.region)
+             for result in summary.results}
+            == {(account.id, region)
+                for account in provisioner.accounts
+                for region in ['us-east-1', 'us-west-2']})
+
+    summary = provisioner.provision_accounts(confirm=False)
+    assert [result.action for result in summary.results] == ['unchanged'] * 4
+
+    with pytest.raises(ValueError):
+        provisioner.plan_accounts()
+
+
+def manifest_provisioner(**kwargs):
+    manifest = Manifest([
+        StackSpec('target', VALID_TEMPLATE6_URL, parameters={
+            'SourceQueueArn': {'StackOutput': 'source.QueueArn'}
+        }),
+        StackSpec('source', VALID_TEMPLATE5_URL),
+        StackSpec('independent', VALID_TEMPLATE4_URL)
+    ])
+    return AwsProvisioner(None, 'us-east-1', None, None,
+                          include_profiles=['profile-include1'],
+                          max_workers=3,
+                          manifest=manifest,
+                          **kwargs)
+
+
+@moto.mock_sts
+@moto.mock_sqs
+@moto.mock_cloudformation
+def test_provision_accounts_manifest():
+    """Stacks are provisioned in dependency order with outputs as params"""
+    provisioner = manifest_provisioner()
+    summary = provisioner.provision_accounts(confirm=False)
+    assert [(result.stack_name, result.action)
+            for result in summary.results] == [('source', 'created'),
+                                               ('target', 'created'),
+                                               ('independent', 'created')]
+
+    cfn = provisioner.accounts[0].session.client('cloudformation',
+                                                 region_name='us-east-1')
+    outputs = {
+        stack_name: {output['OutputKey']: output['OutputValue']
+                     for output in cfn.describe_stacks(
+                         StackName=stack_name)['Stacks'][0]['Outputs']}
+        for stack_name in ['source', 'target']
+    }
+    assert outputs['target']['SourceQueueArn'] == outputs['source']['QueueArn']
+
+
+@moto.mock_sts
+@moto.mock_sqs
+@moto.mock_cloudformation
+def test_provision_accounts_manifest_failed_dependency(tmp_path,
+                                                       monkeypatch):
+    """A failed stack only stops the stacks that depend on it"""
+    apply_template_async = Stack.apply_template_async
+
+    async def fail_source(stack, template, parameters=None,
+                          template_url=None):
+        if stack.name == 'source':
+            raise RuntimeError("apply failed")
+        return await apply_template_async(stack, template,
+                                          parameters=parameters,
+                                          template_url=template_url)
+
+    monkeypatch.setattr(Stack, 'apply_template_async', fail_source)
+    journal_path = tmp_path / 'journal.jsonl'
+    summary = manifest_provisioner(
+        journal_path=str(journal_path)
+    ).provision_accounts(confirm=False)
+    assert [(result.stack_name, result.action)
+            for result in summary.results] == [('source', 'failed'),
+                                               ('target', 'failed'),
+                                               ('independent', 'created')]
+    assert 'source' in str(summary.failed[1].error)
+    # Stacks that were not provisioned for a failed dependency are journaled
+    entries = [json.loads(line)
+               for line in journal_path.read_text().splitlines()]
+    assert sorted((entry['stack_name'], entry['status'])
+                  for entry in entries) == [('independent', 'created'),
+                                            ('source', 'failed'),
+                                            ('target', 'failed')]
+
+
+def test_invalid_template_fails_before_discovery(tmp_path, monkeypatch):
+    """A template that can not be deployed fails the run up front"""
+    template_path = tmp_path / 'invalid.yaml'
+    template_path.write_text("Resources:\n  Role:\n    Properties: {}\n")
+
+    def discover(self):
+        raise AssertionError("accounts were discovered")
+
+    monkeypatch.setattr(AwsProvisioner, 'accounts', property(discover))
+    with pytest.raises(ValueError, match='Resource Role has no Type'):
+        AwsProvisioner('file://{}'.format(template_path), 'us-east-1',
+                       'test-stack', {}).provision_accounts(confirm=False)
+
+
+@moto.mock_sts
+@moto.mock_cloudformation
+def test_provision_accounts_canary(tmp_path, monkeypatch):
+    """A failing canary cancels the accounts of the following waves,
+    without creating their clients"""
+    applied = []
+    clients = []
+    client = AwsAccount.client
+
+    def count_client(account, service_name, region_name=None):
+        if service_name == 'cloudformation':
+            clients.append(account.profile_name)
+        return client(account, service_name, region_name=region_name)
+
+    async def apply_template_async(self, template, parameters=None,
+                                   template_url=None):
+        applied.append(self.name)
+        raise RuntimeError("apply failed")
+
+    monkeypatch.setattr(Stack, 'apply_template_async', apply_template_async)
+    monkeypatch.setattr(AwsAccount, 'client', count_client)
+    provisioner = AwsProvisioner(
+                                    VALID_TEMPLATE1_URL,
+                                    'us-east-1',
+                                    'test-stack',
+                                    {},
+                                    include_profiles=['profile-include1',
+                                                      'profile-include2'],
+                                    max_workers=2,
+                                    journal_path=tmp_path / 'journal.jsonl',
+                                    canary_size=1,
+                                    failure_threshold=10
+                                )
+
+    summary = provisioner.provision_accounts(confirm=False)
+    assert applied == ['test-stack']
+    assert len(clients) == 1
+    assert sorted(result.action for result in summary.results) == [
+        'cancelled', 'failed']
+    assert len(summary.failed) == 2
+    with pytest.raises(ValueError):
+        AwsProvisioner(VALID_TEMPLATE1_URL, 'us-east-1', 'test-stack', {},
+                       engine='stackset', canary_size=1)
+
+
+@moto.mock_sts
+@moto.mock_cloudformation
+def test_cancelled_accounts_not_released(monkeypatch):
+    """Clients of an account with a cancelled stack stay open, its blocking
+    calls may still be running"""
+    applied = []
+
+    async def apply_template_async(self, template, parameters=None,
+                                   template_url=None):
+        applied.append(self.name)
+        if len(applied) == 1:
+            await asyncio.sleep(60)
+        raise RuntimeError("apply failed")
+
+    monkeypatch.setattr(Stack, 'apply_template_async', apply_template_async)
+    # Profiles of different accounts, which are provisioned at the same time
+    monkeypatch.setattr(AwsAccount, 'id', property(
+        lambda account: account.profile_name))
+    provisioner = AwsProvisioner(
+                                    VALID_TEMPLATE1_URL,
+                                    'us-east-1',
+                                    'test-stack',
+                                    {},
+                                    include_profiles=['profile-include1',
+                                                      'profile-include2'],
+                                    max_workers=2,
+                                    failure_threshold=0
+                                )
+    summary = provisioner.provision_accounts(confirm=False)
+    cancelled = [result.profile_name for result in summary.results
+                 if result.action == 'cancelled']
+    assert len(cancelled) == 1
+    assert list(provisioner._client_pool._clients) == cancelled
+
+
+@moto.mock_sts
+@moto.mock_cloudformation
+def test_provision_accounts_broken_profile(monkeypatch):
+    """A profile whose account can not be looked up is left out, the other
+    accounts are provisioned and summarized"""
+    client = ClientPool.client
+
+    def broken_client(pool, service_name, profile_name=None, **kwargs):
+        if service_name == 'sts' and profile_name == 'profile-include2':
+            raise botocore.exceptions.NoCredentialsError()
+        return client(pool, service_name, profile_name=profile_name,
+                      **kwargs)
+
+    monkeypatch.setattr(ClientPool, 'client', broken_client)
+    summary = AwsProvisioner(
+                                VALID_TEMPLATE1_URL,
+                                'us-east-1',
+                                'test-stack',
+                                {},
+                                include_profiles=['profile-include1',
+                                                  'profile-include2'],
+                                max_workers=2
+                            ).provision_accounts(confirm=False)
+    assert [(result.profile_name, result.action)
+            for result in summary.results] == [('profile-include1',
+                                                'created')]
+
+
+@moto.mock_sts
+@moto.mock_cloudformation
+def test_provision_accounts_same_account():
+    """Profiles of the same account are provisioned one after the other"""
+    summary = AwsProvisioner(
+                                VALID_TEMPLATE1_URL,
+                                'us-east-1',
+                                'test-stack',
+                                {},
+                                include_profiles=['profile-include1',
+                                                  'profile-include2'],
+                                max_workers=2
+                            ).provision_accounts(confirm=False)
+    assert len({result.account_id for result in summary.results}) == 1
+    assert sorted(result.action for result in summary.results) == [
+        'created', 'unchanged']
@@ -0,0 +1,101 @@
+import asyncio
+
+import pytest
+
+from lib import aio
+from lib.provisioners import ProvisionResult
+from lib.rollouts import Rollout
+
+
+def result(action):
+    return ProvisionResult('111', 'one', 'us-east-1', action)
+
+
+def test_wave():
+    """Waves start with the canary and grow by wave_growth"""
+    assert [Rollout().wave(index) for index in range(3)] == [0, 0, 0]
+    rollout = Rollout(canary_size=2, wave_growth=2)
+    assert [rollout.wave(index) for index in range(16)] == (
+        [0] * 2 + [1] * 4 + [2] * 8 + [3] * 2)
+    # A growth of 1 gives waves of the canary's size
+    rollout = Rollout(canary_size=2, wave_growth=1)
+    assert [rollout.wave(index) for index in range(6)] == [0, 0, 1, 1, 2, 2]
+    rollout = Rollout(canary_size=2, wave_growth=1.5)
+    assert [rollout.wave(index) for index in range(10)] == (
+        [0] * 2 + [1] * 3 + [2] * 5)
+    with pytest.raises(ValueError):
+        Rollout(canary_size=-1)
+    with pytest.raises(ValueError):
+        Rollout(wave_growth=0.5)
+    with pytest.raises(ValueError):
+        Rollout(failure_threshold=100)
+
+
+def test_record():
+    """The rollout stops once more than failure_threshold percent of the
+    finished stacks failed"""
+    rollout = Rollout(failure_threshold=50)
+    for action in ('created', 'failed', 'skipped', 'cancelled'):
+        rollout.record(result(action))
+    assert not rollout.stopped
+    rollout.record(result('failed'))
+    assert rollout.stopped
+    assert rollout.reason.startswith("2 of 3 finished stacks failed")
+
+    rollout = Rollout()
+    rollout.record(result('failed'))
+    assert not rollout.stopped
+
+
+def test_record_min_finished():
+    """A single early failure does not decide the threshold on its own"""
+    rollout = Rollout(failure_threshold=10)
+    rollout.record(result('failed'))
+    for _ in range(8):
+        rollout.record(result('created'))
+    assert not rollout.stopped
+    rollout.record(result('failed'))
+    assert rollout.stopped
+
+    # The canary is judged on all of its stacks
+    rollout = Rollout(canary_size=2, failure_threshold=10,
+                      stacks_per_account=2)
+    for action in ('failed', 'created', 'created'):
+        rollout.record(result(action))
+    assert not rollout.stopped
+    rollout.record(result('created'))
+    assert rollout.stopped
+
+    rollout = Rollout(canary_size=2, failure_threshold=0)
+    rollout.record(result('failed'))
+    assert rollout.stopped
+
+
+def test_stop_cancels_running():
+    """stop() cancels the coroutines in flight and later ones are not run"""
+    started = []
+
+    async def provision(name, delay, action):
+        started.append(name)
+        await asyncio.sleep(delay)
+        return result(action)
+
+    async def rollout_run():
+        rollout = Rollout(failure_threshold=0)
+
+        async def run(name, delay, action):
+            outcome = await rollout.run(provision(name, delay, action))
+            if outcome:
+                rollout.record(outcome)
+            return outcome
+
+        slow = asyncio.ensure_future(run('slow', 10, 'created'))
+        outcomes = [await run('failing', 0, 'failed'), await slow,
+                    await run('pending', 0, 'created')]
+        return rollout, outcomes
+
+    rollout, outcomes = aio.run(rollout_run())
+    assert rollout.stopped
+    assert outcomes[0].action == 'failed'
+    assert outcomes[1:] == [None, None]
+    assert sorted(started) == ['failing', 'slow']
@@ -1,9 +1,14 @@
+import boto3
+import botocore.exceptions
 import moto
 import pytest
 
-from lib.stacks import Stack, Template
+from lib.stacks import (MAX_TEMPLATE_BODY_BYTES, PARAMETERS_HEXDIGEST_TAG,
+                        Stack, StackInventory, StackWaiter, Template,
+                        parameters_hexdigest, template_errors)
 from tests import (VALID_TEMPLATE1_URL,
-                   VALID_TEMPLATE2_URL)
+                   VALID_TEMPLATE2_URL,
+                   VALID_TEMPLATE3_URL)
 
 
 def test_template_invalid_path_format():
@@ -17,6 +22,171 @@ def test_template_hexdigest():
     assert template.hexdigest == 'e52c979111e5ea905648146555c689b32b2d5bea'
 
 
+class InProgressCfnClient:
+    """Stand-in cfn client for a stack that never finishes"""
+
+    def describe_stack_events(self, **kwargs):
+        return {'StackEvents': [{
+            'EventId': 'event1',
+            'StackName': 'OcmsTest',
+            'LogicalResourceId': 'OcmsTest',
+            'ResourceType': 'AWS::CloudFormation::Stack',
+            'ResourceStatus': 'UPDATE_IN_PROGRESS'
+        }]}
+
+
+def test_waiter_timeout():
+    waiter = StackWaiter(InProgressCfnClient(), 'OcmsTest', timeout=0)
+    with pytest.raises(RuntimeError):
+        waiter.wait()
+    assert [event['ResourceStatus'] for event in waiter.events] == [
+        'UPDATE_IN_PROGRESS'
+    ]
+
+
+@moto.mock_s3
+def test_template_s3_cache(tmp_path):
+    s3 = boto3.client('s3', region_name='us-east-1')
+    s3.create_bucket(Bucket='test-bucket')
+    s3.put_object(Bucket='test-bucket', Key='template.yaml', Body=b'v1\n')
+    template_url = 's3://test-bucket/template.yaml'
+
+    template = Template(template_url, cache_dir=str(tmp_path))
+    assert template.body == 'v1\n'
+    cached_path = tmp_path / '{}.template'.format(template.hexdigest)
+    assert cached_path.read_text() == 'v1\n'
+
+    # unchanged ETag, so the template is read from the cache
+    cached_path.write_text('cached\n')
+    assert Template(template_url, cache_dir=str(tmp_path)).body == 'cached\n'
+
+    s3.put_object(Bucket='test-bucket', Key='template.yaml', Body=b'v2\n')
+    assert Template(template_url, cache_dir=str(tmp_path)).body == 'v2\n'
+
+
+def test_template_errors():
+    assert template_errors(Template(VALID_TEMPLATE1_URL).body) == ()
+    assert template_errors("Resources: {}\nResource: {}\n") == (
+        "Unknown template sections: Resource",
+        "Template must declare at least one resource"
+    )
+    assert template_errors(
+        "Parameters:\n  Name: {}\nResources:\n  Role:\n    Properties: {}\n"
+    ) == ("Resource Role has no Type", "Parameter Name has no Type")
+    assert template_errors("- not a template\n") == (
+        "Template must be a JSON or YAML object",
+    )
+
+
+def test_template_errors_valid_templates(tmp_path):
+    """Templates CloudFormation accepts pass the check"""
+    # JSON indented with tabs, which YAML does not allow
+    assert template_errors(
+        '{\n\t"Resources": {\n\t\t"Topic": {"Type": "AWS::SNS::Topic"}'
+        '\n\t}\n}\n'
+    ) == ()
+    assert template_errors(
+        "Transform: AWS::LanguageExtensions\n"
+        "Resources:\n"
+        "  Fn::ForEach::Topics:\n"
+        "    - Name\n"
+        "    - [A, B]\n"
+        "    - Topic${Name}:\n"
+        "        Type: AWS::SNS::Topic\n"
+    ) == ()
+    assert template_errors(
+        "Hooks: {}\nResources:\n  Topic:\n    Type: AWS::SNS::Topic\n"
+    ) == ()
+    # The check can be turned off for constructs it does not know
+    template_path = tmp_path / 'template.yaml'
+    template_path.write_text("Resources: {}\n")
+    template = Template('file://{}'.format(template_path))
+    with pytest.raises(ValueError):
+        template.validate()
+    template.validate(check_structure=False)
+
+
+class InvalidTemplateCfnClient:
+    """Stand-in cfn client rejecting every template"""
+
+    def __init__(self):
+        self.calls = []
+
+    def validate_template(self, **kwargs):
+        self.calls.append(kwargs)
+        raise botocore.exceptions.ClientError({'Error': {
+            'Code': 'ValidationError',
+            'Message': 'Template format error'
+        }}, 'ValidateTemplate')
+
+
+def test_template_validate_remote():
+    cfn = InvalidTemplateCfnClient()
+    template = Template(VALID_TEMPLATE1_URL)
+    with pytest.raises(ValueError, match='Template format error'):
+        template.validate(cfn_client=cfn)
+    assert cfn.calls == [{'TemplateBody': template.body}]
+
+
+def large_template(tmp_path):
+    """Returns the file:// url of a valid template over
+    MAX_TEMPLATE_BODY_BYTES"""
+    body = Template(VALID_TEMPLATE1_URL).body.replace(
+        'Description: template used for testing creation of new stack',
+        'Description: {}'.format('x' * MAX_TEMPLATE_BODY_BYTES)
+    )
+    path = tmp_path / 'large.yaml'
+    path.write_text(body)
+    return 'file://{}'.format(path)
+
+
+class CountingS3Client:
+    """Wraps an s3 client to count uploads"""
+
+    def __init__(self, client):
+        self._client = client
+        self.uploads = 0
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def put_object(self, **kwargs):
+        self.uploads += 1
+        return self._client.put_object(**kwargs)
+
+
+@moto.mock_s3
+@moto.mock_sts
+@moto.mock_cloudformation
+def test_template_stage(tmp_path):
+    """Large templates are uploaded once and sent as a TemplateURL"""
+    s3 = CountingS3Client(boto3.client('s3', region_name='us-east-1'))
+    s3.create_bucket(Bucket='test-bucket')
+    template = Template(large_template(tmp_path), s3_client=s3)
+    assert template.needs_staging
+    with pytest.raises(ValueError):
+        template.validate()
+    with pytest.raises(ValueError):
+        template.stage()
+
+    url = template.stage('s3://test-bucket/staged/')
+    template.validate()
+    key = 'staged/{}.template'.format(template.hexdigest)
+    assert url == template.url
+    assert key in url
+    Template(large_template(tmp_path), s3_client=s3).stage(
+        's3://test-bucket/staged')
+    assert s3.uploads == 1
+
+    cfn = boto3.client('cloudformation', region_name='us-east-1')
+    stack = Stack('LargeTest', cfn_client=cfn)
+    assert stack.apply_template(template.body,
+                                template_url=template.url) == 'created'
+    assert stack.api_calls['create_stack'] == 1
+    deployed = cfn.get_template(StackName='LargeTest')['TemplateBody']
+    assert len(deployed) > MAX_TEMPLATE_BODY_BYTES
+
+
 @pytest.fixture
 def cfn_templates():
     """Generating template object in a fixture as moto does not implement the
@@ -47,3 +217,155 @@ class TestCfnCreateUpdate:
         stack.apply_template(template1.body)
         stack.apply_template(template2.body)
         assert stack.hexdigest == template2.hexdigest
+
+    def test_snapshot_api_calls(self, cfn_templates):
+        template = cfn_templates[0]
+        stack = Stack("OcmsTest")
+        stack.apply_template(template.body)
+        # create_stack and the wait invalidate the snapshot, so the stack is
+        # described once before and once after creating it
+        str(stack)
+        assert stack.api_calls['describe_stacks'] == 2
+        assert stack.api_calls['create_stack'] == 1
+
+        stack.refresh()
+        assert stack.api_calls['describe_stacks'] == 3
+        assert stack.status == 'CREATE_COMPLETE'
+        assert stack.api_calls['describe_stacks'] == 3
+
+    def test_inventory(self, cfn_templates):
+        template = cfn_templates[0]
+        Stack("OcmsTest").apply_template(template.body)
+
+        inventory = StackInventory().load()
+        assert inventory.names == ['OcmsTest']
+        assert inventory.get('Missing') is None
+
+        stack = inventory.stack("OcmsTest")
+        assert stack.apply_template(template.body) == 'unchanged'
+        assert stack.status == 'CREATE_COMPLETE'
+        assert 'describe_stacks' not in stack.api_calls
+        assert inventory.api_calls == {'describe_stacks': 1}
+
+    def test_update_stack_events(self, cfn_templates):
+        template1, template2 = cfn_templates
+        stack = Stack("OcmsTest")
+        stack.apply_template(template1.body)
+        stack.apply_template(template2.body)
+        statuses = [event['ResourceStatus'] for event in stack.events
+                    if event['LogicalResourceId'] == 'OcmsTest']
+        assert statuses == ['UPDATE_IN_PROGRESS', 'UPDATE_COMPLETE']
+
+    def test_recorded_hexdigest(self, cfn_templates):
+        template = cfn_templates[0]
+        stack = Stack("OcmsTest")
+        stack.apply_template(template.body)
+        assert stack.recorded_hexdigest == template.hexdigest
+
+        stack = Stack("OcmsTest")
+        assert stack.apply_template(template.body) == 'unchanged'
+        assert 'get_template' not in stack.api_calls
+
+        stack = Stack("OcmsTest", verify_deployed=True)
+        assert stack.apply_template(template.body) == 'unchanged'
+        assert stack.api_calls['get_template'] == 1
+
+
+@moto.mock_sts
+@moto.mock_cloudformation
+def test_change_set_not_executed():
+    """A stack only created by a change set is planned as a create again"""
+    template = Template(VALID_TEMPLATE1_URL)
+    change_set = Stack("OcmsTest").create_change_set(template.body)
+    assert change_set.type == 'CREATE'
+
+    stack = Stack("OcmsTest")
+    assert stack.status == 'REVIEW_IN_PROGRESS'
+    assert stack.diff(template.body).action == 'create'
+    change_set = stack.create_change_set(template.body)
+    assert change_set.type == 'CREATE'
+
+
+@moto.mock_sts
+@moto.mock_cloudformation
+def test_stack_diff():
+    template = Template(VALID_TEMPLATE3_URL)
+    stack = Stack("OcmsParamsTest")
+    stack.apply_template(template.body,
+                         parameters={'RoleNameSuffix': 'A',
+                                     'PrincipalAccountId': '555703595940',
+                                     'Undeclared': 'value'})
+    assert stack.last_diff.action == 'create'
+    assert stack.last_diff.ignored == ['Undeclared']
+
+    diff = stack.diff(template.body, parameters={'RoleNameSuffix': 'B'})
+    assert diff.action == 'update'
+    assert not diff.template_changed
+    assert diff.changed == {'RoleNameSuffix': ('A', 'B')}
+    assert diff.previous == ['PrincipalAccountId']
+    assert {'ParameterKey': 'PrincipalAccountId',
+            'UsePreviousValue': True} in diff.cfn_parameters
+
+    action = stack.apply_template(template.body,
+                                  parameters={'RoleNameSuffix': 'B',
+                                              'PrincipalAccountId': '1234'})
+    assert action == 'updated'
+    assert stack.api_calls['update_stack'] == 1
+    assert len(stack.last_diff.changed) == 2
+
+
+NO_ECHO_TEMPLATE = """Parameters:
+  Name:
+    Type: String
+  Secret:
+    Type: String
+    NoEcho: true
+Resources:
+  Topic:
+    Type: AWS::SNS::Topic
+    Properties:
+      TopicName: !Ref Name
+"""
+
+
+class NoUpdatesCfnClient:
+    """Passes calls to a cfn client, but rejects updates the way CFN does
+    when nothing changed"""
+
+    def __init__(self, cfn):
+        self._cfn = cfn
+
+    def __getattr__(self, name):
+        return getattr(self._cfn, name)
+
+    def update_stack(self, **kwargs):
+        raise botocore.exceptions.ClientError({'Error': {
+            'Code': 'ValidationError',
+            'Message': 'No updates are to be performed.'
+        }}, 'UpdateStack')
+
+
+@moto.mock_sts
+@moto.mock_cloudformation
+def test_stack_no_echo_parameters():
+    """NoEcho values are not hashed into the stack tags, CFN compares
+    them instead"""
+    parameters = {'Name': 'topic', 'Secret': 'hunter2'}
+    stack = Stack("NoEchoTest")
+    assert stack.apply_template(NO_ECHO_TEMPLATE, parameters) == 'created'
+    stack.refresh()
+    assert stack.tags[PARAMETERS_HEXDIGEST_TAG] == parameters_hexdigest(
+        {'Name': 'topic'})
+
+    diff = stack.diff(NO_ECHO_TEMPLATE, parameters)
+    assert diff.action == 'update'
+    assert diff.changed == {'Secret': ('****', '****')}
+    assert diff.parameters_hexdigest == parameters_hexdigest(
+        {'Name': 'topic'})
+    # Without the NoEcho parameter the stack is up to date
+    assert stack.diff(NO_ECHO_TEMPLATE, {'Name': 'topic'}).action == 'none'
+
+    cfn = NoUpdatesCfnClient(boto3.client('cloudformation',
+                                          region_name='us-east-1'))
+    stack = Stack("NoEchoTest", cfn_client=cfn)
+    assert stack.apply_template(NO_ECHO_TEMPLATE, parameters) == 'unchanged'
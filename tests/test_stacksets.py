@@ -0,0 +1,70 @@
+import boto3
+import moto
+
+from lib.stacksets import StackSet
+
+with open('tests/cfn_valid_template4.yaml') as template_file:
+    TEMPLATE = template_file.read()
+TARGETS = [('111111111111', 'us-east-1'), ('222222222222', 'us-east-1')]
+
+
+@moto.mock_sqs
+@moto.mock_cloudformation
+def test_apply_template():
+    cfn = boto3.client('cloudformation', region_name='us-east-1')
+    stack_set = StackSet('test-stack-set', cfn_client=cfn)
+
+    results = stack_set.apply_template(TEMPLATE, TARGETS)
+    assert results == {target: ('created', None) for target in TARGETS}
+    assert set(stack_set.instances()) == set(TARGETS)
+
+    new_target = ('333333333333', 'us-east-1')
+    results = stack_set.apply_template(TEMPLATE, TARGETS + [new_target])
+    assert results[new_target] == ('created', None)
+    assert results[TARGETS[0]] == ('unchanged', None)
+
+    results = stack_set.apply_template(TEMPLATE + '\n', TARGETS)
+    assert results == {target: ('updated', None) for target in TARGETS}
+    assert stack_set.api_calls['update_stack_set'] == 1
+
+
+class RecordingCfnClient:
+    """Passes calls to a cfn client and records their arguments"""
+
+    def __init__(self, cfn):
+        self._cfn = cfn
+        self.calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self._cfn, name)
+
+        def call(*args, **kwargs):
+            self.calls.append((name, kwargs))
+            return method(*args, **kwargs)
+        return call
+
+
+@moto.mock_sqs
+@moto.mock_cloudformation
+def test_apply_template_scoped_to_targets():
+    """Operations cover the targets only and run max_concurrent_count
+    accounts at a time with the default failure tolerance"""
+    cfn = RecordingCfnClient(boto3.client('cloudformation',
+                                          region_name='us-east-1'))
+    stack_set = StackSet('test-stack-set', cfn_client=cfn,
+                         max_concurrent_count=4)
+    stack_set.apply_template(TEMPLATE, TARGETS)
+    results = stack_set.apply_template(TEMPLATE + '\n', TARGETS[:1])
+    assert results == {TARGETS[0]: ('updated', None)}
+
+    operations = {name: kwargs for name, kwargs in cfn.calls
+                  if name in ('create_stack_instances', 'update_stack_set')}
+    assert operations['update_stack_set']['Accounts'] == ['111111111111']
+    assert operations['update_stack_set']['Regions'] == ['us-east-1']
+    for kwargs in operations.values():
+        assert kwargs['OperationPreferences'] == {
+            'ConcurrencyMode': 'SOFT_FAILURE_TOLERANCE',
+            'FailureToleranceCount': 0,
+            'MaxConcurrentCount': 4,
+            'RegionConcurrencyType': 'PARALLEL'
+        }
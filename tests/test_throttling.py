@@ -0,0 +1,46 @@
+import moto
+
+from lib.accounts import AwsAccount
+from lib.clients import ClientPool
+from lib.throttling import RateLimiter, TokenBucket, retry_config
+
+
+def test_token_bucket(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr('lib.throttling.time.sleep', sleeps.append)
+    monkeypatch.setattr('lib.throttling.time.monotonic', lambda: 100.0)
+
+    bucket = TokenBucket(2)
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == 0
+    # Bucket is empty, each call waits for the calls queued before it
+    assert bucket.acquire() == 0.5
+    assert bucket.acquire() == 1.0
+    assert sleeps == [0.5, 1.0]
+
+
+def test_rate_limiter_buckets():
+    limiter = RateLimiter({'cloudformation': 0, 's3': 5})
+    assert limiter.bucket('cloudformation', 'us-east-1') is None
+    assert limiter.bucket('s3', 'us-east-1').rate == 5
+    assert (limiter.bucket('sts', 'us-east-1')
+            is limiter.bucket('sts', 'us-east-1'))
+    assert (limiter.bucket('sts', 'us-east-1')
+            is not limiter.bucket('sts', 'us-west-2'))
+
+
+@moto.mock_sts
+def test_rate_limited_account(monkeypatch):
+    calls = []
+    monkeypatch.setattr(TokenBucket, 'acquire',
+                        lambda bucket: calls.append(bucket) or 0)
+
+    limiter = RateLimiter()
+    client_pool = ClientPool(rate_limiter=limiter,
+                             client_config=retry_config(max_attempts=3))
+    account = AwsAccount('default', client_pool=client_pool)
+    assert account.id
+    assert calls == [limiter.bucket('sts', 'us-east-1')]
+    sts = account.client('sts', region_name='us-east-1')
+    assert sts.meta.config.retries == {'mode': 'standard',
+                                       'total_max_attempts': 3}